@@ -0,0 +1,572 @@
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import queue
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+
+from build_cache import hash_file
+from constants import USER_DATA_DIR
+from file_matcher import translate
+from pathlib import Path
+from profiling import trace
+
+LOCAL_HEADER_SIZE = 30
+DATA_DESCRIPTOR_FLAG = 0x08
+STREAM_CHUNK_SIZE = 64 * 1024
+BOUNDED_STREAM_CHUNKS = 16
+DEFAULT_COMPRESSION_LEVEL = 6
+STORED_EXTENSIONS = frozenset([
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp4', '.m4v', '.mkv', '.ts', '.mp3', '.m4a', '.aac',
+    '.ogg', '.zip', '.gz', '.pkg', '.woff', '.woff2'
+])
+COMPRESS_BATCH_BYTES = 1024 * 1024
+# deflated output past this is written to a file instead of being passed back in memory
+SPILL_BYTES = COMPRESS_BATCH_BYTES
+PARALLEL_COMPRESS_BYTES = 4 * 1024 * 1024
+# crc, file size and whether the cached data is deflated
+CACHED_ENTRY_HEADER = struct.Struct('<IQ?')
+ENTRY_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+def default_entry_cache_dir():
+    return Path.home() / USER_DATA_DIR / 'entries'
+
+
+def read_raw_entry(archive_file, info):
+    """
+    Reads the still compressed bytes of a zip entry so it can be copied without inflating it
+    :param archive_file: Object - open binary file object of the source archive
+    :param info: Object - ZipInfo of the entry to read
+    :return: Bytes
+    """
+    archive_file.seek(info.header_offset)
+    header = archive_file.read(LOCAL_HEADER_SIZE)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    archive_file.seek(info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length)
+
+    return archive_file.read(info.compress_size)
+
+
+def write_raw_entry(target_zip, info, raw_data):
+    """
+    Writes an already compressed entry into an archive opened for writing
+    :param target_zip: Object - ZipFile opened in write mode
+    :param info: Object - ZipInfo with CRC, sizes and compression type already set
+    :param raw_data: Bytes, Object - compressed entry data or a binary file object to copy compress_size bytes
+                     from, stored data copied from a file is checked against the crc
+    """
+    # sizes and crc are known up front so the entry never needs a data descriptor
+    info.flag_bits &= ~DATA_DESCRIPTOR_FLAG
+    info.header_offset = target_zip.fp.tell()
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    target_zip.fp.write(info.FileHeader(zip64))
+    if isinstance(raw_data, bytes):
+        target_zip.fp.write(raw_data)
+    else:
+        remaining = info.compress_size
+        crc = 0
+        while remaining:
+            chunk = raw_data.read(min(STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            target_zip.fp.write(chunk)
+            remaining -= len(chunk)
+        # the header was written from an earlier read of the file
+        if remaining or raw_data.read(1) or (info.compress_type == zipfile.ZIP_STORED and crc != info.CRC):
+            raise OSError(f'{info.filename} changed while it was archived')
+    target_zip.filelist.append(info)
+    target_zip.NameToInfo[info.filename] = info
+    target_zip.start_dir = target_zip.fp.tell()
+    target_zip._didModify = True
+
+
+def zip_info(relative_path, stat):
+    """
+    Builds the entry header from an existing stat result, same fields as ZipInfo.from_file
+    :param relative_path: String - posix path inside the archive
+    :param stat: Object - os.stat_result of the source file
+    :return: Object - ZipInfo set up for deflate
+    """
+    date_time = time.localtime(stat.st_mtime)[0:6]
+    info = zipfile.ZipInfo(relative_path, date_time if date_time[0] >= 1980 else (1980, 1, 1, 0, 0, 0))
+    info.external_attr = (stat.st_mode & 0xFFFF) << 16
+    info.file_size = stat.st_size
+    info.compress_type = zipfile.ZIP_DEFLATED
+
+    return info
+
+
+class CompressionPolicy:
+    """
+    Picks the compression level of every entry. Config rules map a glob to a level from
+    0 (stored) to 9 and are checked in order, otherwise already compressed media is stored
+    and everything else is deflated at the default level
+    """
+    def __init__(self, rules=None):
+        self.rules = dict(rules or {})
+        self.patterns = []
+        for pattern, level in self.rules.items():
+            if not isinstance(level, int) or not 0 <= level <= 9:
+                raise ValueError(f'compression level for "{pattern}" has to be a number from 0 to 9')
+            self.patterns.append((re.compile(translate(pattern)), level))
+
+    def level_for(self, relative_path):
+        for pattern, level in self.patterns:
+            if pattern.fullmatch(relative_path):
+                return level
+        if os.path.splitext(relative_path)[1].lower() in STORED_EXTENSIONS:
+            return 0
+
+        return DEFAULT_COMPRESSION_LEVEL
+
+
+class EntryCache:
+    """
+    Deflated entries shared between builds and channels, keyed by the content hash of the
+    file and the compression level, so a file common to several channel variants is only
+    compressed once
+    """
+    def __init__(self, cache_dir, hashes):
+        """
+        :param cache_dir: Object - path object to the cache directory
+        :param hashes: Dictionary - relative path to the sha1 of its content, files without one are not cached
+        """
+        self.cache_dir = Path(cache_dir)
+        self.hashes = hashes
+
+    def entry_for(self, relative_path, level):
+        """
+        :return: Tuple, None - cache file path and the sha1 the file has to have for it to be used
+        """
+        sha1 = self.hashes.get(relative_path)
+        if sha1 is None or level == 0:
+            return None
+
+        return str(self.cache_dir / sha1[:2] / f'{sha1}-{level}'), sha1
+
+
+class SpilledEntry(collections.namedtuple('SpilledEntry', ['path', 'offset', 'size', 'temporary'])):
+    """
+    Deflated data of an entry held in a file, a temporary one is removed once copied
+    """
+
+
+def remove_spilled(results):
+    for _, _, raw_data in results:
+        if isinstance(raw_data, SpilledEntry) and raw_data.temporary:
+            try:
+                os.unlink(raw_data.path)
+            except FileNotFoundError:
+                pass
+
+
+def deflate_file(source_path, level, digest=None):
+    """
+    Deflates a file a chunk at a time, output past SPILL_BYTES goes to a temporary file so
+    neither a large file nor its deflated data is held in memory
+    :param source_path: String - file to deflate
+    :param level: Int - compression level
+    :param digest: Object - hashlib object updated with the bytes deflated
+    :return: Tuple - crc, file size and raw deflate data, a SpilledEntry or None when deflate does not make
+             the file smaller
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    compressed = 0
+    chunks = []
+    spill = None
+    try:
+        with open(source_path, 'rb') as source:
+            for chunk in iter(lambda: source.read(STREAM_CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                chunks.append(compressor.compress(chunk))
+                compressed += len(chunks[-1])
+                if spill is None and compressed > SPILL_BYTES:
+                    spill = tempfile.NamedTemporaryFile(prefix='rokuPi-', suffix='.deflate', delete=False)
+                if spill is not None:
+                    spill.writelines(chunks)
+                    chunks = []
+        chunks.append(compressor.flush())
+        compressed += len(chunks[-1])
+        if spill is not None:
+            spill.writelines(chunks)
+            spill.close()
+    except BaseException:
+        if spill is not None:
+            spill.close()
+            os.unlink(spill.name)
+        raise
+
+    if compressed >= size:
+        if spill is not None:
+            os.unlink(spill.name)
+        return crc, size, None
+    if spill is not None:
+        return crc, size, SpilledEntry(spill.name, 0, compressed, True)
+
+    return crc, size, b''.join(chunks)
+
+
+def read_cached_entry(cache_path):
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            crc, size, deflated = CACHED_ENTRY_HEADER.unpack(cache_file.read(CACHED_ENTRY_HEADER.size))
+            compressed = os.fstat(cache_file.fileno()).st_size - CACHED_ENTRY_HEADER.size
+            if not deflated:
+                raw_data = None
+            elif compressed > SPILL_BYTES:
+                raw_data = SpilledEntry(cache_path, CACHED_ENTRY_HEADER.size, compressed, False)
+            else:
+                raw_data = cache_file.read()
+    except (FileNotFoundError, struct.error):
+        return None
+    # the modification time orders entries for trim_entry_cache
+    os.utime(cache_path)
+
+    return crc, size, raw_data
+
+
+def write_cached_entry(cache_path, crc, size, raw_data):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    part_path = f'{cache_path}.{os.getpid()}.part'
+    with open(part_path, 'wb') as cache_file:
+        cache_file.write(CACHED_ENTRY_HEADER.pack(crc, size, raw_data is not None))
+        if isinstance(raw_data, SpilledEntry):
+            with open(raw_data.path, 'rb') as spilled:
+                spilled.seek(raw_data.offset)
+                shutil.copyfileobj(spilled, cache_file, STREAM_CHUNK_SIZE)
+        elif raw_data is not None:
+            cache_file.write(raw_data)
+    os.replace(part_path, cache_path)
+
+
+def trim_entry_cache(cache_dir, max_bytes):
+    """
+    Removes the least recently used cached entries until the cache is within max_bytes
+    :param cache_dir: Object - path object to the cache directory
+    :param max_bytes: Int - size limit
+    :return: Int - removed entries
+    """
+    entries = []
+    for root, _, files in os.walk(str(cache_dir)):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.unlink(path)
+        total -= size
+        removed += 1
+
+    return removed
+
+
+def compress_files(entries):
+    """
+    Process pool worker, deflates a batch of channel files. Stored files only get their crc
+    so the parent can copy them without holding them in memory, files that deflate does
+    not make smaller are stored as well
+    :param entries: List - tuples of relative path, source path, compression level and the result of
+                    EntryCache.entry_for or None. The cache is only used or written when the file still has
+                    the hash it was scanned with, a file edited since would otherwise be cached under a stale key
+    :return: List - tuples of crc, file size and raw deflate data, a SpilledEntry or None for stored files
+    """
+    results = []
+    try:
+        for _, source_path, level, cache_entry in entries:
+            cache_path, sha1 = cache_entry or (None, None)
+            cached = read_cached_entry(cache_path) if cache_path else None
+            if cached is not None and hash_file(source_path) == sha1:
+                results.append(cached)
+            elif level == 0:
+                crc = 0
+                size = 0
+                with open(source_path, 'rb') as source:
+                    for chunk in iter(lambda: source.read(STREAM_CHUNK_SIZE), b''):
+                        crc = zlib.crc32(chunk, crc)
+                        size += len(chunk)
+                results.append((crc, size, None))
+            else:
+                digest = hashlib.sha1()
+                results.append(deflate_file(source_path, level, digest))
+                if cache_path and digest.hexdigest() == sha1:
+                    write_cached_entry(cache_path, *results[-1])
+    except BaseException:
+        remove_spilled(results)
+        raise
+
+    return results
+
+
+def plan_batches(relative_paths, compression, stats, channel_path, sources, entry_cache=None):
+    """
+    Groups files in archive order into batches of about COMPRESS_BATCH_BYTES so small
+    files do not pay one process round trip each
+    :return: Tuple - list of batches and the number of bytes that will be deflated
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    deflate_bytes = 0
+    for relative_path in relative_paths:
+        level = compression.level_for(relative_path)
+        source_path = str(sources.get(relative_path) or os.path.join(channel_path, relative_path))
+        stat = stats.get(relative_path) or os.stat(source_path)
+        cache_entry = entry_cache.entry_for(relative_path, level) if entry_cache is not None else None
+        batch.append((relative_path, source_path, level, cache_entry))
+        if level:
+            batch_bytes += stat.st_size
+            deflate_bytes += stat.st_size
+        if batch_bytes >= COMPRESS_BATCH_BYTES:
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+    if batch:
+        batches.append(batch)
+
+    return batches, deflate_bytes
+
+
+def write_entries(target_zip, channel_path, relative_paths, compression=None, stats=None, max_workers=None,
+                  sources=None, entry_cache=None):
+    """
+    Writes channel files into an archive in the given order. Batches are deflated across a
+    process pool a few batches ahead of the writer, small builds are compressed in process
+    :param target_zip: Object - ZipFile opened in write mode
+    :param channel_path: Object - path object to channel root
+    :param relative_paths: Iterable - relative posix paths in archive order
+    :param compression: Object - CompressionPolicy, defaults to storing media and deflating the rest
+    :param stats: Dictionary - relative path to os.stat_result, missing files are stat'ed
+    :param max_workers: Int - compression processes, defaults to the cpu count
+    :param sources: Dictionary - relative path to a file archived in place of the channel file
+    :param entry_cache: Object - EntryCache deflated entries are taken from and added to
+    """
+    channel_path = str(channel_path)
+    compression = compression or CompressionPolicy()
+    stats = stats or {}
+    batches, deflate_bytes = plan_batches(relative_paths, compression, stats, channel_path, sources or {},
+                                          entry_cache)
+    workers = max_workers or os.cpu_count() or 1
+    executor = None
+    if workers > 1 and len(batches) > 1 and deflate_bytes >= PARALLEL_COMPRESS_BYTES:
+        executor = concurrent.futures.ProcessPoolExecutor(min(workers, len(batches)))
+
+    def submit(batch):
+        return executor.submit(compress_files, batch) if executor else None
+
+    pending = collections.deque()
+    try:
+        # a bounded window of batches in flight keeps memory flat on large channels
+        remaining = iter(batches)
+        pending.extend((batch, submit(batch)) for batch in itertools.islice(remaining, workers * 2))
+        while pending:
+            batch, future = pending.popleft()
+            next_batch = next(remaining, None)
+            if next_batch is not None:
+                pending.append((next_batch, submit(next_batch)))
+
+            results = future.result() if future else compress_files(batch)
+            try:
+                for (relative_path, source_path, _, _), (crc, size, raw_data) in zip(batch, results):
+                    info = zip_info(relative_path, stats.get(relative_path) or os.stat(source_path))
+                    info.CRC = crc
+                    info.file_size = size
+                    if raw_data is None:
+                        info.compress_type = zipfile.ZIP_STORED
+                        info.compress_size = size
+                        with open(source_path, 'rb') as source:
+                            write_raw_entry(target_zip, info, source)
+                    elif isinstance(raw_data, SpilledEntry):
+                        info.compress_size = raw_data.size
+                        with open(raw_data.path, 'rb') as spilled:
+                            spilled.seek(raw_data.offset)
+                            write_raw_entry(target_zip, info, spilled)
+                    else:
+                        info.compress_size = len(raw_data)
+                        write_raw_entry(target_zip, info, raw_data)
+            finally:
+                remove_spilled(results)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+            # batches deflated ahead of a failed write may have spilled to temporary files
+            for _, future in pending:
+                if future is not None and not future.cancelled() and future.exception() is None:
+                    remove_spilled(future.result())
+
+
+def update_archive(previous_archive_path, archive_path, channel_path, changed, removed, compression=None,
+                   max_workers=None, sources=None, entry_cache=None):
+    """
+    Writes a new archive reusing the compressed entries of the previous one, only the
+    changed files are read from the channel and deflated again
+    :param previous_archive_path: Object - path object to the last built archive
+    :param archive_path: Object - path object to where the updated archive is going
+    :param channel_path: Object - path object to channel root
+    :param changed: List - relative paths of added or modified files
+    :param removed: List - relative paths of files no longer part of the channel
+    :param compression: Object - CompressionPolicy for the changed files
+    :param max_workers: Int - compression processes for the changed files
+    :param sources: Dictionary - relative path to a file archived in place of the channel file
+    :param entry_cache: Object - EntryCache deflated entries are taken from and added to
+    """
+    skipped = set(changed) | set(removed)
+    part_path = Path(f'{archive_path}.part')
+
+    with trace('archive_update', 'build', files=len(changed)) as span, \
+            zipfile.ZipFile(str(previous_archive_path)) as previous_zip, \
+            open(str(previous_archive_path), 'rb') as previous_file, \
+            zipfile.ZipFile(str(part_path), 'w', zipfile.ZIP_DEFLATED) as updated_zip:
+        for info in previous_zip.infolist():
+            if info.filename in skipped:
+                continue
+            write_raw_entry(updated_zip, info, read_raw_entry(previous_file, info))
+
+        write_entries(updated_zip, channel_path, changed, compression, max_workers=max_workers, sources=sources,
+                      entry_cache=entry_cache)
+        span["bytes"] = updated_zip.fp.tell()
+
+    os.replace(str(part_path), str(archive_path))
+    if Path(previous_archive_path) != Path(archive_path) and Path(previous_archive_path).exists():
+        os.unlink(str(previous_archive_path))
+
+
+class ChunkPipe:
+    """
+    Write only file object handing zip output to a consumer thread in fixed size chunks,
+    zipfile sees it as unseekable and writes data descriptors instead of seeking back
+    """
+    def __init__(self, max_chunks=0):
+        self.chunks = queue.Queue(max_chunks)
+        self.buffer = bytearray()
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.bytes_written += len(data)
+        if len(self.buffer) >= STREAM_CHUNK_SIZE:
+            self.chunks.put(bytes(self.buffer))
+            self.buffer.clear()
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self, error=None):
+        if self.buffer:
+            self.chunks.put(bytes(self.buffer))
+            self.buffer.clear()
+        self.chunks.put(error)
+
+
+class ArchiveStream:
+    """
+    Iterable of zip bytes built straight from the channel source files while they are
+    being consumed, optionally writing the same bytes to an out archive on its own thread
+    """
+    def __init__(self, channel_path, relative_paths, archive_path=None, bounded_memory=False, on_complete=None,
+                 stats=None, compression=None, max_workers=None, sources=None, entry_cache=None):
+        self.channel_path = Path(channel_path)
+        self.relative_paths = relative_paths
+        self.stats = stats or {}
+        self.compression = compression
+        self.max_workers = max_workers
+        self.sources = sources
+        self.entry_cache = entry_cache
+        self.archive_path = archive_path
+        self.max_chunks = BOUNDED_STREAM_CHUNKS if bounded_memory else 0
+        self.on_complete = on_complete
+        self.bytes_streamed = 0
+
+    @property
+    def name(self):
+        return Path(self.archive_path).name if self.archive_path else f'{self.channel_path.name}.zip'
+
+    def write_archive(self, pipe):
+        try:
+            with trace('archive_stream', 'build', files=len(self.relative_paths)) as span:
+                with zipfile.ZipFile(pipe, 'w', zipfile.ZIP_DEFLATED) as zf:
+                    write_entries(zf, self.channel_path, self.relative_paths, self.compression, self.stats,
+                                  self.max_workers, self.sources, self.entry_cache)
+                span["bytes"] = pipe.bytes_written
+        except Exception as e:
+            pipe.close(e)
+        else:
+            pipe.close()
+
+    def write_out(self, chunks, result):
+        """
+        Writes streamed chunks to a part file next to the out archive, keeps draining the
+        queue after a write error so the upload is never blocked by the disk
+        """
+        part_path = Path(f'{self.archive_path}.part')
+        try:
+            with open(str(part_path), 'wb') as out_file:
+                for chunk in iter(chunks.get, None):
+                    out_file.write(chunk)
+            result["path"] = part_path
+        except OSError as e:
+            result["error"] = e
+            for _ in iter(chunks.get, None):
+                pass
+
+    def __iter__(self):
+        pipe = ChunkPipe(self.max_chunks)
+        producer = threading.Thread(target=self.write_archive, args=(pipe,), daemon=True)
+        producer.start()
+
+        out_chunks = None
+        out_writer = None
+        out_result = {}
+        if self.archive_path is not None:
+            out_chunks = queue.Queue(self.max_chunks)
+            out_writer = threading.Thread(target=self.write_out, args=(out_chunks, out_result), daemon=True)
+            out_writer.start()
+
+        completed = False
+        try:
+            for chunk in iter(pipe.chunks.get, None):
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if out_chunks is not None:
+                    out_chunks.put(chunk)
+                self.bytes_streamed += len(chunk)
+                yield chunk
+            completed = True
+        finally:
+            if not completed:
+                # unblock the producer if the consumer stopped reading early
+                while producer.is_alive():
+                    try:
+                        pipe.chunks.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            producer.join()
+            if out_writer is not None:
+                out_chunks.put(None)
+                out_writer.join()
+            if not completed and "path" in out_result:
+                os.unlink(str(out_result["path"]))
+
+        if "path" in out_result:
+            os.replace(str(out_result["path"]), str(self.archive_path))
+        if self.on_complete is not None and "error" not in out_result:
+            self.on_complete()
@@ -0,0 +1,214 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from constants import USER_DATA_DIR
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, the index is only guarded within one process
+    fcntl = None
+
+ARTIFACT_INDEX_FILE = 'index.json'
+ARTIFACT_LOCK_FILE = 'index.lock'
+ARTIFACT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+ARTIFACT_MAX_COUNT = 100
+
+
+def default_store_dir():
+    return Path.home() / USER_DATA_DIR / 'artifacts'
+
+
+def artifact_key(build_fingerprint, settings=None):
+    """
+    Identifies a built archive by the hash of its input files and manifest, and the
+    compression and optimizer settings it was built with
+    :param build_fingerprint: String - Channel.build_fingerprint
+    :param settings: Dictionary - build settings stored in the build cache
+    :return: String - hex digest
+    """
+    digest = hashlib.sha1(build_fingerprint.encode('utf-8'))
+    digest.update(json.dumps(settings or {}, sort_keys=True).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+class ArtifactStore:
+    """
+    Per user store of built archives addressed by artifact_key, so any earlier build can be
+    deployed again without rebuilding. An index file holds every entry for lookups without
+    listing the store, the least recently used archives are evicted past the size or count limit.
+    Changes to the index hold a file lock as parallel builds share the store
+    """
+    def __init__(self, store_dir=None, max_bytes=ARTIFACT_MAX_BYTES, max_count=ARTIFACT_MAX_COUNT):
+        self.store_dir = Path(store_dir) if store_dir else default_store_dir()
+        self.index_path = self.store_dir / ARTIFACT_INDEX_FILE
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.artifacts = {}
+        self.lock = threading.RLock()
+        self.lock_depth = 0
+        self.load()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Holds the index for this thread and, where fcntl is available, for other processes, nested use
+        takes the file lock once
+        """
+        with self.lock:
+            if self.lock_depth or fcntl is None:
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+                return
+
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            with open(str(self.store_dir / ARTIFACT_LOCK_FILE), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self):
+        try:
+            with open(str(self.index_path)) as index_file:
+                self.artifacts = json.load(index_file).get("artifacts", {})
+        except (FileNotFoundError, ValueError):
+            self.artifacts = {}
+
+    def save(self):
+        with self.locked():
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            part_path = self.index_path.with_name(f'{self.index_path.name}.{os.getpid()}.part')
+            with open(str(part_path), 'w') as index_file:
+                json.dump({"artifacts": self.artifacts}, index_file, indent=4, sort_keys=True)
+            os.replace(str(part_path), str(self.index_path))
+
+    def object_path(self, key):
+        return self.store_dir / key[:2] / f'{key}.zip'
+
+    def get(self, key):
+        """
+        Looks up a stored archive and marks it as used
+        :param key: String - artifact_key of the build
+        :return: Object, None - path object to the archive or None when it is not stored
+        """
+        with self.locked():
+            self.load()
+            entry = self.artifacts.get(key)
+            if entry is None:
+                return None
+            path = self.object_path(key)
+            if not path.exists():
+                del self.artifacts[key]
+                self.save()
+                return None
+            entry["used"] = time.time()
+            self.save()
+
+        return path
+
+    def find(self, reference, channel_path=None):
+        """
+        Resolves a build given on the command line
+        :param reference: String - key prefix, or a manifest version for the last used build of that version
+        :param channel_path: Object - only consider builds of this channel
+        :return: Tuple, None - key and entry or None when nothing matched
+        """
+        channel_path = str(Path(channel_path).resolve()) if channel_path else None
+        with self.lock:
+            matches = [(key, entry) for key, entry in self.artifacts.items()
+                       if (key.startswith(reference) or entry["version"] == reference) and
+                       (channel_path is None or entry["channel"] == channel_path)]
+        if not matches:
+            return None
+
+        return max(matches, key=lambda match: match[1]["used"])
+
+    def put(self, key, archive_path, channel, settings=None):
+        """
+        Adds a built archive, hard linked when the store is on the same file system since
+        archives in out are replaced rather than rewritten
+        :param key: String - artifact_key of the build
+        :param archive_path: Object - path object to the built archive
+        :param channel: Object - Channel the archive was built from
+        :param settings: Dictionary - build settings
+        :return: Object - path object to the stored archive
+        """
+        path = self.object_path(key)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            part_path = path.with_name(f'{path.name}.{os.getpid()}.part')
+            try:
+                os.link(str(archive_path), str(part_path))
+            except OSError:
+                shutil.copyfile(str(archive_path), str(part_path))
+            os.replace(str(part_path), str(path))
+
+        now = time.time()
+        with self.locked():
+            # other processes may have stored builds since this index was read
+            self.load()
+            self.artifacts[key] = {
+                "channel": str(Path(channel.channel_path).resolve()),
+                "title": channel.manifest_data.get("title"),
+                "version": channel.version(),
+                "manifest": channel.manifest_data,
+                "fingerprint": channel.build_fingerprint,
+                "settings": settings or {},
+                "size": path.stat().st_size,
+                "created": self.artifacts.get(key, {}).get("created", now),
+                "used": now
+            }
+            self.evict(keep=key)
+            self.save()
+
+        return path
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used archives until the store is within its limits
+        :param keep: String - key never evicted, the build just stored
+        :return: List - evicted keys
+        """
+        evicted = []
+        with self.locked():
+            total = sum(entry["size"] for entry in self.artifacts.values())
+            for key, entry in sorted(self.artifacts.items(), key=lambda item: item[1]["used"]):
+                if total <= self.max_bytes and len(self.artifacts) <= self.max_count:
+                    break
+                if key == keep:
+                    continue
+                del self.artifacts[key]
+                total -= entry["size"]
+                evicted.append(key)
+                try:
+                    os.unlink(str(self.object_path(key)))
+                except FileNotFoundError:
+                    pass
+
+        return evicted
+
+    def entries(self, channel_path=None):
+        """
+        :param channel_path: Object - only list builds of this channel
+        :return: List - tuples of key and entry, most recently used first
+        """
+        channel_path = str(Path(channel_path).resolve()) if channel_path else None
+        with self.lock:
+            entries = [(key, dict(entry)) for key, entry in self.artifacts.items()
+                       if channel_path is None or entry["channel"] == channel_path]
+
+        return sorted(entries, key=lambda item: item[1]["used"], reverse=True)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import click
+import collections
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from archive import ArchiveStream, update_archive
+from build_cache import BuildCache
+from channel import Channel
+from fake_roku import FakeRoku
+from file_matcher import collect_channel_files
+from fleet import deploy_to_fleet
+from pathlib import Path
+from roku import Roku
+from rokuPi import parse_manifest
+
+BENCHMARK_STRUCTURE = ['manifest', 'components/**', 'source/**', 'images/**']
+STARTUP_COMMANDS = {
+    'import_rokuPi': [sys.executable, '-c', 'import rokuPi'],
+    'deploy_help': [sys.executable, 'rokuPi.py', 'deploy', '--help']
+}
+
+
+def generate_channel(channel_path, file_count, image_count=0, image_size=256 * 1024):
+    """
+    Writes a synthetic channel, about a third of the files are components and the rest
+    BrightScript source, images are random bytes so they do not compress
+    :param channel_path: Object - path object to an empty directory
+    :param file_count: Int - number of source and component files
+    :param image_count: Int - number of images
+    :param image_size: Int - bytes per image
+    """
+    (channel_path / 'manifest').write_text('title=Benchmark\nmajor_version=1\nminor_version=0\nbuild_version=1\n'
+                                           'mm_icon_focus_hd=pkg:/images/icon.png\n')
+    for index in range(file_count):
+        folder = 'components' if index % 3 == 0 else 'source'
+        group = channel_path / folder / f'group{index // 500}'
+        group.mkdir(parents=True, exist_ok=True)
+        if folder == 'components':
+            (group / f'Component{index}.xml').write_text(
+                f'<?xml version="1.0" encoding="utf-8" ?>\n<!-- component {index} -->\n'
+                f'<component name="Component{index}" extends="Group">\n'
+                f'  <script type="text/brightscript" uri="Component{index}.brs" />\n</component>\n')
+        else:
+            (group / f'file{index}.brs').write_text(
+                f"' generated source {index}\nfunction value{index}() as Integer\n"
+                f"    ' comment\n    return {index}\nend function\n" * 4)
+    (channel_path / 'images').mkdir(exist_ok=True)
+    for index in range(image_count):
+        (channel_path / 'images' / f'image{index}.png').write_bytes(os.urandom(image_size))
+
+    with open(str(channel_path / 'rokuPiConfig.json'), 'w') as config_file:
+        json.dump({"files": BENCHMARK_STRUCTURE}, config_file)
+
+
+def timed(results, benchmark, scenario, function, **fields):
+    started = time.perf_counter()
+    value = function()
+    results.append({"benchmark": benchmark, "scenario": scenario, "seconds": time.perf_counter() - started, **fields})
+
+    return value
+
+
+def run_channel_benchmarks(results, scenario, channel_path, devices):
+    channel = Channel(channel_path)
+    channel.set_config_file_data()
+    channel.manifest_data = timed(results, 'parse_manifest', scenario,
+                                  lambda: parse_manifest(channel_path / 'manifest'))
+
+    channel_files = timed(results, 'collect_channel_files', scenario,
+                          lambda: collect_channel_files(channel_path, channel.config_data["files"]))
+    total_bytes = sum(os.path.getsize(str(channel_path / path)) for path in channel_files)
+    build_cache = BuildCache(channel_path)
+    file_states = timed(results, 'build_cache_scan_cold', scenario, lambda: build_cache.scan(channel_files),
+                        files=len(channel_files), bytes=total_bytes)
+    build_cache.update(file_states, None)
+    timed(results, 'build_cache_scan_warm', scenario, lambda: build_cache.scan(channel_files), files=len(channel_files))
+
+    archive_path = channel.out_dir / f'{channel.__str__()}.zip'
+    archive_stream = ArchiveStream(channel_path, channel_files, archive_path, stats=channel_files)
+    timed(results, 'archive_full', scenario, lambda: collections.deque(archive_stream, maxlen=0),
+          files=len(channel_files), bytes=total_bytes)
+    archive_size = archive_path.stat().st_size
+
+    changed = list(channel_files)[len(channel_files) // 2]
+    with open(str(channel_path / changed), 'a') as changed_file:
+        changed_file.write('\n')
+    updated_path = channel.out_dir / 'updated.zip'
+    timed(results, 'archive_incremental_one_file', scenario,
+          lambda: update_archive(archive_path, updated_path, channel_path, [changed], []), files=1)
+    os.replace(str(updated_path), str(archive_path))
+
+    if devices:
+        roku = Roku(devices[0].device_data)
+        timed(results, 'upload', scenario, lambda: roku.install_channel(channel), bytes=archive_size)
+        fleet = [device.device_data for device in devices]
+        timed(results, 'fleet_deploy', scenario, lambda: deploy_to_fleet(fleet, channel, max_concurrency=len(fleet)),
+              devices=len(fleet), bytes=archive_size * len(fleet))
+
+
+def run_startup_benchmarks(results, runs):
+    """
+    Times fresh interpreters importing the cli, the fastest run is kept since cold start
+    noise only ever adds time
+    """
+    for benchmark, command in STARTUP_COMMANDS.items():
+        durations = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+                           stdout=subprocess.DEVNULL)
+            durations.append(time.perf_counter() - started)
+        results.append({"benchmark": benchmark, "scenario": 'startup', "seconds": min(durations), "runs": runs})
+
+
+@click.command()
+@click.option('--files',
+              'file_counts',
+              multiple=True,
+              type=int,
+              default=(100, 5000, 50000),
+              show_default=True,
+              help='synthetic channel sizes in files, repeat for several')
+@click.option('--images',
+              'image_count',
+              default=50,
+              show_default=True,
+              help='incompressible images added to each channel')
+@click.option('--devices',
+              'device_count',
+              default=4,
+              show_default=True,
+              help='fake devices used for upload and fleet deploy')
+@click.option('--latency',
+              default=0.0,
+              show_default=True,
+              help='seconds added to every fake device request')
+@click.option('--bandwidth',
+              type=int,
+              help='fake device bandwidth in bytes per second')
+@click.option('--startup-runs',
+              'startup_runs',
+              default=5,
+              show_default=True,
+              help='fresh interpreters started for the cli startup benchmark, 0 skips it')
+@click.option('-o',
+              '--output',
+              'output',
+              type=click.Path(dir_okay=False),
+              help='write results as json')
+def benchmark(file_counts, image_count, device_count, latency, bandwidth, startup_runs, output):
+    """
+    Times packaging and deploy against synthetic channels and fake devices
+    """
+    devices = [FakeRoku(f'Fake Roku {index}', latency=latency, bandwidth=bandwidth).start()
+               for index in range(device_count)]
+    results = []
+    if startup_runs:
+        run_startup_benchmarks(results, startup_runs)
+    try:
+        for file_count in file_counts:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                channel_path = Path(temp_dir)
+                scenario = f'{file_count} files, {image_count} images'
+                generate_channel(channel_path, file_count, image_count)
+                run_channel_benchmarks(results, scenario, channel_path, devices)
+    finally:
+        for device in devices:
+            device.stop()
+
+    for result in results:
+        click.echo(f'{result["scenario"]:<28} {result["benchmark"]:<30} {result["seconds"] * 1000:>10.1f}ms')
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump({
+                "timestamp": time.time(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results
+            }, output_file, indent=4)
+
+
+if __name__ == '__main__':
+    benchmark()
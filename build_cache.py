@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+
+from pathlib import Path
+from constants import BUILD_CACHE_FILE
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(file_path):
+    """
+    Hashes file contents in chunks so large assets are not read into memory at once
+    :param file_path: String - path to file
+    :return: String - hex digest
+    """
+    digest = hashlib.sha1()
+    with open(str(file_path), 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def build_fingerprint(file_states, manifest_data, optimizer_settings=None):
+    """
+    Identifies a build by the content of its files and its manifest
+    :param file_states: Dictionary - result of BuildCache.scan
+    :param manifest_data: Dictionary - parsed manifest
+    :param optimizer_settings: Dictionary - settings of the optimizer when the files were optimized
+    :return: String - hex digest
+    """
+    digest = hashlib.sha1()
+    for relative_path in sorted(file_states.keys()):
+        digest.update(f'{relative_path}\0{file_states[relative_path]["sha1"]}\n'.encode('utf-8'))
+    for key in sorted(manifest_data.keys()):
+        digest.update(f'{key}={manifest_data[key]}\n'.encode('utf-8'))
+    if optimizer_settings:
+        digest.update(json.dumps(optimizer_settings, sort_keys=True).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+class BuildCache:
+    def __init__(self, channel_path):
+        self.channel_path = Path(channel_path)
+        self.cache_file = self.channel_path / BUILD_CACHE_FILE
+        self.archive = None
+        self.settings = {}
+        self.files = {}
+        self.load()
+
+    def load(self):
+        """
+        Loads the previous build state, a missing or unreadable cache is treated as empty
+        """
+        try:
+            with open(str(self.cache_file)) as cache_file:
+                cache_data = json.load(cache_file)
+            self.archive = cache_data.get("archive")
+            self.settings = cache_data.get("settings", {})
+            self.files = cache_data.get("files", {})
+        except (FileNotFoundError, ValueError):
+            self.archive = None
+            self.settings = {}
+            self.files = {}
+
+    def save(self):
+        with open(str(self.cache_file), 'w') as cache_file:
+            json.dump({"archive": self.archive, "settings": self.settings, "files": self.files}, cache_file,
+                      indent=4, sort_keys=True)
+
+    def clear(self):
+        self.archive = None
+        self.settings = {}
+        self.files = {}
+
+    def scan(self, relative_paths):
+        """
+        Records size, mtime and content hash of every channel file, files whose size and mtime
+        match the cache keep their cached hash instead of being read again
+        :param relative_paths: List, Dictionary - channel files relative to channel root, or the result
+            of collect_channel_files whose stat results are reused
+        :return: Dictionary - relative path to file state
+        """
+        stats = relative_paths if isinstance(relative_paths, dict) else {}
+        file_states = {}
+        for relative_path in relative_paths:
+            stat = stats.get(relative_path) or os.stat(str(self.channel_path / relative_path))
+            cached = self.files.get(relative_path)
+            if cached and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime_ns:
+                file_states[relative_path] = cached
+            else:
+                file_states[relative_path] = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "sha1": hash_file(self.channel_path / relative_path)
+                }
+
+        return file_states
+
+    def diff(self, file_states):
+        """
+        Compares scanned file states against the last build
+        :param file_states: Dictionary - result of scan
+        :return: Dictionary - sorted lists of changed and removed relative paths
+        """
+        changed = [path for path, state in file_states.items()
+                   if path not in self.files or self.files[path]["sha1"] != state["sha1"]]
+        removed = [path for path in self.files.keys() if path not in file_states]
+
+        return {
+            "changed": sorted(changed),
+            "removed": sorted(removed)
+        }
+
+    def update(self, file_states, archive_name, settings=None):
+        self.files = file_states
+        self.archive = archive_name
+        self.settings = dict(settings or {})
@@ -13,6 +13,8 @@ class Channel:
         self.config_file = self.get_config_file()
         self.out_dir = self.get_out_dir()
         self.manifest_data = None
+        self.build_fingerprint = None
+        self.archive_path = None
 
     def get_config_file(self):
         """
@@ -37,10 +39,25 @@ class Channel:
         return Path(out_path)
 
     def get_channel_archive(self):
+        """
+        The archive to upload, a build taken from the artifact store or the archive in out
+        :return: Object, None - path object to the archive
+        """
+        if self.archive_path is not None:
+            return self.archive_path
         out_dir = self.get_out_dir()
-        for child in out_dir.iterdir():
-            if Path(child).is_file:
-                return Path(child)
+        # a build in progress writes a .part file next to the archive
+        for child in sorted(out_dir.iterdir()):
+            if child.suffix == '.zip' and child.is_file():
+                return child
+
+        return None
+
+    def version(self):
+        if {'major_version', 'minor_version', 'build_version'} <= set(self.manifest_data.keys()):
+            return f'{self.manifest_data["major_version"]}.' \
+                   f'{self.manifest_data["minor_version"]}.' \
+                   f'{self.manifest_data["build_version"]}'
 
         return None
 
@@ -0,0 +1,226 @@
+import collections
+import heapq
+import os
+import re
+import time
+
+from roku import DEBUG_CONSOLE_PORT
+
+BUFFER_LINES = 10000
+READ_SIZE = 64 * 1024
+MAX_LINE_BYTES = 16 * 1024
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+ROTATE_BYTES = 10 * 1024 * 1024
+ROTATE_BACKUPS = 5
+
+
+class LineFilter:
+    """
+    Compiles the --grep and --exclude regexes into one alternation each, so a line costs at
+    most two searches however many patterns were given. Excludes win over includes
+    """
+    def __init__(self, includes=(), excludes=(), ignore_case=False):
+        flags = re.IGNORECASE if ignore_case else 0
+        self.include = re.compile('|'.join(f'(?:{pattern})' for pattern in includes), flags) if includes else None
+        self.exclude = re.compile('|'.join(f'(?:{pattern})' for pattern in excludes), flags) if excludes else None
+
+    def matches(self, line):
+        if self.exclude is not None and self.exclude.search(line):
+            return False
+
+        return self.include is None or self.include.search(line) is not None
+
+
+class DeviceLog:
+    """
+    Ring buffer of the filtered console lines of one device waiting to be written, when the
+    output falls behind a noisy device the oldest lines are dropped and counted instead of
+    growing memory or holding up the other devices
+    """
+    def __init__(self, device_data, buffer_lines=BUFFER_LINES):
+        self.host = device_data["ip_address"]
+        self.port = int(device_data.get("console_port", DEBUG_CONSOLE_PORT))
+        self.name = (device_data.get("name") or '').strip() or self.host
+        self.lines = collections.deque(maxlen=buffer_lines)
+        self.received = 0
+        self.filtered = 0
+        self.dropped = 0
+
+    def append(self, timestamp, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append((timestamp, self.name, line))
+
+    def take(self):
+        lines = list(self.lines)
+        self.lines.clear()
+
+        return lines
+
+
+class RotatingWriter:
+    """
+    Appends to a log file, once it would grow past max_bytes it moves to .1, .1 to .2 and so
+    on, keeping at most backups old files
+    """
+    def __init__(self, path, max_bytes=ROTATE_BYTES, backups=ROTATE_BACKUPS):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(self.path, 'ab')
+        self.size = self.file.tell()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{index}'):
+                os.replace(f'{self.path}.{index}', f'{self.path}.{index + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def format_line(timestamp, name, line, width=0):
+    clock = time.strftime('%H:%M:%S', time.localtime(timestamp))
+    return f'{clock}.{int(timestamp % 1 * 1000):03d} [{name:<{width}}] {line}'
+
+
+def split_lines(pending, data):
+    """
+    :param pending: Bytes - unterminated line left from the previous read
+    :param data: Bytes - newly read bytes
+    :return: Tuple - complete lines and the new unterminated rest, a line longer than
+             MAX_LINE_BYTES is cut so a console without newlines cannot grow memory
+    """
+    lines = (pending + data).split(b'\n')
+    pending = lines.pop()
+    if len(pending) > MAX_LINE_BYTES:
+        lines.append(pending[:MAX_LINE_BYTES])
+        pending = b''
+
+    return [line.rstrip(b'\r').decode('utf-8', 'replace') for line in lines], pending
+
+
+async def follow_device(log, line_filter, wake):
+    """
+    Reads one device console until cancelled, reconnecting with backoff when the device
+    closes it or cannot be reached, for example while it reboots
+    :param log: Object - DeviceLog receiving the lines
+    :param line_filter: Object - LineFilter applied as lines arrive
+    :param wake: Object - asyncio.Event set whenever lines were added
+    """
+    import asyncio
+
+    delay = RECONNECT_DELAY
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(log.host, log.port)
+        except OSError as e:
+            log.append(time.time(), f'[console unavailable: {e.strerror or e}, retrying in {delay:g}s]')
+            wake.set()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            continue
+
+        delay = RECONNECT_DELAY
+        pending = b''
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                received = time.time()
+                lines, pending = split_lines(pending, data)
+                for line in lines:
+                    log.received += 1
+                    if line_filter.matches(line):
+                        log.append(received, line)
+                    else:
+                        log.filtered += 1
+                if lines:
+                    wake.set()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+        log.append(time.time(), '[console closed, reconnecting]')
+        wake.set()
+        await asyncio.sleep(delay)
+
+
+async def follow_logs(logs, line_filter, write_lines, duration=None):
+    """
+    Multiplexes the device consoles, lines of all devices are merged in arrival order and
+    handed to write_lines on a worker thread so a slow terminal or disk never stalls reading
+    :param logs: List - DeviceLog per device
+    :param line_filter: Object - LineFilter
+    :param write_lines: Function - takes a list of formatted lines
+    :param duration: Float - seconds to follow for, None until interrupted
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    width = max(len(log.name) for log in logs)
+    wake = asyncio.Event()
+    readers = [asyncio.ensure_future(follow_device(log, line_filter, wake)) for log in logs]
+
+    def drain():
+        batch = heapq.merge(*(log.take() for log in logs))
+        return [format_line(timestamp, name, line, width) for timestamp, name, line in batch]
+
+    deadline = None if duration is None else loop.time() + duration
+    try:
+        while deadline is None or loop.time() < deadline:
+            try:
+                await asyncio.wait_for(wake.wait(), None if deadline is None else deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            wake.clear()
+            lines = drain()
+            if lines:
+                await loop.run_in_executor(None, write_lines, lines)
+    finally:
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        lines = drain()
+        if lines:
+            write_lines(lines)
+
+
+def stream_logs(devices, write_lines, line_filter=None, buffer_lines=BUFFER_LINES, duration=None):
+    """
+    Follows the BrightScript debug console of every device at once until the duration
+    passed or Ctrl+C
+    :param devices: List - device dictionaries
+    :param write_lines: Function - takes a list of formatted, timestamped lines
+    :param line_filter: Object - LineFilter, None keeps every line
+    :param buffer_lines: Int - lines held per device while the output catches up
+    :param duration: Float - seconds to follow for, None until interrupted
+    :return: List - DeviceLog per device with received, filtered and dropped counts
+    """
+    # asyncio is only needed while following logs, importing it up front slows every cli start
+    import asyncio
+
+    logs = [DeviceLog(device, buffer_lines) for device in devices]
+    try:
+        asyncio.run(follow_logs(logs, line_filter or LineFilter(), write_lines, duration))
+    except KeyboardInterrupt:
+        pass
+
+    return logs
@@ -5,4 +5,25 @@ STANDARD_CHANNEL_STRUCTURE = [
     'images/**'
 ]
 CONFIG_FILE = 'rokuPiConfig.json'
-STAGE_DIR = 'rokuPiTemp'
\ No newline at end of file
+BUILD_CACHE_FILE = 'rokuPiBuildCache.json'
+USER_DATA_DIR = '.rokuPi'
+DEVICE_REGISTRY_FILE = 'devices.json'
+USERNAME_ENV = 'ROKUPI_USERNAME'
+PASSWORD_ENV = 'ROKUPI_PASSWORD'
+SERVE_TOKEN_ENV = 'ROKUPI_SERVE_TOKEN'
+DEFAULT_EXCLUDE_PATTERNS = [
+    'out',
+    CONFIG_FILE,
+    BUILD_CACHE_FILE,
+    '**/.git',
+    '**/.svn',
+    '**/.hg',
+    '**/.idea',
+    '**/.vscode',
+    '**/.DS_Store',
+    '**/Thumbs.db',
+    '**/*.swp',
+    '**/*.swo',
+    '**/*~',
+    '**/.#*'
+]
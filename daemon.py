@@ -0,0 +1,417 @@
+import collections
+import hmac
+import http.server
+import itertools
+import json
+import os
+import queue
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import urllib3
+import xml.etree.ElementTree as eTree
+
+from build_cache import BuildCache
+from constants import USER_DATA_DIR
+from fleet import deploy_to_device
+from pathlib import Path
+from remote import summarize
+from roku import Roku
+
+DEVICE_TIMEOUT = 120.0
+DEPLOY_RETRIES = 2
+RETRY_BACKOFF = 2.0
+WAIT_TIMEOUT = 600.0
+LATENCY_WINDOW = 1000
+FINISHED_JOBS = 1000
+QUERIES = ('device-info', 'apps', 'active-app', 'media-player')
+
+
+def default_socket_path():
+    return Path.home() / USER_DATA_DIR / 'serve.sock'
+
+
+def device_key(device_data):
+    """
+    Identifies a device queue, the ECP port is part of it when given so devices behind one
+    address, such as fake devices, get a queue each
+    """
+    if "ecp_port" in device_data:
+        return f'{device_data["ip_address"]}:{device_data["ecp_port"]}'
+
+    return device_data["ip_address"]
+
+
+class Job:
+    def __init__(self, job_id, kind, device_data, run):
+        self.id = job_id
+        self.kind = kind
+        self.device_data = device_data
+        self.run = run
+        self.state = 'queued'
+        self.result = None
+        self.error = None
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "device": device_key(self.device_data),
+            "state": self.state,
+            "result": self.result,
+            "error": self.error,
+            "wait": (self.started or time.perf_counter()) - self.submitted,
+            "run": (self.finished or time.perf_counter()) - self.started if self.started else None
+        }
+
+
+class DeviceWorker:
+    """
+    Runs the jobs of one device one at a time in submission order on its own thread, so
+    uploads to a device never overlap while other devices work in parallel
+    """
+    def __init__(self, device_data):
+        self.roku = Roku(device_data, DEVICE_TIMEOUT)
+        self.jobs = queue.Queue()
+        self.running = None
+        self.completed = 0
+        self.failed = 0
+        self.waits = collections.deque(maxlen=LATENCY_WINDOW)
+        self.runs = collections.deque(maxlen=LATENCY_WINDOW)
+        threading.Thread(target=self.work, name=f'device-{device_data["ip_address"]}', daemon=True).start()
+
+    def work(self):
+        for job in iter(self.jobs.get, None):
+            if job.device_data != self.roku.device_data:
+                # other credentials for the same device, the warm client is replaced in turn
+                self.roku = Roku(job.device_data, DEVICE_TIMEOUT)
+            self.running = job
+            job.state = 'running'
+            job.started = time.perf_counter()
+            try:
+                job.result = job.run(self.roku)
+                job.state = 'done'
+                self.completed += 1
+            except Exception as e:
+                job.error = f'{type(e).__name__}: {e}'
+                job.state = 'failed'
+                self.failed += 1
+            job.finished = time.perf_counter()
+            self.waits.append(job.started - job.submitted)
+            self.runs.append(job.finished - job.started)
+            self.running = None
+            job.done.set()
+
+    def stats(self):
+        return {
+            "queued": self.jobs.qsize(),
+            "running": self.running.kind if self.running else None,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_ms": summarize(wait * 1000 for wait in list(self.waits)),
+            "run_ms": summarize(run * 1000 for run in list(self.runs))
+        }
+
+
+class DeployDaemon:
+    """
+    Long lived state shared by every job, the device registry, one Roku client per device
+    with its connection pool and digest nonce, and the build cache of every channel built
+    """
+    def __init__(self, registry, build_channel, username='rokudev', password=''):
+        """
+        :param registry: Object - DeviceRegistry
+        :param build_channel: Function - takes a channel path, a BuildCache and force_rebuild, builds the
+                              archive into out and returns the Channel with its build fingerprint set
+        :param username: String - device username when a job does not give one
+        :param password: String - device password when a job does not give one
+        """
+        self.registry = registry
+        self.build_channel = build_channel
+        self.username = username
+        self.password = password
+        self.workers = {}
+        self.builds = {}
+        self.jobs = collections.OrderedDict()
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.pin_dir = Path(tempfile.mkdtemp(prefix='rokuPi-serve-'))
+        self.pin_ids = itertools.count(1)
+
+    def resolve_device(self, spec):
+        """
+        :param spec: String, Dictionary - ip address, serial number of a known device or device data
+        :return: Dictionary - device data with credentials
+        """
+        device = dict(spec) if isinstance(spec, dict) else {"ip_address": spec}
+        entry = self.registry.find(device["ip_address"])
+        if entry is not None:
+            device["ip_address"] = entry["ip_address"]
+        device.setdefault("name", device["ip_address"])
+        device.setdefault("username", self.username)
+        device.setdefault("password", self.password)
+
+        return device
+
+    def submit(self, kind, spec, run):
+        """
+        Queues a job on the worker of its device
+        :param kind: String - deploy, keypress or query
+        :param spec: String, Dictionary - device as accepted by resolve_device
+        :param run: Function - takes the Roku client of the device, returns the job result
+        :return: Object - Job
+        """
+        device = self.resolve_device(spec)
+        with self.lock:
+            job = Job(next(self.job_ids), kind, device, run)
+            self.jobs[job.id] = job
+            finished = [job_id for job_id, old_job in self.jobs.items() if old_job.done.is_set()]
+            for job_id in finished[:max(0, len(finished) - FINISHED_JOBS)]:
+                del self.jobs[job_id]
+            worker = self.workers.get(device_key(device))
+            if worker is None:
+                worker = self.workers[device_key(device)] = DeviceWorker(device)
+        worker.jobs.put(job)
+
+        return job
+
+    def build(self, channel_path, force_rebuild=False):
+        """
+        Builds a channel once for every device of a deploy job, builds of the same channel
+        wait for each other and reuse its in memory build cache. The archive is pinned before
+        the lock is released, so queued jobs upload this build even once a later deploy rebuilt out
+        :return: Object - Channel whose archive_path is the pinned archive
+        """
+        channel_path = str(Path(channel_path).resolve())
+        with self.lock:
+            build = self.builds.setdefault(channel_path, {
+                "lock": threading.Lock(), "cache": None, "cache_mtime": None, "count": 0, "seconds": None
+            })
+        with build["lock"]:
+            if build["cache"] is None:
+                build["cache"] = BuildCache(channel_path)
+            try:
+                cache_mtime = build["cache"].cache_file.stat().st_mtime_ns
+            except FileNotFoundError:
+                cache_mtime = None
+            if cache_mtime != build["cache_mtime"]:
+                # a deploy outside the daemon rewrote the cache
+                build["cache"].load()
+            started = time.perf_counter()
+            channel = self.build_channel(channel_path, build["cache"], force_rebuild)
+            build["seconds"] = time.perf_counter() - started
+            build["count"] += 1
+            archive_path = channel.get_channel_archive()
+            pinned_path = self.pin_dir / f'{next(self.pin_ids)}-{archive_path.name}'
+            try:
+                # archives in out are replaced rather than rewritten, a hard link keeps this build
+                os.link(str(archive_path), str(pinned_path))
+            except OSError:
+                shutil.copyfile(str(archive_path), str(pinned_path))
+            channel.archive_path = pinned_path
+            try:
+                build["cache_mtime"] = build["cache"].cache_file.stat().st_mtime_ns
+            except FileNotFoundError:
+                build["cache_mtime"] = None
+
+        return channel
+
+    def deploy(self, channel_path, devices, force_rebuild=False, force_deploy=False):
+        channel = self.build(channel_path, force_rebuild)
+        remaining = [len(devices)]
+
+        def release():
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0] <= 0 and channel.archive_path.exists():
+                    channel.archive_path.unlink()
+
+        def run(roku):
+            try:
+                rokus = {roku.device_data["ip_address"]: roku}
+                result = deploy_to_device(roku.device_data, channel, DEVICE_TIMEOUT, DEPLOY_RETRIES, RETRY_BACKOFF,
+                                          self.registry, rokus, force_deploy)
+                self.registry.save()
+                return result
+            finally:
+                release()
+
+        if not devices:
+            release()
+        jobs = []
+        try:
+            for device in devices:
+                jobs.append(self.submit('deploy', device, run))
+        finally:
+            # devices that could not be queued never release the pinned archive themselves
+            for _ in range(len(devices) - len(jobs)):
+                release()
+
+        return jobs
+
+    def keypress(self, device, keys):
+        def run(roku):
+            for key in keys:
+                roku.send_key_press(key)
+            return {"keys": len(keys)}
+
+        return [self.submit('keypress', device, run)]
+
+    def query(self, device, name):
+        if name not in QUERIES:
+            raise ValueError(f'unknown query {name}, use one of {", ".join(QUERIES)}')
+
+        def run(roku):
+            if name == 'device-info':
+                return roku.query_device_info()
+            elif name == 'apps':
+                return roku.query_dev_app()
+            elif name == 'active-app':
+                return roku.query_active_app()
+
+            return roku.query_media_player()
+
+        return [self.submit('query', device, run)]
+
+    def stats(self):
+        with self.lock:
+            workers = dict(self.workers)
+            builds = {path: {"count": build["count"], "last_seconds": build["seconds"]}
+                      for path, build in self.builds.items()}
+        return {
+            "uptime": time.time() - self.started,
+            "devices": {key: worker.stats() for key, worker in workers.items()},
+            "builds": builds
+        }
+
+    def close(self):
+        with self.lock:
+            for worker in self.workers.values():
+                worker.jobs.put(None)
+        shutil.rmtree(str(self.pin_dir), ignore_errors=True)
+
+
+class DaemonHandler(http.server.BaseHTTPRequestHandler):
+    """
+    JSON api of the daemon, jobs block until done unless the body sets "wait": false
+        POST /deploy    {"channel": path, "devices": [ip, ...], "force_rebuild": false, "force_deploy": false}
+        POST /keypress  {"device": ip, "keys": ["Home", "Select"]}
+        POST /query     {"device": ip, "query": "device-info"}
+        GET  /jobs/<id>
+        GET  /stats
+    With a token every request needs an Authorization: Bearer <token> header
+    """
+    protocol_version = 'HTTP/1.1'
+    deploy_daemon = None
+    token = None
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, data):
+        body = json.dumps(data, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        if self.token is None:
+            return True
+        if hmac.compare_digest(self.headers.get('Authorization', '').encode('utf-8'),
+                               f'Bearer {self.token}'.encode('utf-8')):
+            return True
+
+        # the body of a refused request is never read, so the connection cannot be reused
+        self.close_connection = True
+        self.respond(401, {"error": 'missing or wrong Authorization token'})
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path == '/stats':
+            return self.respond(200, self.deploy_daemon.stats())
+        if self.path.startswith('/jobs/'):
+            job = self.deploy_daemon.jobs.get(int(self.path[len('/jobs/'):])) if self.path[6:].isdigit() else None
+            if job is not None:
+                return self.respond(200, job.as_dict())
+        self.respond(404, {"error": f'{self.path} not found'})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path == '/deploy':
+                jobs = self.deploy_daemon.deploy(request["channel"], request["devices"],
+                                                 request.get("force_rebuild", False),
+                                                 request.get("force_deploy", False))
+            elif self.path == '/keypress':
+                jobs = self.deploy_daemon.keypress(request["device"], request["keys"])
+            elif self.path == '/query':
+                jobs = self.deploy_daemon.query(request["device"], request["query"])
+            else:
+                return self.respond(404, {"error": f'{self.path} not found'})
+        except (KeyError, TypeError, ValueError) as e:
+            return self.respond(400, {"error": f'{type(e).__name__}: {e}'})
+        except (OSError, urllib3.exceptions.HTTPError, eTree.ParseError) as e:
+            return self.respond(500, {"error": f'{type(e).__name__}: {e}'})
+
+        if not request.get("wait", True):
+            return self.respond(202, {"jobs": [job.as_dict() for job in jobs]})
+
+        deadline = time.monotonic() + float(request.get("timeout", WAIT_TIMEOUT))
+        for job in jobs:
+            job.done.wait(max(0.0, deadline - time.monotonic()))
+        results = [job.as_dict() for job in jobs]
+        ok = all(job["state"] == 'done' and (job["kind"] != 'deploy' or job["result"]["ok"]) for job in results)
+        self.respond(200 if ok else 502, {"jobs": results})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # http.server expects a (host, port) client address
+        return request, ('local', 0)
+
+
+def start_servers(daemon, socket_path=None, host='127.0.0.1', port=None, token=None):
+    """
+    Serves the daemon on a Unix socket, on a local HTTP port or both. The socket is only
+    reachable by its owner, the HTTP port checks the token when one is given
+    :param daemon: Object - DeployDaemon
+    :param socket_path: String - path of the Unix socket
+    :param host: String - address the HTTP port binds to
+    :param port: Int - HTTP port, 0 picks a free one
+    :param token: String - bearer token HTTP requests need, None accepts every request
+    :return: List - running servers
+    """
+    handler = type('DaemonHandler', (DaemonHandler,), {"deploy_daemon": daemon})
+    servers = []
+    if socket_path is not None:
+        socket_path = Path(socket_path)
+        socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if socket_path.exists():
+            socket_path.unlink()
+        servers.append(UnixHTTPServer(str(socket_path), handler))
+        os.chmod(str(socket_path), 0o600)
+    if port is not None:
+        server = http.server.ThreadingHTTPServer(
+            (host, port), type('DaemonHandler', (DaemonHandler,), {"deploy_daemon": daemon, "token": token}))
+        server.daemon_threads = True
+        servers.append(server)
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return servers
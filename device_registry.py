@@ -0,0 +1,228 @@
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import urllib3
+import xml.etree.ElementTree as eTree
+
+from constants import USER_DATA_DIR, DEVICE_REGISTRY_FILE
+from discovery import discover_devices
+from pathlib import Path
+from profiling import trace
+from roku import device_choice, query_device_info
+
+REGISTRY_TTL = 60 * 60
+REVALIDATE_TIMEOUT = urllib3.Timeout(connect=1.0, read=3.0)
+
+
+def default_registry_path():
+    return Path.home() / USER_DATA_DIR / DEVICE_REGISTRY_FILE
+
+
+class DeviceRegistry:
+    """
+    Per user record of known devices keyed by serial number, so a device keeps its entry
+    when its ip address changes
+    """
+    def __init__(self, registry_path=None, ttl=REGISTRY_TTL):
+        self.registry_path = Path(registry_path) if registry_path else default_registry_path()
+        self.ttl = ttl
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.revalidation = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(str(self.registry_path)) as registry_file:
+                self.devices = json.load(registry_file).get("devices", {})
+        except (FileNotFoundError, ValueError):
+            self.devices = {}
+
+    def save(self):
+        with self.lock:
+            self.registry_path.parent.mkdir(parents=True, exist_ok=True)
+            part_path = self.registry_path.with_name(f'{self.registry_path.name}.part')
+            with open(str(part_path), 'w') as registry_file:
+                json.dump({"devices": self.devices}, registry_file, indent=4, sort_keys=True)
+            os.replace(str(part_path), str(self.registry_path))
+
+    def record(self, device_info, ip_address):
+        """
+        Adds or updates a device from its device-info fields
+        :param device_info: Dictionary - result of query_device_info
+        :param ip_address: String - address the device answered on
+        :return: Dictionary, None - registry entry or None when the device reports no serial number
+        """
+        serial_number = device_info.get('serial-number')
+        if not serial_number:
+            return None
+
+        now = time.time()
+        with self.lock:
+            entry = self.devices.get(serial_number, {"first_seen": now})
+            entry.update({
+                "serial_number": serial_number,
+                "ip_address": ip_address,
+                "info": device_info,
+                "updated": now
+            })
+            self.devices[serial_number] = entry
+
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry["updated"] < self.ttl
+
+    def known_devices(self, fresh_only=True):
+        with self.lock:
+            entries = list(self.devices.values())
+
+        return sorted([entry for entry in entries if not fresh_only or self.is_fresh(entry)],
+                      key=lambda entry: entry["info"].get('friendly-model-name') or '')
+
+    def find(self, serial_number):
+        with self.lock:
+            return self.devices.get(serial_number)
+
+    def choices(self, fresh_only=True):
+        """
+        Formats known devices as PyInquirer choices carrying their serial number
+        :return: List
+        """
+        choices = []
+        for entry in self.known_devices(fresh_only):
+            choice = device_choice(entry["info"], entry["ip_address"])
+            choice["value"]["serial_number"] = entry["serial_number"]
+            choices.append(choice)
+
+        return choices
+
+    def discover(self, subnet=None):
+        """
+        Runs network discovery and records every device that answers
+        :param subnet: String - CIDR to sweep when no device answers the SSDP search
+        :return: List - registry entries of discovered devices
+        """
+        def query(ip_address):
+            device_info = query_device_info(ip_address, REVALIDATE_TIMEOUT)
+            return self.record(device_info, ip_address) if device_info else None
+
+        with trace('discover') as span:
+            devices = list(discover_devices(query, subnet=subnet))
+            span["devices"] = len(devices)
+
+        return devices
+
+    def revalidate(self, subnet=None, max_workers=16):
+        """
+        Queries every known device at its last address, devices that moved or did not answer
+        are looked for with network discovery so ip changes are picked up
+        :param subnet: String - CIDR to sweep when no device answers the SSDP search
+        :param max_workers: Int - device info queries in flight at once
+        :return: List - serial numbers of devices that could not be found
+        """
+        def check(entry):
+            device_info = query_device_info(entry["ip_address"], REVALIDATE_TIMEOUT)
+            if device_info and device_info.get('serial-number') == entry["serial_number"]:
+                self.record(device_info, entry["ip_address"])
+                return None
+
+            return entry["serial_number"]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            missing = [serial for serial in executor.map(check, self.known_devices(False)) if serial]
+
+        if missing:
+            found = {entry["serial_number"] for entry in self.discover(subnet)}
+            missing = [serial for serial in missing if serial not in found]
+        self.save()
+
+        return missing
+
+    def revalidate_in_background(self, subnet=None):
+        self.revalidation = threading.Thread(target=self.revalidate, args=(subnet,), daemon=True)
+        self.revalidation.start()
+
+        return self.revalidation
+
+    def wait_for_revalidation(self, timeout=None):
+        if self.revalidation is not None:
+            self.revalidation.join(timeout)
+
+    def record_install(self, serial_number, channel):
+        """
+        Remembers which build was last installed on a device
+        :param serial_number: String - device serial number
+        :param channel: Object - Channel that was installed, with its build fingerprint set
+        """
+        with self.lock:
+            entry = self.devices.get(serial_number)
+            if entry is not None:
+                entry["installed"] = {
+                    "title": channel.manifest_data.get("title"),
+                    "version": channel.version(),
+                    "fingerprint": channel.build_fingerprint,
+                    "time": time.time()
+                }
+
+    def is_installed(self, serial_number, channel, dev_app):
+        """
+        Checks whether the dev channel on a device is the build about to be uploaded, the device
+        has to report the same title and version and the last build installed from here has to
+        have the same fingerprint
+        :param serial_number: String - device serial number
+        :param channel: Object - Channel about to be deployed, with its build fingerprint set
+        :param dev_app: Dictionary, None - result of Roku.query_dev_app
+        :return: Bool
+        """
+        if dev_app is None or channel.build_fingerprint is None:
+            return False
+
+        entry = self.find(serial_number)
+        installed = entry.get("installed") if entry else None
+
+        return installed is not None and \
+            installed["fingerprint"] == channel.build_fingerprint and \
+            dev_app["version"] == channel.version() and \
+            dev_app["title"] == channel.manifest_data.get("title")
+
+    def prune(self, older_than=None, serial_numbers=()):
+        """
+        Removes devices not seen for a while or given explicitly
+        :param older_than: Float - seconds since a device last answered
+        :param serial_numbers: Iterable - serial numbers to remove
+        :return: List - removed serial numbers
+        """
+        now = time.time()
+        with self.lock:
+            removed = [serial for serial, entry in self.devices.items()
+                       if serial in serial_numbers or (older_than is not None and now - entry["updated"] > older_than)]
+            for serial in removed:
+                del self.devices[serial]
+        self.save()
+
+        return removed
+
+
+def check_installed_build(roku, registry, channel):
+    """
+    Pre-flight for a deploy, looks up the device and its dev channel over ECP
+    :param roku: Object - Roku about to be deployed to
+    :param registry: Object - DeviceRegistry holding installed builds
+    :param channel: Object - Channel about to be deployed
+    :return: Tuple - whether the build is already installed and the device serial number
+    """
+    device_info = roku.query_device_info()
+    if not device_info or not device_info.get('serial-number'):
+        return False, None
+
+    registry.record(device_info, roku.device_data["ip_address"])
+    serial_number = device_info['serial-number']
+    try:
+        dev_app = roku.query_dev_app()
+    except (urllib3.exceptions.HTTPError, ValueError, eTree.ParseError):
+        dev_app = None
+
+    return registry.is_installed(serial_number, channel, dev_app), serial_number
@@ -0,0 +1,86 @@
+import hashlib
+import os
+import re
+
+CHALLENGE_PARAM = re.compile(r'(\w+)=(?:"([^"]*)"|([^,\s]+))')
+
+
+def md5_hex(value):
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+
+class DigestAuth:
+    """
+    HTTP digest credentials that keep the server nonce between requests, every request
+    after the first challenge is authenticated up front without another 401 round trip
+    """
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.challenge = None
+        self.nonce_count = 0
+
+    @property
+    def has_challenge(self):
+        return self.challenge is not None
+
+    def parse_challenge(self, header):
+        """
+        Stores the nonce and options of a WWW-Authenticate digest challenge
+        :param header: String - WWW-Authenticate header value
+        :return: Bool - whether the header was a digest challenge
+        """
+        if header is None or not header.lower().startswith('digest '):
+            return False
+
+        challenge = {}
+        for key, quoted, bare in CHALLENGE_PARAM.findall(header[7:]):
+            challenge[key.lower()] = quoted if quoted else bare
+        if 'nonce' not in challenge:
+            return False
+
+        if self.challenge is None or self.challenge.get('nonce') != challenge['nonce']:
+            self.nonce_count = 0
+        self.challenge = challenge
+
+        return True
+
+    def authorization(self, method, uri):
+        """
+        Builds the Authorization header for a request against the cached challenge
+        :param method: String - HTTP method
+        :param uri: String - request path
+        :return: String
+        """
+        realm = self.challenge.get('realm', '')
+        nonce = self.challenge['nonce']
+        qop = self.challenge.get('qop')
+        ha1 = md5_hex(f'{self.username}:{realm}:{self.password}')
+        ha2 = md5_hex(f'{method}:{uri}')
+
+        params = {
+            'username': self.username,
+            'realm': realm,
+            'nonce': nonce,
+            'uri': uri,
+        }
+        if qop:
+            self.nonce_count += 1
+            nc = f'{self.nonce_count:08x}'
+            cnonce = os.urandom(8).hex()
+            params.update({
+                'qop': 'auth',
+                'nc': nc,
+                'cnonce': cnonce,
+                'response': md5_hex(f'{ha1}:{nonce}:{nc}:{cnonce}:auth:{ha2}')
+            })
+        else:
+            params['response'] = md5_hex(f'{ha1}:{nonce}:{ha2}')
+        if 'opaque' in self.challenge:
+            params['opaque'] = self.challenge['opaque']
+        if 'algorithm' in self.challenge:
+            params['algorithm'] = self.challenge['algorithm']
+
+        unquoted = {'qop', 'nc', 'algorithm'}
+        return 'Digest ' + ', '.join(
+            f'{key}={value}' if key in unquoted else f'{key}="{value}"' for key, value in params.items())
@@ -0,0 +1,195 @@
+import concurrent.futures
+import ipaddress
+import queue
+import socket
+import threading
+import time
+
+from urllib.parse import urlparse
+
+SSDP_ADDRESS = ('239.255.255.250', 1900)
+ROKU_SEARCH_TARGET = 'roku:ecp'
+ECP_PORT = 8060
+SSDP_WINDOW = 3.0
+SWEEP_TIMEOUT = 0.3
+SWEEP_CONCURRENCY = 256
+
+
+def build_search_request(search_target=ROKU_SEARCH_TARGET, max_wait=2):
+    return '\r\n'.join([
+        'M-SEARCH * HTTP/1.1',
+        f'HOST: {SSDP_ADDRESS[0]}:{SSDP_ADDRESS[1]}',
+        'MAN: "ssdp:discover"',
+        f'ST: {search_target}',
+        f'MX: {max_wait}',
+        '', ''
+    ]).encode('ascii')
+
+
+def parse_search_response(data):
+    """
+    Parses the headers of an SSDP response
+    :param data: Bytes - datagram received after an M-SEARCH
+    :return: Dictionary, None - lower cased headers or None if it is not a 200 response
+    """
+    lines = data.decode('utf-8', 'replace').split('\r\n')
+    if not lines or ' 200 ' not in f'{lines[0]} ':
+        return None
+
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+    return headers
+
+
+def ssdp_search(window=SSDP_WINDOW, search_target=ROKU_SEARCH_TARGET, address=SSDP_ADDRESS):
+    """
+    Sends an SSDP M-SEARCH and yields devices as they answer until the window closes
+    :param window: Float - seconds to collect responses for
+    :param search_target: String - SSDP search target
+    :param address: Tuple - host and port the search is sent to, multicast by default
+    :return: Generator - dictionaries with ip_address, port, location and usn
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    seen = set()
+    try:
+        sock.sendto(build_search_request(search_target), address)
+        deadline = time.monotonic() + window
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, sender = sock.recvfrom(4096)
+            except socket.timeout:
+                break
+
+            headers = parse_search_response(data)
+            if headers is None or headers.get('st', search_target) != search_target:
+                continue
+            location = urlparse(headers.get('location', ''))
+            ip_address = location.hostname or sender[0]
+            if ip_address in seen:
+                continue
+            seen.add(ip_address)
+            yield {
+                "ip_address": ip_address,
+                "port": location.port or ECP_PORT,
+                "location": headers.get('location'),
+                "usn": headers.get('usn')
+            }
+    finally:
+        sock.close()
+
+
+async def probe_port(host, port, timeout, semaphore):
+    import asyncio
+
+    async with semaphore:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        writer.close()
+
+        return host
+
+
+async def sweep(hosts, port, timeout, concurrency, found):
+    import asyncio
+
+    semaphore = asyncio.Semaphore(concurrency)
+    probes = [probe_port(host, port, timeout, semaphore) for host in hosts]
+    for probe in asyncio.as_completed(probes):
+        host = await probe
+        if host is not None:
+            found.put(host)
+
+
+def sweep_subnet(subnet, port=ECP_PORT, timeout=SWEEP_TIMEOUT, concurrency=SWEEP_CONCURRENCY):
+    """
+    Probes every host of a subnet for an open ECP port with many connects in flight,
+    hosts are yielded as soon as they accept instead of after the slowest one
+    :param subnet: String - CIDR notation, e.g. 192.168.1.0/24
+    :param port: Int - port to probe
+    :param timeout: Float - connect timeout for each host
+    :param concurrency: Int - connects in flight at once
+    :return: Generator - ip address strings
+    """
+    hosts = [str(host) for host in ipaddress.ip_network(subnet, strict=False).hosts()]
+    found = queue.Queue()
+
+    def run_sweep():
+        # asyncio is only needed for a sweep, importing it up front slows every cli start
+        import asyncio
+
+        try:
+            asyncio.run(sweep(hosts, port, timeout, concurrency, found))
+        finally:
+            found.put(None)
+
+    threading.Thread(target=run_sweep, daemon=True).start()
+    for host in iter(found.get, None):
+        yield host
+
+
+def local_subnet(prefix=24):
+    """
+    Guesses the LAN subnet from the address used for multicast, no packet is sent
+    :return: String, None - CIDR notation or None without a usable interface
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(SSDP_ADDRESS)
+        local_address = sock.getsockname()[0]
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
+    if local_address.startswith('127.') or local_address == '0.0.0.0':
+        return None
+
+    return str(ipaddress.ip_network(f'{local_address}/{prefix}', strict=False))
+
+
+def discover_devices(query_device, window=SSDP_WINDOW, subnet=None, max_workers=16):
+    """
+    Finds devices with SSDP and falls back to a subnet sweep when nothing answered,
+    every candidate is queried for device info as soon as it is found and yielded
+    as soon as it responds
+    :param query_device: Function - takes an ip address, returns device data or None
+    :param window: Float - seconds to collect SSDP responses for
+    :param subnet: String - CIDR to sweep when SSDP finds nothing, defaults to the local /24
+    :param max_workers: Int - device info queries in flight at once
+    :return: Generator - device data returned by query_device
+    """
+    answered = queue.Queue()
+
+    def find_candidates():
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                candidates = 0
+                try:
+                    for response in ssdp_search(window):
+                        executor.submit(query_device, response["ip_address"]).add_done_callback(answered.put)
+                        candidates += 1
+                except OSError:
+                    pass
+
+                sweep_target = subnet or local_subnet() if candidates == 0 else None
+                if sweep_target is not None:
+                    for host in sweep_subnet(sweep_target):
+                        executor.submit(query_device, host).add_done_callback(answered.put)
+        finally:
+            answered.put(None)
+
+    threading.Thread(target=find_candidates, daemon=True).start()
+    for future in iter(answered.get, None):
+        if future.exception() is None and future.result() is not None:
+            yield future.result()
@@ -0,0 +1,468 @@
+import hashlib
+import http.server
+import io
+import os
+import re
+import socketserver
+import struct
+import threading
+import time
+import zipfile
+import zlib
+
+from digest import CHALLENGE_PARAM, md5_hex
+from urllib.parse import unquote
+
+# seconds between shutdown checks of the servers, stopping a device waits for one
+SHUTDOWN_POLL = 0.05
+DEVICE_INFO_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8" ?>
+<device-info>
+<udn>{udn}</udn>
+<serial-number>{serial_number}</serial-number>
+<device-id>{serial_number}</device-id>
+<vendor-name>Roku</vendor-name>
+<model-number>4800X</model-number>
+<model-name>Roku Ultra</model-name>
+<friendly-model-name>{name}</friendly-model-name>
+<software-version>9.2.0</software-version>
+<software-build>4803</software-build>
+<network-type>ethernet</network-type>
+<uptime>{uptime}</uptime>
+<developer-enabled>true</developer-enabled>
+</device-info>
+'''
+CHANPERF_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8" ?>
+<chanperf>
+<plugin id="{app_id}">
+<cpu-percent>
+<durationSeconds>1</durationSeconds>
+<user>{cpu_user:.1f}</user>
+<sys>{cpu_sys:.1f}</sys>
+</cpu-percent>
+<memory>
+<used>{mem_used}</used>
+<res>{mem_res}</res>
+<anon>{mem_anon}</anon>
+<swap>0</swap>
+<file>{mem_file}</file>
+<shared>{mem_shared}</shared>
+</memory>
+</plugin>
+<status>OK</status>
+</chanperf>
+'''
+BITMAPS_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8" ?>
+<r2d2-bitmaps>
+<sizes>
+<total>{texture_total}</total>
+<used>{texture_used}</used>
+<max>{texture_max}</max>
+</sizes>
+<bitmaps>
+{bitmaps}
+</bitmaps>
+<status>OK</status>
+</r2d2-bitmaps>
+'''
+PLUGIN_PAGE_TEMPLATE = '''<html><body>
+<form method="post" action="plugin_install" enctype="multipart/form-data">
+<input type="file" name="archive">
+<input type="submit" name="mysubmit" value="Install">
+{replace}
+<input type="submit" name="mysubmit" value="Delete">
+</form>
+<script>Shell.create('Roku.Message').trigger('Set message content', '{message}').trigger('Render', node);</script>
+</body></html>
+'''
+INSPECT_PAGE_TEMPLATE = '''<html><body>
+<form method="post" action="plugin_inspect" enctype="multipart/form-data">
+<input type="submit" name="mysubmit" value="Screenshot">
+</form>
+{image}
+<script>Shell.create('Roku.Message').trigger('Set message content', '{message}').trigger('Render', node);</script>
+</body></html>
+'''
+SCREEN_SIZE = (64, 36)
+
+
+class FakeRoku:
+    """
+    In process stand-in for a Roku in developer mode, serves ECP on one port and the digest
+    protected developer web server on another and the debug console on a third, with optional
+    latency and bandwidth limits and a delay before a launched channel comes up
+    """
+    def __init__(self, name='Fake Roku', serial_number=None, username='rokudev', password='rokudev',
+                 latency=0.0, bandwidth=None, support_replace=True, launch_delay=0.0):
+        self.name = name
+        self.serial_number = serial_number or os.urandom(6).hex().upper()
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.support_replace = support_replace
+        self.launch_delay = launch_delay
+        self.realm = 'rokudev'
+        self.nonce = os.urandom(16).hex()
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.installed = None
+        self.active_app = None
+        self.keypresses = []
+        self.requests = []
+        self.ecp_connections = 0
+        # grey level of the screen background, a highlight moves with every key press
+        self.screen = 32
+        self.screenshots = 0
+        # cpu percentages and memory bytes reported by chanperf while the dev channel runs
+        self.perf = {"cpu_user": 12.0, "cpu_sys": 3.0, "mem_used": 96 * 1024 * 1024, "texture_used": 24 * 1024 * 1024}
+        self.console_clients = []
+        self.ecp_server = None
+        self.http_server = None
+        self.console_server = None
+
+    @property
+    def device_data(self):
+        return {
+            "name": self.name,
+            "username": self.username,
+            "password": self.password,
+            "ip_address": '127.0.0.1',
+            "ecp_port": self.ecp_server.server_address[1],
+            "http_port": self.http_server.server_address[1],
+            "console_port": self.console_server.server_address[1]
+        }
+
+    def start(self):
+        self.ecp_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.handler(EcpHandler))
+        self.http_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.handler(DeveloperHandler))
+        self.console_server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), self.handler(ConsoleHandler))
+        for server in (self.ecp_server, self.http_server, self.console_server):
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, args=(SHUTDOWN_POLL,), daemon=True).start()
+
+        return self
+
+    def stop(self):
+        with self.lock:
+            for client in self.console_clients:
+                client.close()
+        for server in (self.ecp_server, self.http_server, self.console_server):
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handler(self, handler_class):
+        device = self
+        return type(handler_class.__name__, (handler_class,), {"device": device})
+
+    def check_authorization(self, header, method):
+        """
+        Verifies a digest Authorization header against the device credentials
+        :return: Bool
+        """
+        if not header or not header.startswith('Digest '):
+            return False
+        params = {key.lower(): quoted if quoted else bare for key, quoted, bare in CHALLENGE_PARAM.findall(header[7:])}
+        if params.get('username') != self.username or params.get('nonce') != self.nonce:
+            return False
+
+        ha1 = md5_hex(f'{self.username}:{self.realm}:{self.password}')
+        ha2 = md5_hex(f'{method}:{params.get("uri")}')
+        if params.get('qop'):
+            expected = md5_hex(f'{ha1}:{self.nonce}:{params.get("nc")}:{params.get("cnonce")}:auth:{ha2}')
+        else:
+            expected = md5_hex(f'{ha1}:{self.nonce}:{ha2}')
+
+        return params.get('response') == expected
+
+    def install(self, archive):
+        """
+        Installs an uploaded archive as the dev channel
+        :param archive: Bytes - zip contents
+        :return: String - install message
+        """
+        try:
+            with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+                manifest = zf.read('manifest').decode('utf-8')
+        except (zipfile.BadZipFile, KeyError):
+            return 'Install Failure: No manifest. Invalid package.'
+
+        manifest_data = dict(line.split('=', 1) for line in manifest.splitlines() if '=' in line)
+        with self.lock:
+            self.installed = {
+                "title": manifest_data.get('title', 'dev'),
+                "version": f'{manifest_data.get("major_version", "0")}.{manifest_data.get("minor_version", "0")}.'
+                           f'{manifest_data.get("build_version", "0")}',
+                "size": len(archive),
+                "sha1": hashlib.sha1(archive).hexdigest()
+            }
+            self.active_app = 'dev'
+
+        return 'Install Success.'
+
+    def console_print(self, line):
+        """
+        Writes a line to every connected debug console client
+        """
+        with self.lock:
+            for client in list(self.console_clients):
+                try:
+                    client.sendall(f'{line}\r\n'.encode('utf-8'))
+                except OSError:
+                    self.console_clients.remove(client)
+
+    def launch(self, app_id):
+        """
+        Starts a channel, it reaches the foreground and prints its launch beacon after launch_delay
+        """
+        def ready():
+            self.active_app = app_id
+            self.console_print(f'[beacon.signal] |AppLaunchComplete ---------> '
+                               f'Duration({int(self.launch_delay * 1000)}ms)')
+
+        self.active_app = None
+        if app_id == 'dev':
+            self.console_print(f"------ Running dev '{self.installed['title']}' main ------")
+        if self.launch_delay:
+            threading.Timer(self.launch_delay, ready).start()
+        else:
+            ready()
+
+    def delete(self):
+        with self.lock:
+            self.installed = None
+            if self.active_app == 'dev':
+                self.active_app = None
+
+        return 'Delete Succeeded.'
+
+    def screenshot(self):
+        """
+        Renders the screen as a grayscale png, the highlighted tile follows the number of key presses
+        :return: Bytes - png file
+        """
+        width, height = SCREEN_SIZE
+        with self.lock:
+            tile = len(self.keypresses) % (width // 8)
+            background = self.screen
+        rows = []
+        for y in range(height):
+            row = bytes(255 if tile * 8 <= x < tile * 8 + 8 and 8 <= y < 28 else background for x in range(width))
+            rows.append(b'\x00' + row)
+
+        def chunk(chunk_type, data):
+            return struct.pack('>I', len(data)) + chunk_type + data + \
+                struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+        return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) + \
+            chunk(b'IDAT', zlib.compress(b''.join(rows))) + chunk(b'IEND', b'')
+
+
+class FakeRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    device = None
+
+    def log_message(self, *args):
+        pass
+
+    def delay(self, size=0):
+        seconds = self.device.latency
+        if self.device.bandwidth and size:
+            seconds += size / float(self.device.bandwidth)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.delay(len(body))
+
+        return body
+
+    def respond(self, status, body=b'', content_type='text/xml; charset="utf-8"', headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.delay(len(body))
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class EcpHandler(FakeRequestHandler):
+    def setup(self):
+        super().setup()
+        with self.device.lock:
+            self.device.ecp_connections += 1
+
+    def do_GET(self):
+        device = self.device
+        device.requests.append(('GET', self.path))
+        if self.path == '/query/device-info':
+            self.respond(200, DEVICE_INFO_TEMPLATE.format(
+                udn=f'fake-{device.serial_number}', serial_number=device.serial_number, name=device.name,
+                uptime=int(time.time() - device.started)))
+        elif self.path == '/query/apps':
+            apps = ['<app id="12" type="appl" version="4.1.218">Netflix</app>']
+            if device.installed is not None:
+                apps.append(f'<app id="dev" type="appl" version="{device.installed["version"]}">'
+                            f'{device.installed["title"]}</app>')
+            self.respond(200, '<?xml version="1.0" encoding="UTF-8" ?>\n<apps>\n' + '\n'.join(apps) + '\n</apps>\n')
+        elif self.path == '/query/active-app':
+            if device.active_app == 'dev' and device.installed is not None:
+                app = f'<app id="dev" type="appl" version="{device.installed["version"]}">' \
+                      f'{device.installed["title"]}</app>'
+            else:
+                app = '<app>Roku</app>'
+            self.respond(200, f'<?xml version="1.0" encoding="UTF-8" ?>\n<active-app>\n{app}\n</active-app>\n')
+        elif self.path.startswith('/query/chanperf'):
+            app_id = self.path[len('/query/chanperf/'):] or 'dev'
+            if device.active_app != app_id or device.installed is None:
+                self.respond(200, '<?xml version="1.0" encoding="UTF-8" ?>\n<chanperf>\n<status>FAILED</status>\n'
+                                  '<error>Channel not running</error>\n</chanperf>\n')
+                return
+            perf = device.perf
+            self.respond(200, CHANPERF_TEMPLATE.format(
+                app_id=app_id, cpu_user=perf["cpu_user"], cpu_sys=perf["cpu_sys"], mem_used=perf["mem_used"],
+                mem_res=perf["mem_used"] * 3 // 4, mem_anon=perf["mem_used"] // 2, mem_file=perf["mem_used"] // 4,
+                mem_shared=perf["mem_used"] // 8))
+        elif self.path == '/query/media-player':
+            state = 'play' if device.active_app == 'dev' else 'close'
+            self.respond(200, f'<?xml version="1.0" encoding="UTF-8" ?>\n<player error="false" state="{state}" />\n')
+        elif self.path == '/query/r2d2-bitmaps':
+            used = device.perf["texture_used"] if device.active_app == 'dev' else 0
+            bitmaps = '\n'.join(f'<bitmap name="pkg:/images/image{index}.png" size="{used // 8}" />'
+                                 for index in range(8 if used else 0))
+            self.respond(200, BITMAPS_TEMPLATE.format(texture_total=256 * 1024 * 1024, texture_used=used,
+                                                      texture_max=256 * 1024 * 1024, bitmaps=bitmaps))
+        else:
+            self.respond(404)
+
+    def do_POST(self):
+        device = self.device
+        device.requests.append(('POST', self.path))
+        self.read_body()
+        if self.path.startswith('/keypress/'):
+            with device.lock:
+                device.keypresses.append(unquote(self.path[len('/keypress/'):]))
+            if self.path == '/keypress/Home':
+                device.active_app = None
+            self.respond(200)
+        elif self.path.startswith('/launch/'):
+            app_id = self.path[len('/launch/'):].split('?')[0]
+            if app_id == 'dev' and device.installed is None:
+                self.respond(404)
+            else:
+                device.launch(app_id)
+                self.respond(200)
+        elif self.path.startswith('/input'):
+            self.respond(200)
+        else:
+            self.respond(404)
+
+
+class ConsoleHandler(socketserver.BaseRequestHandler):
+    device = None
+
+    def handle(self):
+        with self.device.lock:
+            self.device.console_clients.append(self.request)
+        try:
+            # input such as debugger commands is read and ignored until the client disconnects
+            while self.request.recv(1024):
+                pass
+        except OSError:
+            pass
+        finally:
+            with self.device.lock:
+                if self.request in self.device.console_clients:
+                    self.device.console_clients.remove(self.request)
+
+
+class DeveloperHandler(FakeRequestHandler):
+    def challenge(self):
+        self.respond(401, '<html><body>401 Unauthorized</body></html>', 'text/html', {
+            'WWW-Authenticate': f'Digest qop="auth", realm="{self.device.realm}", nonce="{self.device.nonce}"'
+        })
+
+    def do_GET(self):
+        self.device.requests.append(('GET', self.path))
+        if not self.device.check_authorization(self.headers.get('Authorization'), 'GET'):
+            return self.challenge()
+        if self.path == '/pkgs/dev.png' and self.device.screenshots:
+            return self.respond(200, self.device.screenshot(), 'image/png')
+        if self.path != '/plugin_install':
+            return self.respond(404, content_type='text/html')
+
+        replace = '<input type="submit" name="mysubmit" value="Replace">' \
+            if self.device.support_replace and self.device.installed else ''
+        self.respond(200, PLUGIN_PAGE_TEMPLATE.format(replace=replace, message=''), 'text/html')
+
+    def do_POST(self):
+        self.device.requests.append(('POST', self.path))
+        body = self.read_body()
+        if not self.device.check_authorization(self.headers.get('Authorization'), 'POST'):
+            return self.challenge()
+        if self.path not in ('/plugin_install', '/plugin_inspect'):
+            return self.respond(404, content_type='text/html')
+
+        fields = parse_multipart(body, self.headers.get('Content-Type', ''))
+        submit = fields.get('mysubmit', b'').decode('utf-8')
+        if self.path == '/plugin_inspect':
+            image = ''
+            if submit != 'Screenshot':
+                message = 'Failure: unknown action.'
+            elif self.device.installed is None:
+                message = 'Failure: no dev channel installed.'
+            else:
+                self.device.screenshots += 1
+                message = 'Screenshot ok'
+                image = f'<img src="pkgs/dev.png?time={int(time.time())}" width="640">'
+            return self.respond(200, INSPECT_PAGE_TEMPLATE.format(image=image, message=message), 'text/html')
+        if submit == 'Delete':
+            message = self.device.delete()
+        elif submit in ('Install', 'Replace') and fields.get('archive'):
+            message = self.device.install(fields['archive'])
+        else:
+            message = 'Install Failure: No archive.'
+        self.respond(200, PLUGIN_PAGE_TEMPLATE.format(replace='', message=message), 'text/html')
+
+
+def parse_multipart(body, content_type):
+    """
+    Splits a multipart/form-data body into its fields
+    :param body: Bytes - request body
+    :param content_type: String - Content-Type header with the boundary
+    :return: Dictionary - field name to raw value
+    """
+    match = re.search(r'boundary=("?)([^";]+)\1', content_type)
+    if match is None:
+        return {}
+
+    fields = {}
+    for part in body.split(b'--' + match.group(2).encode('ascii')):
+        headers, separator, value = part.partition(b'\r\n\r\n')
+        name = re.search(rb'name="([^"]*)"', headers)
+        if separator and name:
+            fields[name.group(1).decode('utf-8')] = value[:-2] if value.endswith(b'\r\n') else value
+
+    return fields
@@ -0,0 +1,159 @@
+import fnmatch
+import os
+import re
+
+from constants import DEFAULT_EXCLUDE_PATTERNS
+from pathlib import Path
+
+
+def translate_segment(segment):
+    """
+    Translates one path segment of a glob to a regex, wildcards never cross a slash
+    :param segment: String - glob segment without slashes
+    :return: String - regex
+    """
+    regex = ''
+    index = 0
+    while index < len(segment):
+        character = segment[index]
+        index += 1
+        if character == '*':
+            while index < len(segment) and segment[index] == '*':
+                index += 1
+            regex += '[^/]*'
+        elif character == '?':
+            regex += '[^/]'
+        elif character == '[' and ']' in segment[index + 1:]:
+            end = segment.index(']', index + 1)
+            members = segment[index:end]
+            index = end + 1
+            if members.startswith('!'):
+                members = '^' + members[1:]
+            regex += '[' + members.replace('\\', '\\\\') + ']'
+        else:
+            regex += re.escape(character)
+
+    return regex
+
+
+def translate(pattern):
+    """
+    Translates a channel glob to a regex matching posix paths relative to the channel root,
+    a ** segment matches any number of directories
+    :param pattern: String - glob like components/** or **/*.swp
+    :return: String - regex
+    """
+    segments = pattern.strip().strip('/').split('/')
+    regex = ''
+    for index, segment in enumerate(segments):
+        last = index == len(segments) - 1
+        if segment == '**':
+            regex += '.*' if last else '(?:[^/]+/)*'
+        else:
+            regex += translate_segment(segment) + ('' if last else '/')
+
+    return regex
+
+
+def compile_patterns(patterns):
+    if not patterns:
+        return re.compile('(?!)')
+
+    return re.compile('|'.join(f'(?:{translate(pattern)})' for pattern in patterns))
+
+
+class FileMatcher:
+    """
+    Compiles the include and !exclude globs of a channel config into two regexes. A path is
+    selected when it or one of its parent directories matches an include and neither it
+    nor a parent matches an exclude, excludes always win regardless of their order
+    """
+    def __init__(self, glob_array, default_excludes=DEFAULT_EXCLUDE_PATTERNS):
+        patterns = [pattern.strip() for pattern in glob_array if pattern.strip()]
+        includes = [pattern for pattern in patterns if not pattern.startswith('!')]
+        excludes = [pattern[1:] for pattern in patterns if pattern.startswith('!')] + list(default_excludes)
+        self.include = compile_patterns(includes)
+        self.exclude = compile_patterns(excludes)
+        self.include_segments = [pattern.strip('/').split('/') for pattern in includes]
+
+    def may_contain(self, relative_dir):
+        """
+        Checks whether an include could match something below a directory that is not
+        itself included, directories that fail this are never walked
+        :param relative_dir: String - posix path relative to channel root
+        :return: Bool
+        """
+        dir_segments = relative_dir.split('/')
+        for segments in self.include_segments:
+            for index, dir_segment in enumerate(dir_segments):
+                if index >= len(segments):
+                    break
+                if segments[index] == '**':
+                    return True
+                if not fnmatch.fnmatchcase(dir_segment, segments[index]):
+                    break
+            else:
+                if len(segments) > len(dir_segments):
+                    return True
+
+        return False
+
+    def matches(self, relative_path):
+        """
+        Checks a single relative path, used for file change events
+        :param relative_path: String - posix path relative to channel root
+        :return: Bool
+        """
+        parts = relative_path.split('/')
+        included = False
+        for index in range(1, len(parts) + 1):
+            prefix = '/'.join(parts[:index])
+            if self.exclude.fullmatch(prefix):
+                return False
+            included = included or self.include.fullmatch(prefix) is not None
+
+        return included
+
+    def scan(self, channel_path):
+        """
+        Walks the channel once, excluded directories and directories no include can reach
+        are pruned without being listed. Symlinked directories are followed, a link back to
+        a directory above it is skipped so a loop does not walk forever
+        :param channel_path: Object - path object to channel root
+        :return: Dictionary - sorted relative posix paths to their os.stat_result
+        """
+        root_stat = os.stat(str(channel_path))
+        channel_files = {}
+        pending = [('', False, frozenset([(root_stat.st_dev, root_stat.st_ino)]))]
+        while pending:
+            relative_dir, included, ancestors = pending.pop()
+            with os.scandir(os.path.join(str(channel_path), relative_dir)) as entries:
+                for entry in entries:
+                    relative_path = f'{relative_dir}/{entry.name}' if relative_dir else entry.name
+                    if self.exclude.fullmatch(relative_path):
+                        continue
+                    entry_included = included or self.include.fullmatch(relative_path) is not None
+                    try:
+                        if entry.is_dir():
+                            if entry_included or self.may_contain(relative_path):
+                                stat = entry.stat()
+                                if (stat.st_dev, stat.st_ino) not in ancestors:
+                                    pending.append((relative_path, entry_included,
+                                                    ancestors | {(stat.st_dev, stat.st_ino)}))
+                        elif entry_included and entry.is_file():
+                            channel_files[relative_path] = entry.stat()
+                    except FileNotFoundError:
+                        continue
+
+        return {relative_path: channel_files[relative_path] for relative_path in sorted(channel_files)}
+
+
+def collect_channel_files(channel_path, glob_array):
+    """
+    Lists the files defined in channel config, directories matched by a pattern
+    contribute every file below them and patterns starting with ! exclude
+    :param channel_path: Object - path object to channel root
+    :param glob_array: List - list of content thats needs to be archived for channel
+    :return: Dictionary - sorted relative posix paths to their os.stat_result
+    """
+    return FileMatcher(glob_array).scan(Path(channel_path))
@@ -0,0 +1,152 @@
+import click
+import concurrent.futures
+import json
+import time
+
+from device_registry import check_installed_build
+from profiling import trace, TRACER
+from roku import install_succeeded, Roku
+from urllib3.exceptions import HTTPError
+
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def deploy_to_device(device, channel, timeout, retries, backoff, registry=None, rokus=None, force=False):
+    """
+    Installs the built channel archive on one device, retrying connection errors and
+    retryable statuses with exponential backoff until the device deadline
+    :param device: Dictionary - device data with name, username, password and ip_address
+    :param channel: Object - Channel whose archive is in out
+    :param timeout: Float - seconds the device may take in total, no retry starts after them and
+                            each request is limited to them as well
+    :param retries: Int - attempts after the first one
+    :param backoff: Float - seconds to wait before the first retry, doubled after each one
+    :param registry: Object - DeviceRegistry used to skip devices that already run this build
+    :param rokus: Dictionary - Roku clients by ip address kept between deploys to reuse their connections
+    :param force: Bool - upload even when the device already runs this build, the install is still recorded
+    :return: Dictionary - per device result
+    """
+    started = time.perf_counter()
+    result = {
+        "name": device.get("name", ''),
+        "ip_address": device["ip_address"],
+        "ok": False,
+        "status": None,
+        "messages": [],
+        "attempts": 0,
+        "skipped": False,
+        "timed_out": False,
+        "error": None
+    }
+    deadline = started + timeout
+    roku = rokus.get(device["ip_address"]) if rokus is not None else None
+    if roku is None:
+        roku = Roku(device, timeout)
+        if rokus is not None:
+            rokus[device["ip_address"]] = roku
+
+    serial_number = None
+    if registry is not None:
+        installed, serial_number = check_installed_build(roku, registry, channel)
+        if installed and not force:
+            result.update(ok=True, skipped=True, messages=['build already installed'],
+                          elapsed=time.perf_counter() - started)
+            TRACER.add('device_deploy', started, result["elapsed"], 'device', device=device["ip_address"],
+                       skipped=True)
+            return result
+
+    for attempt in range(retries + 1):
+        result["attempts"] = attempt + 1
+        try:
+            install_result = roku.install_channel(channel)
+            result["status"] = install_result["status"]
+            result["messages"] = install_result["messages"]
+            result["error"] = None
+            if install_result["status"] not in RETRY_STATUSES:
+                break
+        except (HTTPError, OSError) as e:
+            result["error"] = f'{type(e).__name__}: {e}'
+        if attempt < retries:
+            delay = backoff * 2 ** attempt
+            if time.perf_counter() + delay >= deadline:
+                # a slow or unreachable device gives its concurrency slot back instead of retrying
+                result["timed_out"] = True
+                result["error"] = f'device timeout of {timeout:g}s reached after {attempt + 1} attempts' + \
+                    (f', {result["error"]}' if result["error"] else f', last status {result["status"]}')
+                break
+            with trace('retry_backoff', 'device', device=device["ip_address"]):
+                time.sleep(delay)
+
+    result["ok"] = result["error"] is None and install_succeeded(result)
+    if result["ok"] and serial_number is not None:
+        registry.record_install(serial_number, channel)
+    result["elapsed"] = time.perf_counter() - started
+    TRACER.add('device_deploy', started, result["elapsed"], 'device', device=device["ip_address"],
+               status=result["status"] or result["error"], attempts=result["attempts"])
+
+    return result
+
+
+def deploy_to_fleet(devices, channel, max_concurrency=8, timeout=120.0, retries=2, backoff=2.0, registry=None,
+                    rokus=None, force=False):
+    """
+    Pushes one built archive to many devices at once, a failing device never stops the others
+    :param devices: List - device dictionaries
+    :param channel: Object - Channel whose archive is in out
+    :param max_concurrency: Int - devices uploading at the same time
+    :param timeout: Float - seconds each device may take in total, see deploy_to_device
+    :param retries: Int - attempts after the first one for each device
+    :param backoff: Float - seconds to wait before the first retry
+    :param registry: Object - DeviceRegistry used to skip devices that already run this build
+    :param rokus: Dictionary - Roku clients by ip address kept between deploys to reuse their connections
+    :param force: Bool - upload even to devices that already run this build
+    :return: List - per device results in the order devices were given
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = [executor.submit(deploy_to_device, device, channel, timeout, retries, backoff, registry, rokus,
+                                   force)
+                   for device in devices]
+        concurrent.futures.wait(futures)
+    if registry is not None:
+        registry.save()
+
+    results = []
+    for device, future in zip(devices, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append({
+                "name": device.get("name", ''),
+                "ip_address": device["ip_address"],
+                "ok": False,
+                "status": None,
+                "messages": [],
+                "attempts": 0,
+                "skipped": False,
+                "timed_out": False,
+                "error": f'{type(e).__name__}: {e}',
+                "elapsed": 0.0
+            })
+
+    return results
+
+
+def echo_fleet_summary(results):
+    """
+    Prints one row per device with the outcome of its install
+    :param results: List - results of deploy_to_fleet
+    """
+    click.echo(f'{"device":<24} {"ip address":<16} {"result":<7} {"status":<6} {"tries":<5} {"time":>8}  message')
+    for result in results:
+        message = result["error"] or '; '.join(result["messages"])
+        click.echo(f'{result["name"][:24]:<24} {result["ip_address"]:<16} '
+                   f'{"skipped" if result["skipped"] else "ok" if result["ok"] else "FAILED":<7} '
+                   f'{str(result["status"] or "-"):<6} '
+                   f'{result["attempts"]:<5} {result["elapsed"]:>7.2f}s  {message}')
+    failed = len([result for result in results if not result["ok"]])
+    click.echo(f'{len(results) - failed} of {len(results)} devices deployed')
+
+
+def write_fleet_report(results, report_path):
+    with open(str(report_path), 'w') as report_file:
+        json.dump({"devices": results}, report_file, indent=4)
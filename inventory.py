@@ -0,0 +1,175 @@
+import concurrent.futures
+import time
+import urllib3
+import xml.etree.ElementTree as eTree
+
+from discovery import ECP_PORT
+
+STATUS_TIMEOUT = urllib3.Timeout(connect=1.0, read=3.0)
+STATUS_CONCURRENCY = 32
+STREAM_CHUNK_SIZE = 8 * 1024
+# device-info fields kept, a device reports close to a hundred
+DEVICE_INFO_FIELDS = ('serial-number', 'friendly-model-name', 'model-name', 'model-number', 'software-version',
+                      'software-build', 'developer-enabled', 'uptime', 'network-type', 'network-name')
+STATUS_COLUMNS = ('device', 'ip_address', 'model', 'firmware', 'developer', 'dev_version', 'active_app',
+                  'uptime', 'network', 'latency_ms', 'state')
+
+
+def pull_elements(response, done):
+    """
+    Feeds a streamed response to a pull parser and yields elements as they close, the rest of
+    the body is read off the connection but not parsed once done returns true
+    :param response: Object - urllib3 response opened with preload_content=False
+    :param done: Function - called after every element, true stops parsing
+    """
+    parser = eTree.XMLPullParser(events=('end',))
+    try:
+        for chunk in response.stream(STREAM_CHUNK_SIZE):
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                yield element
+                if done():
+                    return
+    finally:
+        response.drain_conn()
+        response.release_conn()
+
+
+def parse_device_info(response):
+    """
+    :param response: Object - streamed /query/device-info response
+    :return: Dictionary - the DEVICE_INFO_FIELDS the device reported by tag name
+    """
+    info = {}
+    for element in pull_elements(response, lambda: len(info) == len(DEVICE_INFO_FIELDS)):
+        if element.tag in DEVICE_INFO_FIELDS:
+            info[element.tag] = (element.text or '').strip()
+        element.clear()
+
+    return info
+
+
+def parse_dev_app(response):
+    """
+    :param response: Object - streamed /query/apps response
+    :return: Dictionary, None - title and version of the dev channel or None when none is installed
+    """
+    found = []
+    for element in pull_elements(response, lambda: bool(found)):
+        if element.tag == 'app' and element.get('id') == 'dev':
+            found.append({"title": element.text, "version": element.get('version')})
+        element.clear()
+
+    return found[0] if found else None
+
+
+def parse_active_app(response):
+    """
+    :param response: Object - streamed /query/active-app response
+    :return: String, None - id of the channel in the foreground or None on the home screen
+    """
+    found = []
+    for element in pull_elements(response, lambda: bool(found)):
+        if element.tag == 'app':
+            found.append(element.get('id'))
+
+    return found[0] if found else None
+
+
+def query_status(http, device_data, expected_version=None):
+    """
+    Queries device-info, apps and active-app of one device over one keep-alive connection,
+    a device that does not answer device-info is not asked the rest
+    :param http: Object - urllib3 PoolManager shared by every device
+    :param device_data: Dictionary - device to query
+    :param expected_version: String - version the dev channel should have, a different one counts as stale
+    :return: Dictionary - compact status record, state is ok, offline, stale or error
+    """
+    ecp_url = f'http://{device_data["ip_address"]}:{device_data.get("ecp_port", ECP_PORT)}'
+    record = {column: None for column in STATUS_COLUMNS}
+    record.update({"device": device_data.get("name") or device_data["ip_address"],
+                   "ip_address": device_data["ip_address"], "info": {}, "dev_app": None, "error": None})
+
+    def get(path):
+        response = http.request('GET', f'{ecp_url}{path}', preload_content=False, retries=False)
+        if response.status != 200:
+            response.drain_conn()
+            response.release_conn()
+            raise urllib3.exceptions.HTTPError(f'{path} returned {response.status}')
+        return response
+
+    started = time.perf_counter()
+    try:
+        info = record["info"] = parse_device_info(get('/query/device-info'))
+    except (urllib3.exceptions.HTTPError, eTree.ParseError, OSError) as e:
+        record.update({"state": 'offline', "error": f'{type(e).__name__}: {e}'})
+        return record
+    record["latency_ms"] = (time.perf_counter() - started) * 1000
+    record.update({
+        "device": info.get('friendly-model-name') or record["device"],
+        "model": info.get('model-name') or info.get('model-number'),
+        "firmware": ' '.join(filter(None, (info.get('software-version'), info.get('software-build')))) or None,
+        "developer": info.get('developer-enabled') == 'true' if 'developer-enabled' in info else None,
+        "uptime": int(info["uptime"]) if info.get('uptime', '').isdigit() else None,
+        "network": info.get('network-name') or info.get('network-type')
+    })
+
+    try:
+        record["dev_app"] = parse_dev_app(get('/query/apps'))
+        record["active_app"] = parse_active_app(get('/query/active-app'))
+    except (urllib3.exceptions.HTTPError, eTree.ParseError, OSError) as e:
+        record.update({"state": 'error', "error": f'{type(e).__name__}: {e}'})
+        return record
+
+    record["dev_version"] = record["dev_app"]["version"] if record["dev_app"] else None
+    stale = expected_version is not None and record["dev_version"] != expected_version
+    record["state"] = 'stale' if stale else 'ok'
+
+    return record
+
+
+def query_fleet_status(devices, expected_version=None, timeout=STATUS_TIMEOUT, max_workers=STATUS_CONCURRENCY):
+    """
+    Queries every device at once through one pool manager, each device keeps one connection
+    for its three queries and an offline device costs at most the connect timeout
+    :param devices: List - device dictionaries
+    :param expected_version: String - version the dev channel should have
+    :param timeout: Object - urllib3 Timeout of every request
+    :param max_workers: Int - devices queried at once
+    :return: List - results of query_status in device order
+    """
+    if not devices:
+        return []
+
+    http = urllib3.PoolManager(num_pools=len(devices), maxsize=1, timeout=timeout)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(devices))) as executor:
+            return list(executor.map(lambda device: query_status(http, device, expected_version), devices))
+    finally:
+        http.clear()
+
+
+def format_uptime(seconds):
+    if seconds is None:
+        return '-'
+    days, seconds = divmod(seconds, 86400)
+
+    return f'{days}d {seconds // 3600:02d}h' if days else f'{seconds // 3600}h {seconds % 3600 // 60:02d}m'
+
+
+def status_report_lines(records):
+    """
+    :param records: List - results of query_fleet_status
+    :return: List - table lines, one per device
+    """
+    lines = [f'{"device":<24} {"ip address":<16} {"model":<14} {"firmware":<12} {"dev":<4} {"dev version":<12} '
+             f'{"uptime":>8} {"network":<12} {"ms":>6}  state']
+    for record in records:
+        developer = '-' if record["developer"] is None else ('yes' if record["developer"] else 'no')
+        latency = f'{record["latency_ms"]:.0f}' if record["latency_ms"] is not None else '-'
+        lines.append(f'{record["device"][:24]:<24} {record["ip_address"]:<16} {(record["model"] or "-")[:14]:<14} '
+                     f'{(record["firmware"] or "-")[:12]:<12} {developer:<4} {(record["dev_version"] or "-"):<12} '
+                     f'{format_uptime(record["uptime"]):>8} {(record["network"] or "-")[:12]:<12} {latency:>6}  '
+                     f'{record["state"]}{"  " + record["error"] if record["error"] else ""}')
+
+    return lines
@@ -0,0 +1,161 @@
+import concurrent.futures
+import socket
+import time
+import urllib3
+import xml.etree.ElementTree as eTree
+
+from remote import summarize
+from roku import DEBUG_CONSOLE_PORT
+
+READY_CONDITIONS = ('active-app', 'media-player', 'console')
+LAUNCH_MARKER = 'AppLaunchComplete'
+LAUNCH_TIMEOUT = 30.0
+POLL_INTERVAL = 0.05
+SETTLE = 1.0
+
+
+class ConsoleMarker:
+    """
+    Watches the BrightScript debug console for a line containing a marker, the connection
+    is opened before the launch so nothing the channel prints is missed
+    """
+    def __init__(self, device_data, marker, timeout=LAUNCH_TIMEOUT):
+        self.marker = marker.encode('utf-8')
+        self.sock = socket.create_connection(
+            (device_data["ip_address"], int(device_data.get("console_port", DEBUG_CONSOLE_PORT))), timeout)
+        self.buffer = b''
+
+    def drain(self):
+        """
+        Drops output printed before the launch, such as the previous run of the channel
+        """
+        self.sock.setblocking(False)
+        try:
+            while self.sock.recv(64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        finally:
+            self.sock.setblocking(True)
+        self.buffer = b''
+
+    def wait(self, deadline):
+        """
+        :param deadline: Float - time.perf_counter() to give up at
+        :return: Float, None - time.perf_counter() the marker arrived or None on timeout
+        """
+        while True:
+            lines = self.buffer.split(b'\n')
+            self.buffer = lines.pop()
+            if any(self.marker in line for line in lines) or self.marker in self.buffer:
+                return time.perf_counter()
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(64 * 1024)
+            except socket.timeout:
+                return None
+            if not data:
+                return None
+            self.buffer += data
+
+    def close(self):
+        self.sock.close()
+
+
+def wait_for_exit(roku, app_id, deadline):
+    """
+    Presses Home until the channel is no longer in the foreground so every launch is a cold one
+    """
+    roku.send_key_press('Home')
+    while roku.query_active_app() == app_id:
+        if time.perf_counter() >= deadline:
+            raise TimeoutError(f'{app_id} did not exit')
+        time.sleep(POLL_INTERVAL)
+
+
+def is_ready(roku, app_id, ready):
+    if ready == 'media-player':
+        return roku.query_media_player() == 'play'
+
+    return roku.query_active_app() == app_id
+
+
+def measure_launch(roku, runs=5, app_id='dev', ready='active-app', marker=LAUNCH_MARKER, timeout=LAUNCH_TIMEOUT,
+                   settle=SETTLE):
+    """
+    Times cold launches of a channel, from the launch request until the device reports the
+    channel in the foreground, the media player playing or the marker on the debug console
+    :param roku: Object - Roku whose connection pool every request reuses
+    :param runs: Int - launches to time
+    :param app_id: String - channel to launch
+    :param ready: String - one of READY_CONDITIONS
+    :param marker: String - console line text that counts as ready
+    :param timeout: Float - seconds a launch may take before the run counts as failed
+    :param settle: Float - seconds on the home screen before each launch
+    :return: List - dictionaries with the run, seconds and an error for failed runs
+    """
+    results = []
+    for run in range(1, runs + 1):
+        console = None
+        try:
+            wait_for_exit(roku, app_id, time.perf_counter() + timeout)
+            time.sleep(settle)
+            if ready == 'console':
+                console = ConsoleMarker(roku.device_data, marker, timeout)
+                console.drain()
+
+            started = time.perf_counter()
+            deadline = started + timeout
+            status = roku.launch_app(app_id)
+            if status >= 400:
+                raise urllib3.exceptions.HTTPError(f'launching {app_id} returned {status}')
+            if console is not None:
+                ready_at = console.wait(deadline)
+            else:
+                ready_at = None
+                while ready_at is None and time.perf_counter() < deadline:
+                    if is_ready(roku, app_id, ready):
+                        ready_at = time.perf_counter()
+                    else:
+                        time.sleep(POLL_INTERVAL)
+            if ready_at is None:
+                raise TimeoutError(f'not ready after {timeout:g}s')
+            results.append({"run": run, "seconds": ready_at - started, "error": None})
+        except (urllib3.exceptions.HTTPError, eTree.ParseError, OSError) as e:
+            results.append({"run": run, "seconds": None, "error": f'{type(e).__name__}: {e}'})
+        finally:
+            if console is not None:
+                console.close()
+
+    return results
+
+
+def measure_launch_on_devices(rokus, runs=5, app_id='dev', ready='active-app', marker=LAUNCH_MARKER,
+                              timeout=LAUNCH_TIMEOUT, settle=SETTLE):
+    """
+    Times launches on several devices at once, each device runs its launches in order
+    :param rokus: List - Roku clients
+    :return: List - dictionaries with the device ip address and its results
+    """
+    def run_device(roku):
+        return {
+            "device": roku.device_data["ip_address"],
+            "results": measure_launch(roku, runs, app_id, ready, marker, timeout, settle)
+        }
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(rokus))) as executor:
+        return list(executor.map(run_device, rokus))
+
+
+def launch_summary(results):
+    """
+    :param results: List - result of measure_launch
+    :return: Dictionary - count, min, mean, p95 and max in seconds of the runs that finished, and failures
+    """
+    summary = summarize(result["seconds"] for result in results)
+    summary["failed"] = sum(1 for result in results if result["error"])
+
+    return summary
@@ -0,0 +1,333 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+import zlib
+
+from constants import USER_DATA_DIR
+from pathlib import Path
+
+OPTIMIZER_VERSION = 1
+OPTIMIZED_KINDS = {
+    '.brs': 'brightscript',
+    '.xml': 'xml',
+    '.png': 'png',
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg'
+}
+PARALLEL_OPTIMIZE_BYTES = 1024 * 1024
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# chunks with no effect on the decoded pixels
+PNG_DROPPED_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+XML_CDATA = re.compile(r'(<!\[CDATA\[.*?\]\]>)', re.S)
+XML_COMMENT = re.compile(r'<!--.*?-->', re.S)
+XML_INTER_TAG_SPACE = re.compile(r'>\s+<')
+BRS_REM = re.compile(r'rem(\s|$)', re.I)
+# print statements sharing their line with another statement are left alone
+BRS_PRINT = re.compile(r'(print\b|\?)[^:]*$', re.I)
+BRS_DIRECTIVE = re.compile(r'#\s*(if|else\s*if|elseif|else|end\s*if|endif)\b\s*(.*)', re.I)
+
+
+def default_cache_dir():
+    return Path.home() / USER_DATA_DIR / 'optimized'
+
+
+def strip_brightscript_comment(line):
+    """
+    Cuts a ' comment off a line, quotes inside string literals are left alone
+    :param line: String - one line of BrightScript
+    :return: String
+    """
+    in_string = False
+    for index, character in enumerate(line):
+        if character == '"':
+            in_string = not in_string
+        elif character == "'" and not in_string:
+            return line[:index]
+
+    return line
+
+
+def strip_debug_blocks(lines, debug_flags):
+    """
+    Drops #if blocks guarded by a debug flag, an #else branch is kept as plain code and an
+    #else if branch becomes the #if of what is left
+    :param lines: List - stripped BrightScript lines
+    :param debug_flags: Set - lower case conditional compilation constants treated as false
+    :return: List
+    """
+    kept = []
+    # one entry per open #if, drop while skipping a debug branch, else once its #else branch
+    # is kept without directives, elseif once its #else if became a new #if
+    blocks = []
+    for line in lines:
+        directive = BRS_DIRECTIVE.match(line)
+        keyword = re.sub(r'\s+', '', directive.group(1).lower()) if directive else None
+        if keyword == 'if':
+            if 'drop' not in blocks and directive.group(2).strip().lower() in debug_flags:
+                blocks.append('drop')
+                continue
+            blocks.append(None)
+        elif keyword in ('elseif', 'else') and blocks and blocks[-1] == 'drop':
+            blocks[-1] = keyword
+            if keyword == 'elseif':
+                kept.append(f'#if {directive.group(2).strip()}')
+            continue
+        elif keyword == 'endif':
+            mode = blocks.pop() if blocks else None
+            if mode in ('drop', 'else'):
+                continue
+
+        if 'drop' not in blocks:
+            kept.append(line)
+
+    return kept
+
+
+def minify_brightscript(source, strip_debug=False, debug_flags=('debug',)):
+    """
+    Removes comments, indentation and blank lines, statements stay one per line since
+    BrightScript is line oriented
+    :param source: String - BrightScript source
+    :param strip_debug: Bool - also drop #if DEBUG blocks and print statements
+    :param debug_flags: Iterable - conditional compilation constants dropped with strip_debug
+    :return: String
+    """
+    lines = []
+    for line in source.splitlines():
+        line = strip_brightscript_comment(line).strip()
+        if not line or BRS_REM.match(line):
+            continue
+        if strip_debug and BRS_PRINT.match(line):
+            continue
+        lines.append(line)
+    if strip_debug:
+        lines = strip_debug_blocks(lines, {flag.lower() for flag in debug_flags})
+
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def minify_xml(source):
+    """
+    Removes comments and whitespace between tags, CDATA sections such as inline scripts
+    are kept byte for byte
+    :param source: String - SceneGraph xml
+    :return: String
+    """
+    parts = XML_CDATA.split(source)
+    for index in range(0, len(parts), 2):
+        part = XML_COMMENT.sub('', parts[index])
+        parts[index] = XML_INTER_TAG_SPACE.sub('><', part)
+
+    return ''.join(parts).strip() + '\n'
+
+
+def recompress_png(data):
+    """
+    Losslessly rewrites a png with its image data deflated at the highest level and text
+    and time chunks dropped
+    :param data: Bytes - png file
+    :return: Bytes
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+
+    chunks = []
+    image_data = []
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        chunk_data = data[offset + 8:offset + 8 + length]
+        offset += 12 + length
+        if chunk_type == b'IDAT':
+            if not image_data:
+                chunks.append((b'IDAT', None))
+            image_data.append(chunk_data)
+        elif chunk_type not in PNG_DROPPED_CHUNKS:
+            chunks.append((chunk_type, chunk_data))
+        if chunk_type == b'IEND':
+            break
+
+    try:
+        pixels = zlib.decompress(b''.join(image_data))
+    except zlib.error:
+        return data
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9)
+    recompressed = compressor.compress(pixels) + compressor.flush()
+
+    output = [PNG_SIGNATURE]
+    for chunk_type, chunk_data in chunks:
+        if chunk_data is None:
+            chunk_data = recompressed
+        output.append(struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data +
+                      struct.pack('>I', zlib.crc32(chunk_type + chunk_data)))
+
+    return b''.join(output)
+
+
+def recompress_jpeg(data):
+    """
+    Optimizes the huffman tables of a jpeg with jpegtran when it is installed
+    :param data: Bytes - jpeg file
+    :return: Bytes
+    """
+    jpegtran = shutil.which('jpegtran')
+    if jpegtran is None:
+        return data
+
+    with tempfile.NamedTemporaryFile(suffix='.jpg') as source:
+        source.write(data)
+        source.flush()
+        result = subprocess.run([jpegtran, '-copy', 'none', '-optimize', source.name],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    return result.stdout if result.returncode == 0 and result.stdout else data
+
+
+def optimize_asset(source_path, kind, settings):
+    """
+    Optimizes one file
+    :param source_path: String - path to the channel file
+    :param kind: String - value of OPTIMIZED_KINDS
+    :param settings: Dictionary - optimizer settings
+    :return: Bytes
+    """
+    with open(source_path, 'rb') as source:
+        data = source.read()
+
+    if kind == 'brightscript':
+        text = minify_brightscript(data.decode('utf-8'), settings["strip_debug"], settings["debug_flags"])
+        return text.encode('utf-8')
+    elif kind == 'xml':
+        return minify_xml(data.decode('utf-8')).encode('utf-8')
+    elif kind == 'png':
+        return recompress_png(data)
+
+    return recompress_jpeg(data)
+
+
+def optimize_to_cache(source_path, cache_path, kind, settings):
+    """
+    Process pool worker, writes the optimized file to its cache path. Files that do not get
+    smaller, or cannot be decoded, leave an empty .same marker so they are not tried again
+    :return: Tuple - original and optimized size
+    """
+    original_size = os.path.getsize(source_path)
+    try:
+        optimized = optimize_asset(source_path, kind, settings)
+    except (UnicodeDecodeError, ValueError):
+        optimized = None
+
+    cache_path = Path(cache_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    if optimized is None or len(optimized) >= original_size:
+        cache_path.with_name(f'{cache_path.name}.same').touch()
+        return original_size, original_size
+
+    part_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.part')
+    part_path.write_bytes(optimized)
+    os.replace(str(part_path), str(cache_path))
+
+    return original_size, len(optimized)
+
+
+class AssetOptimizer:
+    """
+    Optional build stage between file selection and archiving. Outputs are cached by the
+    content hash of the source and the optimizer settings, so only new or edited files are
+    optimized again, across builds and channels
+    """
+    def __init__(self, strip_debug=False, debug_flags=('debug',), cache_dir=None, max_workers=None):
+        self.settings = {
+            "version": OPTIMIZER_VERSION,
+            "strip_debug": strip_debug,
+            "debug_flags": sorted(flag.lower() for flag in debug_flags)
+        }
+        self.cache_dir = Path(cache_dir) if cache_dir else default_cache_dir()
+        self.max_workers = max_workers
+
+    def cache_path(self, sha1, kind):
+        key = hashlib.sha1(f'{json.dumps(self.settings, sort_keys=True)}\0{kind}\0{sha1}'.encode('utf-8'))
+        key = key.hexdigest()
+
+        return self.cache_dir / key[:2] / key
+
+    def optimize(self, channel_path, file_states):
+        """
+        Optimizes every supported channel file
+        :param channel_path: Object - path object to channel root
+        :param file_states: Dictionary - result of BuildCache.scan, its hashes are the cache keys
+        :return: Tuple - relative path to optimized file for files that got smaller, and the report
+        """
+        sources = {}
+        report = {}
+        misses = []
+        for relative_path, state in file_states.items():
+            kind = OPTIMIZED_KINDS.get(os.path.splitext(relative_path)[1].lower())
+            if kind is None:
+                continue
+            entry = report.setdefault(kind, {"files": 0, "cached": 0, "original": 0, "optimized": 0})
+            entry["files"] += 1
+            cache_path = self.cache_path(state["sha1"], kind)
+            if cache_path.exists():
+                entry["cached"] += 1
+                entry["original"] += state["size"]
+                entry["optimized"] += cache_path.stat().st_size
+                sources[relative_path] = cache_path
+            elif cache_path.with_name(f'{cache_path.name}.same').exists():
+                entry["cached"] += 1
+                entry["original"] += state["size"]
+                entry["optimized"] += state["size"]
+            else:
+                misses.append((relative_path, kind, cache_path, state["size"]))
+
+        workers = self.max_workers or os.cpu_count() or 1
+        executor = None
+        if workers > 1 and len(misses) > 1 and sum(miss[3] for miss in misses) >= PARALLEL_OPTIMIZE_BYTES:
+            executor = concurrent.futures.ProcessPoolExecutor(min(workers, len(misses)))
+        try:
+            if executor is not None:
+                sizes = executor.map(optimize_to_cache, *zip(*[
+                    (str(Path(channel_path) / relative_path), str(cache_path), kind, self.settings)
+                    for relative_path, kind, cache_path, _ in misses]), chunksize=8)
+            else:
+                sizes = (optimize_to_cache(str(Path(channel_path) / relative_path), str(cache_path), kind,
+                                           self.settings)
+                         for relative_path, kind, cache_path, _ in misses)
+            for (relative_path, kind, cache_path, _), (original_size, optimized_size) in zip(misses, sizes):
+                report[kind]["original"] += original_size
+                report[kind]["optimized"] += optimized_size
+                if optimized_size < original_size:
+                    sources[relative_path] = cache_path
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        return sources, report
+
+
+def report_lines(report):
+    """
+    Formats the optimizer report, one row per kind of file and a total
+    :param report: Dictionary - report returned by AssetOptimizer.optimize
+    :return: List - lines to print
+    """
+    lines = [f'{"optimized":<14} {"files":>6} {"cached":>7} {"before":>12} {"after":>12} {"saved":>12}']
+    totals = {"files": 0, "cached": 0, "original": 0, "optimized": 0}
+    for kind in sorted(report):
+        entry = report[kind]
+        for key in totals:
+            totals[key] += entry[key]
+        lines.append(f'{kind:<14} {entry["files"]:>6} {entry["cached"]:>7} {entry["original"]:>12,} '
+                     f'{entry["optimized"]:>12,} {entry["original"] - entry["optimized"]:>12,}')
+    saved = totals["original"] - totals["optimized"]
+    percent = 100.0 * saved / totals["original"] if totals["original"] else 0.0
+    lines.append(f'{"total":<14} {totals["files"]:>6} {totals["cached"]:>7} {totals["original"]:>12,} '
+                 f'{totals["optimized"]:>12,} {saved:>12,} ({percent:.1f}%)')
+
+    return lines
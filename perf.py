@@ -0,0 +1,260 @@
+import concurrent.futures
+import csv
+import json
+import math
+import os
+import time
+import urllib3
+import xml.etree.ElementTree as eTree
+
+from remote import RemoteSession, summarize
+from urllib.parse import quote
+
+CHANPERF_PATH = '/query/chanperf/{app_id}'
+BITMAPS_PATH = '/query/r2d2-bitmaps'
+CPU_FIELDS = ('user', 'sys')
+MEMORY_FIELDS = ('used', 'res', 'anon', 'swap', 'file', 'shared')
+TEXTURE_FIELDS = ('used', 'total', 'max')
+METRICS = ('cpu_user', 'cpu_sys', 'cpu_total') + tuple(f'mem_{field}' for field in MEMORY_FIELDS) + \
+          tuple(f'texture_{field}' for field in TEXTURE_FIELDS)
+COLUMNS = ('time', 'device') + METRICS
+SUMMARY_STATS = ('min', 'mean', 'p95', 'max')
+PARSE_CHUNK_SIZE = 16 * 1024
+
+
+def read_number(element, path):
+    node = element.find(path) if element is not None else None
+    if node is None or node.text is None:
+        return None
+    try:
+        value = float(node.text)
+    except ValueError:
+        return None
+
+    return int(value) if value.is_integer() and '.' not in node.text else value
+
+
+def parse_chanperf(data):
+    """
+    Reads cpu and memory of the channel from a chanperf response, fields are None while
+    the channel is not running
+    :param data: Bytes - chanperf xml
+    :return: Dictionary - cpu_* percentages and mem_* bytes
+    """
+    sample = {metric: None for metric in METRICS if not metric.startswith('texture_')}
+    tree = eTree.fromstring(data)
+    if (tree.findtext('status') or '').strip().upper() != 'OK':
+        return sample
+
+    plugin = tree.find('plugin')
+    for field in CPU_FIELDS:
+        sample[f'cpu_{field}'] = read_number(plugin, f'cpu-percent/{field}')
+    if sample["cpu_user"] is not None and sample["cpu_sys"] is not None:
+        sample["cpu_total"] = sample["cpu_user"] + sample["cpu_sys"]
+    for field in MEMORY_FIELDS:
+        sample[f'mem_{field}'] = read_number(plugin, f'memory/{field}')
+
+    return sample
+
+
+def parse_bitmaps(data):
+    """
+    Reads texture memory totals from an r2d2-bitmaps response, parsing stops once the sizes
+    are read so the per bitmap list after them is never built
+    :param data: Bytes - r2d2-bitmaps xml
+    :return: Dictionary - texture_* bytes
+    """
+    sample = {f'texture_{field}': None for field in TEXTURE_FIELDS}
+    parser = eTree.XMLPullParser(events=('end',))
+    for offset in range(0, len(data), PARSE_CHUNK_SIZE):
+        parser.feed(data[offset:offset + PARSE_CHUNK_SIZE])
+        for _, element in parser.read_events():
+            if element.tag == 'sizes':
+                for field in TEXTURE_FIELDS:
+                    sample[f'texture_{field}'] = read_number(element, field)
+                return sample
+
+    return sample
+
+
+class PerfSampler(RemoteSession):
+    """
+    Polls chanperf and r2d2-bitmaps of one device over its keep-alive ECP connection
+    """
+    def __init__(self, device_data, app_id='dev', textures=True):
+        super().__init__(device_data)
+        self.name = device_data.get("name") or device_data["ip_address"]
+        self.app_id = app_id
+        self.textures = textures
+
+    def get(self, path):
+        response = self.pool.urlopen('GET', path, retries=False)
+        if response.status != 200:
+            raise urllib3.exceptions.HTTPError(f'{path} returned {response.status}')
+
+        return response.data
+
+    def sample(self):
+        """
+        Takes one sample
+        :return: Dictionary - device and every metric, metrics the device did not report are None
+        """
+        sample = {"device": self.name}
+        sample.update(parse_chanperf(self.get(CHANPERF_PATH.format(app_id=quote(self.app_id, safe='')))))
+        if self.textures:
+            try:
+                sample.update(parse_bitmaps(self.get(BITMAPS_PATH)))
+            except (urllib3.exceptions.HTTPError, eTree.ParseError):
+                self.textures = False
+        for field in TEXTURE_FIELDS:
+            sample.setdefault(f'texture_{field}', None)
+
+        return sample
+
+
+def sample_device(device_data, app_id, duration, interval, started, launch=True):
+    """
+    Launches the channel and samples it on a fixed schedule, a slow response delays one
+    sample and skips the slots it overran instead of firing them back to back
+    :param device_data: Dictionary - device to sample
+    :param app_id: String - channel to launch and sample, dev for the sideloaded channel
+    :param duration: Float - seconds to sample for
+    :param interval: Float - seconds between samples
+    :param started: Float - time.time() of the first sample, shared by every device so sample times line up
+    :param launch: Bool - launch the channel first
+    :return: Dictionary - device, columnar series and an error if sampling stopped
+    """
+    sampler = PerfSampler(device_data, app_id)
+    series = {column: [] for column in COLUMNS}
+    error = None
+    try:
+        if launch:
+            status, _ = sampler.launch(app_id)
+            if status >= 400:
+                raise urllib3.exceptions.HTTPError(f'launching {app_id} returned {status}')
+
+        count = max(1, int(duration / interval) + 1)
+        index = 0
+        while index < count:
+            delay = started + index * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            sample = sampler.sample()
+            sample["time"] = round(time.time() - started, 3)
+            for column in COLUMNS:
+                series[column].append(sample[column])
+            index = max(index + 1, math.floor((time.time() - started) / interval))
+    except (urllib3.exceptions.HTTPError, eTree.ParseError, OSError) as e:
+        error = f'{type(e).__name__}: {e}'
+    finally:
+        sampler.close()
+
+    return {"device": sampler.name, "series": series, "error": error}
+
+
+def sample_devices(devices, app_id='dev', duration=30.0, interval=1.0, launch=True, warmup=2.0):
+    """
+    Samples every device at the same time, each one on its own thread so a slow device
+    does not skew the schedule of the others
+    :param devices: List - device dictionaries
+    :param warmup: Float - seconds between launching the channel and the first sample
+    :return: List - results of sample_device in device order
+    """
+    started = time.time() + (warmup if launch else 0.0)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(devices))) as executor:
+        return list(executor.map(lambda device: sample_device(device, app_id, duration, interval, started, launch),
+                                 devices))
+
+
+def summarize_series(series):
+    """
+    :param series: Dictionary - columnar series of one device
+    :return: Dictionary - metric to its count, min, mean, p95 and max, metrics never reported are left out
+    """
+    summaries = {}
+    for metric in METRICS:
+        summary = summarize(series[metric])
+        if summary["count"]:
+            summaries[metric] = summary
+
+    return summaries
+
+
+def parse_thresholds(thresholds):
+    """
+    Parses --max values such as cpu_total.p95=40 or mem_used=200000000, the stat defaults to p95
+    :param thresholds: Iterable - threshold strings
+    :return: List - tuples of metric, stat and limit
+    """
+    parsed = []
+    for threshold in thresholds:
+        name, separator, limit = threshold.partition('=')
+        metric, _, stat = name.strip().partition('.')
+        stat = stat or 'p95'
+        if not separator or metric not in METRICS or stat not in SUMMARY_STATS:
+            raise ValueError(f'expected metric[.stat]=value with a metric of {", ".join(METRICS)} '
+                             f'and a stat of {", ".join(SUMMARY_STATS)}, got "{threshold}"')
+        try:
+            parsed.append((metric, stat, float(limit)))
+        except ValueError:
+            raise ValueError(f'"{limit}" is not a number in "{threshold}"')
+
+    return parsed
+
+
+def check_thresholds(runs, thresholds):
+    """
+    :param runs: List - results of sample_devices
+    :param thresholds: List - result of parse_thresholds
+    :return: List - violation messages, a metric a device never reported counts as a violation
+    """
+    violations = []
+    for run in runs:
+        summaries = summarize_series(run["series"])
+        for metric, stat, limit in thresholds:
+            if metric not in summaries:
+                violations.append(f'{run["device"]}: no {metric} samples')
+            elif summaries[metric][stat] > limit:
+                violations.append(f'{run["device"]}: {metric} {stat} {summaries[metric][stat]:g} > {limit:g}')
+
+    return violations
+
+
+def perf_report_lines(runs):
+    lines = []
+    for run in runs:
+        lines.append(f'{run["device"]}: {len(run["series"]["time"])} samples'
+                     f'{"  " + run["error"] if run["error"] else ""}')
+        for metric, summary in summarize_series(run["series"]).items():
+            lines.append(f'  {metric:<16} ' + ' '.join(f'{stat} {summary[stat]:>14,.1f}' for stat in SUMMARY_STATS))
+
+    return lines
+
+
+def write_series(runs, output_path):
+    """
+    Writes every sample of every device as one table, the format follows the extension,
+    .csv with a header row, .json with one array per column or .parquet when pyarrow is installed
+    :param runs: List - results of sample_devices
+    :param output_path: String - path to the output file
+    """
+    table = {column: [value for run in runs for value in run["series"][column]] for column in COLUMNS}
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension == '.csv':
+        with open(output_path, 'w', newline='') as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow(COLUMNS)
+            writer.writerows(zip(*(table[column] for column in COLUMNS)))
+    elif extension == '.json':
+        with open(output_path, 'w') as output_file:
+            json.dump({"columns": table, "summary": {run["device"]: summarize_series(run["series"]) for run in runs}},
+                      output_file)
+    elif extension == '.parquet':
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError('writing .parquet needs pyarrow, pip install pyarrow or use .csv')
+        pyarrow.parquet.write_table(pyarrow.table(table), output_path)
+    else:
+        raise ValueError(f'unsupported output format "{extension}", use .csv, .json or .parquet')
@@ -0,0 +1,159 @@
+import contextlib
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+
+class Tracer:
+    """
+    Collects timed spans of the deploy pipeline from any thread. Disabled by default so an
+    uninstrumented run only pays for a flag check per span
+    """
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.started = time.time()
+
+    def enable(self):
+        with self.lock:
+            self.enabled = True
+            self.events = []
+            self.thread_names = {}
+            self.origin = time.perf_counter()
+            self.started = time.time()
+
+    def add(self, name, start, duration, category='deploy', **args):
+        """
+        Records a finished span
+        :param name: String - phase name
+        :param start: Float - time.perf_counter() at the start of the span
+        :param duration: Float - seconds
+        :param category: String - trace category, deploy, device or build
+        :param args: bytes, files, status, device or any other detail of the span
+        """
+        if not self.enabled:
+            return
+
+        thread = threading.current_thread()
+        with self.lock:
+            self.thread_names[thread.ident] = thread.name
+            self.events.append({
+                "name": name,
+                "category": category,
+                "start": start - self.origin,
+                "duration": duration,
+                "tid": thread.ident,
+                "args": args
+            })
+
+    @contextlib.contextmanager
+    def span(self, name, category='deploy', **args):
+        """
+        Times the wrapped block, the yielded dictionary takes details only known at the end
+        such as bytes or status
+        """
+        if not self.enabled:
+            yield {}
+            return
+
+        fields = dict(args)
+        start = time.perf_counter()
+        try:
+            yield fields
+        except BaseException as e:
+            fields["error"] = type(e).__name__
+            raise
+        finally:
+            self.add(name, start, time.perf_counter() - start, category, **fields)
+
+    def summary(self):
+        """
+        Aggregates spans by name in the order the phases first ran
+        :return: List - dictionaries with name, calls, total, mean, max, bytes, files and statuses
+        """
+        phases = {}
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event["start"])
+        for event in events:
+            phase = phases.setdefault(event["name"], {
+                "name": event["name"], "calls": 0, "total": 0.0, "max": 0.0, "bytes": 0, "files": 0, "statuses": {}
+            })
+            phase["calls"] += 1
+            phase["total"] += event["duration"]
+            phase["max"] = max(phase["max"], event["duration"])
+            phase["bytes"] += event["args"].get("bytes") or 0
+            phase["files"] += event["args"].get("files") or 0
+            status = event["args"].get("status", event["args"].get("error"))
+            if status is not None:
+                phase["statuses"][str(status)] = phase["statuses"].get(str(status), 0) + 1
+        for phase in phases.values():
+            phase["mean"] = phase["total"] / phase["calls"]
+
+        return list(phases.values())
+
+    def summary_lines(self):
+        lines = [f'{"phase":<24} {"calls":>5} {"total":>10} {"mean":>10} {"max":>10} {"bytes":>14} {"files":>7}  '
+                 f'status']
+        for phase in self.summary():
+            statuses = ', '.join(f'{status} x{count}' for status, count in sorted(phase["statuses"].items()))
+            lines.append(f'{phase["name"][:24]:<24} {phase["calls"]:>5} {phase["total"] * 1000:>8.1f}ms '
+                         f'{phase["mean"] * 1000:>8.1f}ms {phase["max"] * 1000:>8.1f}ms '
+                         f'{phase["bytes"] or "":>14} {phase["files"] or "":>7}  {statuses}')
+
+        return lines
+
+    def write_chrome_trace(self, trace_path):
+        """
+        Writes the spans in the Chrome trace event format, loadable in chrome://tracing or
+        Perfetto, with run details under otherData for comparing runs
+        :param trace_path: String - path to the json file
+        """
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+            thread_names = dict(self.thread_names)
+
+        trace_events = [{"name": 'thread_name', "ph": 'M', "pid": pid, "tid": tid, "args": {"name": name}}
+                        for tid, name in thread_names.items()]
+        for event in events:
+            trace_events.append({
+                "name": event["name"],
+                "cat": event["category"],
+                "ph": 'X',
+                "ts": round(event["start"] * 1e6, 3),
+                "dur": round(event["duration"] * 1e6, 3),
+                "pid": pid,
+                "tid": event["tid"],
+                "args": event["args"]
+            })
+
+        with open(trace_path, 'w') as trace_file:
+            json.dump({
+                "traceEvents": trace_events,
+                "displayTimeUnit": 'ms',
+                "otherData": {
+                    "command": ' '.join(sys.argv),
+                    "started": self.started,
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "host": platform.node()
+                }
+            }, trace_file, default=str)
+
+
+TRACER = Tracer()
+
+
+def trace(name, category='deploy', **args):
+    """
+    Times a block on the shared tracer
+        with trace('upload', device=ip) as span:
+            span["bytes"] = sent
+    """
+    return TRACER.span(name, category, **args)
@@ -0,0 +1,243 @@
+import concurrent.futures
+import http.client
+import socket
+import time
+import urllib3
+
+from discovery import ECP_PORT
+from urllib.parse import quote, urlencode
+
+ECP_TIMEOUT = urllib3.Timeout(connect=2.0, read=5.0)
+SCRIPT_COMMANDS = {'key', 'text', 'delay', 'launch', 'input'}
+
+
+def parse_script(script):
+    """
+    Parses a key script, one command per line, blank lines and lines starting with # are ignored
+        key Home [count]       press a key, optionally several times
+        text hello world       type literal text
+        delay 500              wait milliseconds
+        launch dev [k=v ...]   launch a channel with optional params
+        input k=v [k=v ...]    send params to the running channel
+    :param script: String - script contents
+    :return: List - command dictionaries
+    """
+    commands = []
+    for line_number, line in enumerate(script.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        command, _, argument = line.partition(' ')
+        command = command.lower()
+        argument = argument.strip()
+        if command not in SCRIPT_COMMANDS or (not argument and command != 'text'):
+            raise ValueError(f'line {line_number}: unknown or incomplete command "{line}"')
+
+        if command == 'key':
+            parts = argument.split()
+            commands.append({"command": 'key', "key": parts[0], "count": int(parts[1]) if len(parts) > 1 else 1})
+        elif command == 'text':
+            commands.append({"command": 'text', "text": argument})
+        elif command == 'delay':
+            commands.append({"command": 'delay', "milliseconds": float(argument)})
+        elif command == 'launch':
+            parts = argument.split()
+            commands.append({"command": 'launch', "app_id": parts[0], "params": parse_params(parts[1:], line_number)})
+        else:
+            commands.append({"command": 'input', "params": parse_params(argument.split(), line_number)})
+
+    return commands
+
+
+def parse_params(pairs, line_number):
+    params = {}
+    for pair in pairs:
+        if '=' not in pair:
+            raise ValueError(f'line {line_number}: expected key=value, got "{pair}"')
+        key, value = pair.split('=', 1)
+        params[key] = value
+
+    return params
+
+
+class UnclosableReader:
+    """
+    Shares one buffered socket reader between the responses of a pipelined batch,
+    http.client closes the reader after each response otherwise
+    """
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+    def close(self):
+        pass
+
+
+class PipelineSocket:
+    def __init__(self, reader):
+        self.reader = reader
+
+    def makefile(self, mode, *args, **kwargs):
+        return self.reader
+
+
+class RemoteSession:
+    """
+    Sends ECP commands to one device over a single keep-alive connection and records
+    the round trip of every command
+    """
+    def __init__(self, device_data, timeout=ECP_TIMEOUT):
+        self.host = device_data["ip_address"]
+        self.port = int(device_data.get("ecp_port", ECP_PORT))
+        self.timeout = timeout
+        self.pool = urllib3.HTTPConnectionPool(self.host, self.port, maxsize=1, block=True, timeout=timeout)
+
+    def post(self, path):
+        started = time.perf_counter()
+        response = self.pool.urlopen('POST', path, retries=False)
+        return response.status, time.perf_counter() - started
+
+    def key_press(self, key):
+        return self.post(f'/keypress/{quote(key, safe="")}')
+
+    def send_text(self, text):
+        """
+        Types literal text by pipelining one keypress per character on a dedicated connection,
+        all requests are written before the responses are read. Characters are only resent one at
+        a time when the device could not be reached or closed the connection with Connection: close,
+        a batch that breaks after it was sent raises since the device may already have typed the rest
+        :param text: String - text to type
+        :return: List - status and latency of each character in order, the latency of a pipelined
+                        character is the gap since the previous response
+        """
+        requests = b''.join(
+            f'POST /keypress/Lit_{quote(character, safe="")} HTTP/1.1\r\n'
+            f'Host: {self.host}:{self.port}\r\nContent-Length: 0\r\n\r\n'.encode('ascii')
+            for character in text)
+        results = []
+        sent = False
+        connect_timeout = self.timeout.connect_timeout if isinstance(self.timeout, urllib3.Timeout) else self.timeout
+        try:
+            with socket.create_connection((self.host, self.port), connect_timeout) as sock:
+                sock.settimeout(self.timeout.read_timeout if isinstance(self.timeout, urllib3.Timeout) else None)
+                previous = time.perf_counter()
+                sent = True
+                sock.sendall(requests)
+                pipeline = PipelineSocket(UnclosableReader(sock.makefile('rb')))
+                for _ in text:
+                    response = http.client.HTTPResponse(pipeline)
+                    response.begin()
+                    response.read()
+                    received = time.perf_counter()
+                    results.append((response.status, received - previous))
+                    previous = received
+                    if response.will_close:
+                        break
+        except (OSError, http.client.HTTPException) as e:
+            if sent:
+                raise OSError(f'typing stopped after {len(results)} of {len(text)} characters, '
+                              f'the rest may or may not have been typed: {type(e).__name__}: {e}') from e
+
+        # a device that announced it is closing the connection did not read the requests after it
+        for character in text[len(results):]:
+            results.append(self.key_press(f'Lit_{character}'))
+
+        return results
+
+    def launch(self, app_id, params=None):
+        query = f'?{urlencode(params)}' if params else ''
+        return self.post(f'/launch/{quote(app_id, safe="")}{query}')
+
+    def input(self, params):
+        return self.post(f'/input?{urlencode(params)}')
+
+    def run(self, commands):
+        """
+        Runs parsed script commands in order
+        :param commands: List - result of parse_script
+        :return: List - one result per request with command, target, status and latency
+        """
+        results = []
+        for command in commands:
+            if command["command"] == 'delay':
+                time.sleep(command["milliseconds"] / 1000.0)
+                continue
+
+            if command["command"] == 'key':
+                responses = [(command["key"], self.key_press(command["key"])) for _ in range(command["count"])]
+            elif command["command"] == 'text':
+                responses = list(zip(command["text"], self.send_text(command["text"])))
+            elif command["command"] == 'launch':
+                responses = [(command["app_id"], self.launch(command["app_id"], command["params"]))]
+            else:
+                responses = [(urlencode(command["params"]), self.input(command["params"]))]
+
+            for target, (status, latency) in responses:
+                results.append({
+                    "command": command["command"],
+                    "target": target,
+                    "status": status,
+                    "latency": latency
+                })
+
+        return results
+
+    def close(self):
+        self.pool.close()
+
+
+def run_script(device_data, commands):
+    session = RemoteSession(device_data)
+    try:
+        return session.run(commands)
+    finally:
+        session.close()
+
+
+def run_script_on_devices(devices, commands, max_concurrency=8):
+    """
+    Replays the same script on many devices at once
+    :param devices: List - device dictionaries
+    :param commands: List - result of parse_script
+    :param max_concurrency: Int - devices driven at the same time
+    :return: List - dictionaries with the device, its results and an error if the script stopped
+    """
+    def run_device(device):
+        try:
+            return {"device": device, "results": run_script(device, commands), "error": None}
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            return {"device": device, "results": [], "error": f'{type(e).__name__}: {e}'}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        return list(executor.map(run_device, devices))
+
+
+def summarize(values):
+    """
+    Summarises a series of numbers
+    :param values: Iterable - numbers, None values are skipped
+    :return: Dictionary - count, min, mean, p95 and max
+    """
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return {"count": 0, "min": 0.0, "mean": 0.0, "p95": 0.0, "max": 0.0}
+
+    return {
+        "count": len(values),
+        "min": values[0],
+        "mean": sum(values) / len(values),
+        "p95": values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))],
+        "max": values[-1]
+    }
+
+
+def latency_summary(results):
+    """
+    Summarises round trip latencies in milliseconds
+    :param results: List - results of RemoteSession.run
+    :return: Dictionary - count, min, mean, p95 and max
+    """
+    return summarize(result["latency"] * 1000 for result in results)
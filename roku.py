@@ -1,36 +1,62 @@
 import click
-import concurrent.futures
-import ipaddress
+import html
 import json
 import os
 import re
+import time
 import urllib3
+import uuid
 import xml.etree.ElementTree as eTree
 
+from digest import DigestAuth
+from discovery import discover_devices, ECP_PORT, SSDP_WINDOW
+from pathlib import Path
+from profiling import trace, TRACER
 from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
 
-device_pool = []
+PLUGIN_INSTALL_PATH = '/plugin_install'
+PLUGIN_INSPECT_PATH = '/plugin_inspect'
+HTTP_PORT = 80
+DEBUG_CONSOLE_PORT = 8085
+DEVICE_INFO_TIMEOUT = urllib3.Timeout(connect=2.0, read=7.0)
+# device-info queries of discovery and revalidation share connections instead of a pool manager per query
+DEVICE_INFO_HTTP = urllib3.PoolManager(num_pools=64, maxsize=1)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+SCREENSHOT_IMAGE = re.compile(r'<img[^>]+src=["\']/?(pkgs/[^"\'?]+)', re.IGNORECASE)
+REPLACE_SUBMIT = re.compile(r'value=["\']Replace["\']', re.IGNORECASE)
+PLUGIN_MESSAGES = [
+    re.compile(r"'Set message content',\s*'((?:[^'\\]|\\.)*)'"),
+    re.compile(r'<font color="red">(.*?)</font>', re.DOTALL)
+]
 
 
 class Roku:
-    def __init__(self, device_data):
-        self.http = urllib3.PoolManager()
-        self.device_plugin_url = f'http://{device_data["ip_address"]}/plugin_install'
+    def __init__(self, device_data, timeout=None):
+        self.http = urllib3.PoolManager(timeout=urllib3.Timeout(total=timeout)) if timeout else urllib3.PoolManager()
+        self.device_http_url = f'http://{device_data["ip_address"]}:{device_data.get("http_port", HTTP_PORT)}'
+        self.device_plugin_url = f'{self.device_http_url}{PLUGIN_INSTALL_PATH}'
+        self.ecp_url = f'http://{device_data["ip_address"]}:{device_data.get("ecp_port", ECP_PORT)}'
         self.device_data = device_data
+        self.digest_auth = DigestAuth(device_data["username"], device_data["password"])
+        self.replace_supported = None
 
     @staticmethod
-    def scan_network():
+    def scan_network(window=SSDP_WINDOW, subnet=None):
         """
-        Scans LAN using address resolution protocol for any available devices then .
-        :return: List - an list of device dictionaries, removes any "Nones" before returning
+        Discovers devices with an SSDP search for roku:ecp, sweeping the subnet for the ECP
+        port when no device answered
+        :param window: Float - seconds to collect SSDP responses for
+        :param subnet: String - CIDR to sweep, defaults to the local /24
+        :return: List - an list of device dictionaries in the order they answered
         """
-        click.echo('Scanning netwrok for devices')
-        network_ping_results = os.popen('arp -a').read()
-        ip_list = [parse_ip_from_output(i) for i in network_ping_results.split('?')]
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            {executor.submit(query_ip_address_for_device_info, ip, True): ip for ip in ip_list}
+        click.echo('Scanning network for devices')
+        devices = []
+        for device in discover_devices(query_ip_address_for_device_info, window, subnet):
+            click.echo(f'found {device["name"]}')
+            devices.append(device)
 
-        return [device for device in device_pool if device is not None]
+        return devices
 
     @staticmethod
     def write_device_data_to_config(device_data, config_path):
@@ -39,31 +65,260 @@ class Roku:
         with open(str(config_path), 'w') as config_file:
             json.dump(config_data, config_file, indent=4)
 
+    def authenticate(self):
+        """
+        Requests the plugin page once to receive a digest challenge, the nonce is then
+        reused by every following plugin request
+        :return: Object - urllib3 response of the challenge request
+        """
+        with trace('authenticate', 'device', device=self.device_data["ip_address"]) as span:
+            response = self.http.request('GET', self.device_plugin_url, retries=False)
+            span["status"] = response.status
+        self.digest_auth.parse_challenge(response.headers.get('WWW-Authenticate'))
+
+        return response
+
+    def plugin_request(self, fields, archive=None, archive_name=None, path=PLUGIN_INSTALL_PATH):
+        """
+        Submits a developer server form over the pooled connection with digest auth
+        :param fields: Dictionary - form fields, mysubmit selects the action
+        :param archive: Object - path object to an archive or an iterable of archive bytes
+        :param archive_name: String - filename sent for a streamed archive
+        :param path: String - form to submit, plugin_install or plugin_inspect
+        :return: Dictionary - status, install messages, the response page and elapsed seconds
+        """
+        started = time.perf_counter()
+        if not self.digest_auth.has_challenge:
+            self.authenticate()
+
+        boundary = uuid.uuid4().hex
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        chunked = archive is not None and not isinstance(archive, Path)
+        device = self.device_data["ip_address"]
+        submit = fields.get('mysubmit', 'Install').lower()
+
+        for attempt in range(2):
+            if archive is None:
+                body = b''.join(encode_multipart(fields, boundary))
+            elif isinstance(archive, Path):
+                body = encode_multipart(fields, boundary, archive.name, read_file_chunks(archive))
+                headers['Content-Length'] = str(multipart_length(fields, boundary, archive.name,
+                                                                 archive.stat().st_size))
+            else:
+                body = encode_multipart(fields, boundary, archive_name, archive)
+
+            if self.digest_auth.has_challenge:
+                headers['Authorization'] = self.digest_auth.authorization('POST', path)
+            sent = {"bytes": len(body) if isinstance(body, bytes) else 0, "time": None}
+            if TRACER.enabled and not isinstance(body, bytes):
+                body = track_sent(body, sent)
+            request_started = time.perf_counter()
+            response = self.http.urlopen('POST', f'{self.device_http_url}{path}', body=body, headers=headers,
+                                         chunked=chunked, retries=False)
+            responded = time.perf_counter()
+
+            # the upload ends with the last body byte, the device installs until it responds
+            upload_end = sent["time"] or responded
+            TRACER.add(f'{submit}_upload', request_started, upload_end - request_started, 'device', device=device,
+                       bytes=sent["bytes"], attempt=attempt + 1)
+            TRACER.add(f'{submit}_on_device', upload_end, responded - upload_end, 'device', device=device,
+                       status=response.status)
+
+            # a stale nonce can only be retried while the body can be produced again
+            if response.status == 401 and not chunked and attempt == 0 and \
+                    self.digest_auth.parse_challenge(response.headers.get('WWW-Authenticate')):
+                continue
+            break
+
+        page = response.data.decode('utf-8', 'replace')
+        return {
+            "status": response.status,
+            "messages": parse_plugin_messages(page),
+            "page": page,
+            "elapsed": time.perf_counter() - started
+        }
+
+    def download(self, path, target_path):
+        """
+        Streams a file from the developer server to disk with digest auth, the file only
+        replaces target_path once complete
+        :param path: String - path on the developer server
+        :param target_path: Object - path object to write to
+        :return: Int - bytes written
+        """
+        if not self.digest_auth.has_challenge:
+            self.authenticate()
+
+        for attempt in range(2):
+            headers = {}
+            if self.digest_auth.has_challenge:
+                headers['Authorization'] = self.digest_auth.authorization('GET', path)
+            response = self.http.request('GET', f'{self.device_http_url}{path}', headers=headers,
+                                        preload_content=False, retries=False)
+            if response.status == 401 and attempt == 0 and \
+                    self.digest_auth.parse_challenge(response.headers.get('WWW-Authenticate')):
+                response.drain_conn()
+                response.release_conn()
+                continue
+            break
+
+        try:
+            if response.status != 200:
+                raise urllib3.exceptions.HTTPError(f'{path} returned {response.status}')
+            part_path = target_path.with_name(f'{target_path.name}.part')
+            size = 0
+            try:
+                with open(str(part_path), 'wb') as target:
+                    for chunk in response.stream(DOWNLOAD_CHUNK_SIZE):
+                        target.write(chunk)
+                        size += len(chunk)
+                os.replace(str(part_path), str(target_path))
+            except BaseException:
+                if part_path.exists():
+                    os.unlink(str(part_path))
+                raise
+        finally:
+            response.drain_conn()
+            response.release_conn()
+
+        return size
+
+    def take_screenshot(self, target_path):
+        """
+        Has the device capture the screen of the dev channel through plugin_inspect and streams the image to disk
+        :param target_path: Object - path object without a suffix, the suffix of the device image is added
+        :return: Dictionary - image path, bytes and elapsed seconds
+        """
+        started = time.perf_counter()
+        with trace('screenshot', 'device', device=self.device_data["ip_address"]) as span:
+            result = self.plugin_request({'mysubmit': 'Screenshot', 'passwd': '', 'archive': ''},
+                                         path=PLUGIN_INSPECT_PATH)
+            match = SCREENSHOT_IMAGE.search(result["page"])
+            if result["status"] != 200 or match is None:
+                raise urllib3.exceptions.HTTPError(f'no screenshot taken, '
+                                                   f'{"; ".join(result["messages"]) or result["status"]}')
+            image_path = f'/{match.group(1)}'
+            target_path = target_path.with_name(f'{target_path.name}{Path(image_path).suffix}')
+            size = span["bytes"] = self.download(image_path, target_path)
+
+        return {"path": target_path, "bytes": size, "elapsed": time.perf_counter() - started}
+
+    def supports_replace(self):
+        """
+        Checks whether the plugin page offers a Replace submit so an installed dev channel
+        can be swapped out in one request instead of a delete followed by an install
+        :return: Bool
+        """
+        if self.replace_supported is None:
+            if not self.digest_auth.has_challenge:
+                self.authenticate()
+            headers = {}
+            if self.digest_auth.has_challenge:
+                headers['Authorization'] = self.digest_auth.authorization('GET', PLUGIN_INSTALL_PATH)
+            with trace('supports_replace', 'device', device=self.device_data["ip_address"]) as span:
+                response = self.http.request('GET', self.device_plugin_url, headers=headers, retries=False)
+                span["status"] = response.status
+            self.replace_supported = response.status == 200 and \
+                REPLACE_SUBMIT.search(response.data.decode('utf-8', 'replace')) is not None
+
+        return self.replace_supported
+
     def delete_channel(self):
         click.echo('removing channel from  device')
-        delete_cmd = f'curl --user {self.device_data["username"]}:{self.device_data["password"]} --digest -s -S ' \
-                     f'-F "mysubmit=Delete" ' \
-                     f'{self.device_plugin_url}'
-        os.popen(delete_cmd).read()
+        return self.plugin_request({'mysubmit': 'Delete', 'archive': ''})
 
-    def deploy_channel(self, channel):
-        archive_path = channel.get_channel_archive()
+    def deploy_channel(self, channel, archive=None, submit='Install'):
+        """
+        Uploads the channel archive to the device
+        :param channel: Object - Channel being deployed
+        :param archive: Object - ArchiveStream being built, defaults to the archive in out
+        :param submit: String - plugin form action, Install or Replace
+        :return: Dictionary - result of the plugin request
+        """
         click.echo(f'deploying {channel.__str__()} channel from  device')
-        deploy_cmd = f'curl --user {self.device_data["username"]}:{self.device_data["password"]} --digest -s -S ' \
-                     f'-F "mysubmit=Install" ' \
-                     f'-F "archive=@{archive_path}" ' \
-                     f'{self.device_plugin_url}'
-        os.popen(deploy_cmd).read()
+        if archive is None:
+            return self.plugin_request({'mysubmit': submit}, channel.get_channel_archive())
+
+        return self.plugin_request({'mysubmit': submit}, archive, archive.name)
+
+    def install_channel(self, channel, archive=None):
+        """
+        Replaces the dev channel in one submit where the device supports it,
+        otherwise deletes the installed channel before installing the new one
+        :param channel: Object - Channel being deployed
+        :param archive: Object - ArchiveStream being built, defaults to the archive in out
+        :return: Dictionary - result of the install request
+        """
+        if self.supports_replace():
+            return self.deploy_channel(channel, archive, 'Replace')
+
+        self.delete_channel()
+        return self.deploy_channel(channel, archive)
+
+    def query_dev_app(self):
+        """
+        Looks up the sideloaded dev channel through ECP
+        :return: Dictionary, None - title and version of the dev channel or None when none is installed
+        """
+        with trace('query_apps', 'device', device=self.device_data["ip_address"]) as span:
+            response = self.http.request('GET', f'{self.ecp_url}/query/apps', retries=False)
+            span["status"] = response.status
+        if response.status != 200:
+            return None
+        for app in eTree.fromstring(response.data):
+            if app.get('id') == 'dev':
+                return {
+                    'title': app.text,
+                    'version': app.get('version')
+                }
+
+        return None
+
+    def launch_app(self, app_id='dev'):
+        """
+        Launches a channel through ECP
+        :param app_id: String - channel id, dev for the sideloaded channel
+        :return: Int - response status
+        """
+        response = self.http.request('POST', f'{self.ecp_url}/launch/{app_id}', retries=False)
+        return response.status
+
+    def query_active_app(self):
+        """
+        :return: String, None - id of the channel in the foreground or None on the home screen
+        """
+        response = self.http.request('GET', f'{self.ecp_url}/query/active-app', retries=False)
+        if response.status != 200:
+            return None
+        app = eTree.fromstring(response.data).find('app')
+
+        return app.get('id') if app is not None else None
+
+    def query_media_player(self):
+        """
+        :return: String, None - state of the media player such as play, buffer or close
+        """
+        response = self.http.request('GET', f'{self.ecp_url}/query/media-player', retries=False)
+        if response.status != 200:
+            return None
+
+        return eTree.fromstring(response.data).get('state')
+
+    def query_device_info(self):
+        with trace('query_device_info', 'device', device=self.device_data["ip_address"]) as span:
+            device_info = query_device_info(self.device_data["ip_address"],
+                                            port=self.device_data.get("ecp_port", ECP_PORT))
+            span["status"] = 200 if device_info else None
+
+        return device_info
 
     def send_key_press(self, key_press):
         if isinstance(key_press, str):
             if key_press.count(key_press[0]) == len(key_press):
                 key_press = f'Lit_{key_press}'
 
-            # requests.post(f'http://{self.device_data["ip_address"]}:8060/keypress/{key_press}')
-            http = urllib3.PoolManager()
-            url = f'http://{self.device_data["ip_address"]}:8060/keypress/{key_press}'
-            http.request('POST', url, retries=False)
+            url = f'{self.ecp_url}/keypress/{key_press}'
+            self.http.request('POST', url, retries=False)
         else:
             raise ValueError('key_press must be a non empty string')
 
@@ -71,59 +326,142 @@ class Roku:
         return 'Roku'
 
 
-def parse_ip_from_output(output_string):
+def query_ip_address_for_device_info(ip_address):
     """
-    Parses ip address out from arp output
-    :param output_string - String -
-    :return: String, None - either none if device didn't respond or timed out
+    Pings each ip address to see with roku query device,
+    checks for response back then will parse device data xml
+    :param ip_address: String - ip address IPV4 to ping with device query
+    :return: Dictionary - dict is formatted for PyInquirer's choices, and contains available device info
     """
-    if output_string != '':
-        ip_address = re.split(' ', output_string.lstrip(), 2)[0][1:-1]
+    device_info = query_device_info(ip_address)
+    if device_info is not None and 'friendly-model-name' in device_info:
+        return device_choice(device_info, ip_address)
 
-        try:
-            if ipaddress.ip_address(ip_address):
-                return ip_address
-        except ValueError:
-            click.echo(f'got {ip_address} instead of ip')
 
+def device_choice(device_info, ip_address):
+    """
+    Formats device info as a PyInquirer choice
+    :param device_info: Dictionary - result of query_device_info
+    :param ip_address: String - ip address of the device
+    :return: Dictionary
+    """
+    return {
+        'name': f'{device_info.get("friendly-model-name")} - {ip_address}',
+        'value': {
+            'name': device_info.get("friendly-model-name"),
+            'username': 'rokudev',
+            'ip_address': ip_address,
+            'password': ''
+        }
+    }
 
-def query_ip_address_for_device_info(ip_address, use_device_pool=False):
+
+def query_device_info(ip_address, timeout=DEVICE_INFO_TIMEOUT, port=ECP_PORT):
     """
-    Pings each ip address to see with roku query device,
-    checks for response back then will parse device data xml
-    :param use_device_pool:
-    :param ip_address: String - ip address IPV4 to ping with device query
-    :return: Dictionary - dict is formatted for PyInquirer's choices, and contains available device info
+    Queries ECP device-info
+    :param ip_address: String - ip address IPV4 of the device
+    :param timeout: Object - urllib3 Timeout for the query
+    :param port: Int - ECP port of the device
+    :return: Dictionary, None - every device-info field by tag name or None if the device did not answer
     """
-    timeout = urllib3.Timeout(connect=2.0, read=7.0)
-    http = urllib3.PoolManager(timeout=timeout)
-    if isinstance(ip_address, str):
-        url = f'http://{ip_address}:8060/query/device-info'
-        try:
-            response = http.request('GET', url, retries=False)
-            if response.status == 200:
-                data = response.data
-                if isinstance(data, bytes):
-                    tree = eTree.fromstring(data)
-                    for child in tree:
-                        if child.tag == 'friendly-model-name':
-                            device = {
-                                'name': f'{child.text} - {ip_address}',
-                                'value': {
-                                    'name': child.text,
-                                    'username': 'rokudev',
-                                    'ip_address': ip_address,
-                                    'password': ''
-                                }
-                            }
-
-                            if not use_device_pool:
-                                return device
-                            else:
-                                device_pool.append(device)
-        except NewConnectionError:
-            click.echo(f'Unable to establish connection with {ip_address}')
-            return None
-        except ConnectTimeoutError:
-            click.echo(f'Connection timed out connecting to {ip_address}')
-            return None
+    if not isinstance(ip_address, str):
+        return None
+
+    url = f'http://{ip_address}:{port}/query/device-info'
+    try:
+        response = DEVICE_INFO_HTTP.request('GET', url, timeout=timeout, retries=False)
+        if response.status == 200:
+            tree = eTree.fromstring(response.data)
+            return {child.tag: child.text for child in tree}
+    except NewConnectionError:
+        click.echo(f'Unable to establish connection with {ip_address}')
+    except ConnectTimeoutError:
+        click.echo(f'Connection timed out connecting to {ip_address}')
+    except (urllib3.exceptions.HTTPError, eTree.ParseError):
+        click.echo(f'Unable to read device info from {ip_address}')
+
+    return None
+
+
+def track_sent(chunks, sent):
+    """
+    Passes body chunks through while counting them, the time is set once the last one was handed
+    to the connection
+    :param chunks: Iterable - request body chunks
+    :param sent: Dictionary - receives bytes and time
+    """
+    for chunk in chunks:
+        sent["bytes"] += len(chunk)
+        yield chunk
+    sent["time"] = time.perf_counter()
+
+
+def read_file_chunks(file_path):
+    with open(str(file_path), 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            yield chunk
+
+
+def multipart_parts(fields, boundary, archive_name):
+    """
+    Builds the multipart framing around the form fields and the optional archive part
+    :return: Tuple - bytes before the archive data and bytes after it
+    """
+    head = b''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8')
+        for name, value in fields.items())
+    if archive_name is not None:
+        head += f'--{boundary}\r\nContent-Disposition: form-data; name="archive"; filename="{archive_name}"\r\n' \
+                f'Content-Type: application/zip\r\n\r\n'.encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    else:
+        tail = f'--{boundary}--\r\n'.encode('utf-8')
+
+    return head, tail
+
+
+def encode_multipart(fields, boundary, archive_name=None, archive_chunks=None):
+    """
+    Yields a multipart/form-data body, archive chunks are passed through as they arrive
+    :param fields: Dictionary - form fields
+    :param boundary: String - multipart boundary
+    :param archive_name: String - filename of the archive part
+    :param archive_chunks: Iterable - archive bytes
+    """
+    head, tail = multipart_parts(fields, boundary, archive_name)
+    yield head
+    if archive_chunks is not None:
+        for chunk in archive_chunks:
+            yield chunk
+    yield tail
+
+
+def multipart_length(fields, boundary, archive_name, archive_size):
+    head, tail = multipart_parts(fields, boundary, archive_name)
+    return len(head) + archive_size + len(tail)
+
+
+def parse_plugin_messages(page):
+    """
+    Pulls the install messages out of the html returned by plugin_install
+    :param page: String - response html
+    :return: List - messages in page order
+    """
+    messages = []
+    for pattern in PLUGIN_MESSAGES:
+        for message in pattern.findall(page):
+            message = html.unescape(re.sub(r'<[^>]+>', '', message.replace("\\'", "'"))).strip()
+            if message and message not in messages:
+                messages.append(message)
+
+    return messages
+
+
+def install_succeeded(install_result):
+    """
+    Checks a plugin_install result, compile errors still come back with a 200 status
+    :param install_result: Dictionary - result of a plugin request
+    :return: Bool
+    """
+    return install_result["status"] == 200 and \
+        not any('Failure' in message for message in install_result["messages"])
@@ -2,27 +2,112 @@
 # -*- coding: utf-8 -*-
 
 import click
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import glob
+import io
 import ipaddress
 import json
 import os
+import re
 import shutil
+import time
+import urllib3
+import xml.etree.ElementTree as eTree
 
+from archive import (ArchiveStream, CompressionPolicy, default_entry_cache_dir, ENTRY_CACHE_MAX_BYTES, EntryCache,
+                     trim_entry_cache, update_archive)
+from artifact_store import ARTIFACT_MAX_BYTES, ARTIFACT_MAX_COUNT, artifact_key, ArtifactStore
+from build_cache import BuildCache, build_fingerprint
 from channel import Channel
-from constants import (STANDARD_CHANNEL_STRUCTURE, CONFIG_FILE, STAGE_DIR)
-from distutils.dir_util import copy_tree
+from console_logs import BUFFER_LINES, LineFilter, ROTATE_BACKUPS, ROTATE_BYTES, RotatingWriter, stream_logs
+from constants import (STANDARD_CHANNEL_STRUCTURE, CONFIG_FILE, PASSWORD_ENV, SERVE_TOKEN_ENV, USER_DATA_DIR,
+                       USERNAME_ENV)
+from file_matcher import collect_channel_files
+from launch_timing import LAUNCH_MARKER, launch_summary, measure_launch_on_devices, READY_CONDITIONS
+from daemon import default_socket_path, DeployDaemon, start_servers
+from device_registry import check_installed_build, DeviceRegistry, REGISTRY_TTL
+from fleet import deploy_to_fleet, echo_fleet_summary, write_fleet_report
+from inventory import query_fleet_status, STATUS_CONCURRENCY, status_report_lines
+from optimizer import AssetOptimizer, report_lines
+from perf import check_thresholds, parse_thresholds, perf_report_lines, sample_devices, write_series
 from pathlib import Path
-from pyfiglet import Figlet
-from PyInquirer import prompt
-from roku import query_ip_address_for_device_info, Roku
-from validators import EmptyValidator, IpAddressValidator
+from profiling import trace, TRACER
+from remote import latency_summary, parse_script, run_script_on_devices
+from roku import install_succeeded, query_ip_address_for_device_info, Roku
+from screenshot import CHANGE_THRESHOLD, capture_devices, parse_capture_script, screenshot_report_lines
+from watcher import create_watcher, DEBOUNCE
 
+REVALIDATION_WAIT = 10.0
 
-def device_selection():
-    available_devices = Roku.scan_network()
+
+class DefaultCommandGroup(click.Group):
+    """
+    Command group that falls back to a default command when the first argument is not
+    a subcommand, so `rokuPi -c path` keeps deploying
+    """
+    def __init__(self, *args, default_command='deploy', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        if not args or (args[0] not in self.commands and args[0] not in ctx.help_option_names):
+            args = [self.default_command] + list(args)
+
+        return super().parse_args(ctx, args)
+
+
+def echo_banner():
+    # pyfiglet is only needed for interactive runs, importing it costs startup time
+    from pyfiglet import Figlet
+
+    click.echo(Figlet(font='slant').renderText('RokuPi'))
+
+
+def device_username():
+    return os.environ.get(USERNAME_ENV, 'rokudev')
+
+
+def is_loopback(host):
+    try:
+        return host == 'localhost' or ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def device_password(non_interactive=False):
+    """
+    Reads the device password from the environment, prompting for it only in interactive runs
+    :param non_interactive: Bool - fail instead of prompting
+    :return: String
+    """
+    password = os.environ.get(PASSWORD_ENV)
+    if password is None:
+        if non_interactive:
+            raise click.UsageError(f'set {PASSWORD_ENV} to the device password')
+        password = click.prompt('device password', type=str, hide_input=True)
+
+    return password
+
+
+def device_selection(registry, subnet=None):
+    # PyInquirer pulls in prompt-toolkit, only import it once a prompt is shown
+    from PyInquirer import prompt
+    from validators import EmptyValidator, IpAddressValidator
+
+    available_devices = registry.choices()
+    if len(available_devices) > 0:
+        # known devices show up right away while their addresses are checked
+        registry.revalidate_in_background(subnet)
+    else:
+        click.echo('Starting network scan....')
+        registry.discover(subnet)
+        registry.save()
+        available_devices = registry.choices()
     device = {}
     write_to_config = False
-    click.echo('Starting network scan....')
     if len(available_devices) > 0:
         device_selection_questions = [
             {
@@ -48,6 +133,7 @@ def device_selection():
             device_selection_answers["device"][0]["password"] = device_selection_answers["password"]
             device = device_selection_answers["device"][0]
             write_to_config = device_selection_answers["save_device"]
+            resolve_registry_address(registry, device)
         except KeyError:
             click.echo('an error occurred with device selection')
     else:
@@ -90,6 +176,19 @@ def device_selection():
     }
 
 
+def resolve_registry_address(registry, device):
+    """
+    Picks up an ip change found by background revalidation for the selected device
+    :param registry: Object - DeviceRegistry the device was selected from
+    :param device: Dictionary - selected device data, updated in place
+    """
+    registry.wait_for_revalidation(REVALIDATION_WAIT)
+    entry = registry.find(device.get("serial_number"))
+    if entry is not None and entry["ip_address"] != device["ip_address"]:
+        click.echo(f'{device["name"]} moved from {device["ip_address"]} to {entry["ip_address"]}')
+        device["ip_address"] = entry["ip_address"]
+
+
 def parse_manifest(manifest_path):
     """
     Parses channel manifest channel data
@@ -133,64 +232,261 @@ def empty_dir(dir_to_empty):
             shutil.rmtree(os.path.join(root, d))
 
 
-def stage_channel_contents(channel_path, glob_array):
+def prepare_channel_archive(channel, force_rebuild=False, write_out=True, bounded_memory=False, optimizer=None,
+                            build_cache=None, store=None, entry_cache_dir=None, max_workers=None):
     """
-    Empties/creates staging dir then copying channel files to it to be archived
-    :param channel_path: Object - path object to channel root
-    :param glob_array: List - list of content thats needs to staged for channel
-    :return:
+    Prepares the channel archive for upload. When nothing changed since the last build the
+    archive in out is reused, when some files changed only their entries are rewritten,
+    otherwise the archive is streamed straight from the channel files during upload
+    :param channel: Object - Channel with manifest and config data set
+    :param force_rebuild: Bool - ignore the build cache and rebuild from scratch
+    :param write_out: Bool - also write a streamed archive to out for later deploys
+    :param bounded_memory: Bool - cap the streamed bytes held in memory when upload is slower than packaging
+    :param optimizer: Object - AssetOptimizer whose outputs are archived in place of the channel files
+    :param build_cache: Object - BuildCache kept in memory between builds, loaded from the channel otherwise
+    :param store: Object - ArtifactStore to take an earlier build of the same files from and to add new builds to
+    :param entry_cache_dir: Object - directory of deflated entries shared with other channels, None deflates every file
+    :param max_workers: Int - compression processes, None for one per cpu
+    :return: Object - path object to the archive or an ArchiveStream to be uploaded
     """
-    stage_dir_path = channel_path / STAGE_DIR
+    channel_path = channel.channel_path
+    channel.archive_path = None
+    archive_path = channel.out_dir / f'{channel.__str__()}.zip'
+    try:
+        compression = CompressionPolicy(channel.config_data.get("compression"))
+    except ValueError as e:
+        raise click.ClickException(f'{CONFIG_FILE}: {e}')
+    if build_cache is None:
+        build_cache = BuildCache(channel_path)
+    if force_rebuild:
+        build_cache.clear()
+
+    with trace('collect_files', 'build') as span:
+        channel_files = collect_channel_files(channel_path, channel.config_data["files"])
+        span["files"] = len(channel_files)
+    with trace('build_cache_scan', 'build', files=len(channel_files)) as span:
+        file_states = build_cache.scan(channel_files)
+        span["bytes"] = sum(state["size"] for state in file_states.values())
+    changes = build_cache.diff(file_states)
+    settings = {"compression": compression.rules}
+    sources = {}
+    if optimizer is not None:
+        with trace('optimize', 'build') as span:
+            sources, report = optimizer.optimize(channel_path, file_states)
+            span["files"] = sum(entry["files"] - entry["cached"] for entry in report.values())
+            span["bytes"] = sum(entry["original"] - entry["optimized"] for entry in report.values())
+        for line in report_lines(report):
+            click.echo(line)
+        settings["optimize"] = optimizer.settings
+    channel.build_fingerprint = build_fingerprint(file_states, channel.manifest_data, settings.get("optimize"))
+    previous_archive_path = channel.out_dir / build_cache.archive if build_cache.archive else None
+    if build_cache.settings != settings:
+        # entries of the last build were compressed or optimized with other settings
+        previous_archive_path = None
+
+    key = artifact_key(channel.build_fingerprint, settings)
+    unchanged = previous_archive_path == archive_path and archive_path.exists() and \
+        not changes["changed"] and not changes["removed"]
+    if store is not None and not unchanged and not force_rebuild:
+        stored_path = store.get(key)
+        if stored_path is not None:
+            click.echo(f'reusing stored build {key[:12]}, skipping archive')
+            channel.archive_path = stored_path
+            return stored_path
+
+    entry_cache = None
+    if entry_cache_dir is not None:
+        # optimized files are archived from the optimizer output, not the hashed channel file
+        entry_cache = EntryCache(entry_cache_dir, {relative_path: state["sha1"] for relative_path, state
+                                                   in file_states.items() if relative_path not in sources})
+
+    def store_build():
+        if store is not None:
+            with trace('store_build', 'build'):
+                store.put(key, archive_path, channel, settings)
 
-    if stage_dir_path.exists():
-        empty_dir(stage_dir_path)
+    if previous_archive_path is None or not previous_archive_path.exists():
+        if not write_out:
+            return ArchiveStream(channel_path, channel_files, bounded_memory=bounded_memory, stats=channel_files,
+                                 compression=compression, max_workers=max_workers, sources=sources,
+                                 entry_cache=entry_cache)
+
+        def save_build_cache():
+            build_cache.update(file_states, archive_path.name, settings)
+            build_cache.save()
+            store_build()
+
+        empty_dir(str(channel.out_dir))
+        return ArchiveStream(channel_path, channel_files, archive_path, bounded_memory, save_build_cache,
+                             stats=channel_files, compression=compression, max_workers=max_workers,
+                             sources=sources, entry_cache=entry_cache)
+    elif changes["changed"] or changes["removed"] or previous_archive_path != archive_path:
+        click.echo(f'updating {len(changes["changed"])} changed and {len(changes["removed"])} removed files in archive')
+        update_archive(previous_archive_path, archive_path, channel_path, changes["changed"], changes["removed"],
+                       compression, max_workers, sources, entry_cache)
     else:
-        os.mkdir(stage_dir_path)
+        click.echo('no channel changes since last build, skipping archive')
+
+    build_cache.update(file_states, archive_path.name, settings)
+    build_cache.save()
+    store_build()
 
-    for content_path in glob_array:
-        copy_content_to_staging_dir(channel_path, content_path)
+    return archive_path
 
 
-def copy_content_to_staging_dir(channel_path, content_path):
+def stored_build(channel, store, reference):
     """
-    Copies files defined in channel config to the staging in preparation
-    for archiving
-    :param channel_path: String - path to the channel root
-    :param content_path: String - path of the content defined in channel config
-    :return:
+    Takes a build from the artifact store instead of building the channel
+    :param channel: Object - Channel the build was made from
+    :param store: Object - ArtifactStore
+    :param reference: String - key prefix or manifest version of the build
+    :return: Object - path object to the stored archive
     """
-    for from_path in glob.glob(os.path.join(channel_path, content_path)):
-        from_path = Path(from_path)
-        to_path = channel_path / STAGE_DIR / from_path.relative_to(channel_path)
+    match = store.find(reference, channel.channel_path)
+    archive_path = store.get(match[0]) if match else None
+    if archive_path is None:
+        raise click.ClickException(f'no stored build of {channel.channel_path} matches {reference}, '
+                                   f'see rokuPi builds list')
 
-        if from_path.is_file():
-            if not to_path.parent.exists():
-                os.mkdir(str(to_path.parent))
+    key, entry = match
+    click.echo(f'deploying stored build {key[:12]} of {entry["title"]} {entry["version"]}')
+    channel.manifest_data = entry["manifest"]
+    channel.build_fingerprint = entry["fingerprint"]
+    channel.archive_path = archive_path
 
-            try:
-                shutil.copyfile(str(from_path), str(to_path))
-            except FileNotFoundError:
-                click.echo(f'failed to copy {str(from_path)} into staging')
-        elif from_path.is_dir():
-            copy_tree(str(from_path), str(to_path))
-        else:
-            click.echo(f'failed to copy {str(from_path)} into staging')
+    return archive_path
 
 
-def archive_staged_content_to_out(staging_dir_path, out_dir_path):
+def build_channel(channel_path, build_cache=None, force_rebuild=False, store=None, entry_cache_dir=None,
+                  max_workers=None):
     """
-    Creates an archive out of the contents in the staging directory
-    :param staging_dir_path: Object path object to staging dir with to be zipped
-    :param out_dir_path: Object path object to where the archive is going
-    :return:
+    Builds a channel archive into out without deploying it, used by the serve daemon and the build command
+    :param channel_path: String - path to channel root
+    :param build_cache: Object - BuildCache kept between builds
+    :param force_rebuild: Bool - ignore the build cache
+    :param store: Object - ArtifactStore builds are taken from and added to
+    :param entry_cache_dir: Object - directory of deflated entries shared between channels
+    :param max_workers: Int - compression processes
+    :return: Object - Channel with manifest data and build fingerprint set
+    """
+    channel = Channel(channel_path)
+    if channel.config_file is None:
+        raise ValueError(f'{channel_path} has no {CONFIG_FILE}')
+    channel.set_config_file_data()
+    channel.manifest_data = parse_manifest(channel.channel_path / 'manifest')
+    try:
+        channel_archive = prepare_channel_archive(channel, force_rebuild, build_cache=build_cache, store=store,
+                                                  entry_cache_dir=entry_cache_dir, max_workers=max_workers)
+    except click.ClickException as e:
+        raise ValueError(e.format_message())
+    if isinstance(channel_archive, ArchiveStream):
+        for _ in channel_archive:
+            pass
+
+    return channel
+
+
+def expand_channel_paths(patterns):
+    """
+    Resolves the channel arguments of the build command, each one a channel root or a glob
+    such as channels/* matching several, directories without a manifest are skipped
+    :param patterns: Tuple - paths and glob patterns
+    :return: List - path objects to the channel roots in argument order, without duplicates
+    """
+    channel_paths = {}
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            path = Path(match)
+            if (path / 'manifest').is_file():
+                channel_paths.setdefault(path.resolve(), path)
+
+    return list(channel_paths.values())
+
+
+def build_channel_job(channel_path, force_rebuild=False, entry_cache_dir=None, max_workers=1, store_dir=None):
+    """
+    Process pool worker of the build command, builds one channel in its own process with its
+    own build cache and out directory, the output is captured so channels do not interleave
+    :return: Dictionary - channel, archive path, size, seconds, captured output and an error for failed builds
+    """
+    output = io.StringIO()
+    started = time.perf_counter()
+    result = {"channel": str(channel_path), "archive": None, "size": None, "error": None}
+    try:
+        with contextlib.redirect_stdout(output):
+            channel = build_channel(channel_path, force_rebuild=force_rebuild, store=ArtifactStore(store_dir),
+                                    entry_cache_dir=entry_cache_dir, max_workers=max_workers)
+        archive_path = channel.get_channel_archive()
+        result["archive"] = str(archive_path)
+        result["size"] = archive_path.stat().st_size
+    except (ValueError, OSError) as e:
+        result["error"] = f'{type(e).__name__}: {e}'
+    result["seconds"] = time.perf_counter() - started
+    result["messages"] = output.getvalue().splitlines()
+
+    return result
+
+
+def build_channels(channel_paths, jobs=None, force_rebuild=False, entry_cache_dir=None, store_dir=None):
+    """
+    Builds several channels at once, one process per channel so packaging is not held by the
+    GIL, sharing the entry cache so files common to channel variants are compressed once
+    :param channel_paths: List - path objects to channel roots
+    :param jobs: Int - channels built at the same time, None for one per cpu
+    :param force_rebuild: Bool - ignore the build caches
+    :param entry_cache_dir: Object - directory of deflated entries shared between channels
+    :param store_dir: Object - artifact store directory, None for the per user store
+    :return: Tuple - results of build_channel_job in channel order and the wall clock seconds
     """
-    if not out_dir_path.parent.exists():
-        os.mkdir(str(out_dir_path.parent))
+    jobs = min(jobs or os.cpu_count() or 1, len(channel_paths))
+    # with fewer channels than cpus each channel may use the spare cpus for compression
+    max_workers = max(1, (os.cpu_count() or 1) // jobs)
+    started = time.perf_counter()
+    if jobs <= 1:
+        results = [build_channel_job(path, force_rebuild, entry_cache_dir, max_workers, store_dir)
+                   for path in channel_paths]
+    else:
+        job = functools.partial(build_channel_job, force_rebuild=force_rebuild, entry_cache_dir=entry_cache_dir,
+                                max_workers=max_workers, store_dir=store_dir)
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(job, channel_paths))
 
-    if out_dir_path.parent.exists():
-        empty_dir(str(out_dir_path.parent))
+    return results, time.perf_counter() - started
 
-    shutil.make_archive(out_dir_path, 'zip', staging_dir_path)
+
+def select_fleet_devices(channel, roku_ips, non_interactive=False):
+    """
+    Collects the devices for a fleet deploy, either several --roku-ip flags sharing one
+    password or the devices list in channel config
+    :param channel: Object - Channel with config data set
+    :param roku_ips: Tuple - ip addresses passed on the command line
+    :param non_interactive: Bool - take the password from the environment without prompting
+    :return: List - device dictionaries, empty when deploying to a single device
+    """
+    if len(roku_ips) > 1:
+        for roku_ip in roku_ips:
+            try:
+                ipaddress.ip_address(roku_ip)
+            except ValueError:
+                raise click.BadParameter(f'{roku_ip} needs to be in IPV4 format', param_hint='--roku-ip')
+        password = device_password(non_interactive)
+        return [{
+            "name": roku_ip,
+            "username": device_username(),
+            "password": password,
+            "ip_address": roku_ip
+        } for roku_ip in roku_ips]
+
+    if not roku_ips and channel.config_data.get("devices"):
+        devices = channel.config_data["devices"]
+        # devices saved without a password share one, asked for once like the --roku-ip list
+        password = device_password(non_interactive) if any(not device.get("password") for device in devices) else ''
+        return [{"name": device["ip_address"], "username": device_username(), **device,
+                 "password": device.get("password") or password}
+                for device in devices]
+
+    return []
 
 
 def handle_yes_no_response(response):
@@ -212,7 +508,138 @@ def handle_yes_no_response(response):
         return False
 
 
-@click.command()
+def install_on_device(roku, channel, channel_archive, registry, force_deploy=False):
+    """
+    Installs the prepared archive on one device unless it already runs this build
+    :param roku: Object - Roku to deploy to
+    :param channel: Object - Channel with its build fingerprint set
+    :param channel_archive: Object - result of prepare_channel_archive
+    :param registry: Object - DeviceRegistry holding installed builds
+    :param force_deploy: Bool - upload even when the device already runs this build
+    :return: Bool - whether the build is on the device
+    """
+    with trace('preflight', 'device', device=roku.device_data["ip_address"]):
+        installed, serial_number = check_installed_build(roku, registry, channel)
+    if installed and not force_deploy:
+        click.echo(f'{channel.__str__()} is already installed on {roku.device_data["ip_address"]}, skipping upload')
+        if isinstance(channel_archive, ArchiveStream) and channel_archive.archive_path is not None:
+            for _ in channel_archive:
+                pass
+        registry.save()
+        return True
+
+    with trace('install', 'device', device=roku.device_data["ip_address"]) as span:
+        install_result = roku.install_channel(
+            channel, channel_archive if isinstance(channel_archive, ArchiveStream) else None)
+        span["status"] = install_result["status"]
+    for message in install_result["messages"]:
+        click.echo(message)
+    click.echo(f'install finished with status {install_result["status"]} in {install_result["elapsed"]:.2f}s')
+    succeeded = install_succeeded(install_result)
+    if succeeded and serial_number is not None:
+        registry.record_install(serial_number, channel)
+    registry.save()
+
+    return succeeded
+
+
+def install_on_fleet(devices, channel, channel_archive, registry, force_deploy=False, max_concurrency=8,
+                     device_timeout=120.0, retries=2, report_json=None, rokus=None):
+    """
+    Installs the prepared archive on several devices and prints a summary
+    :return: Bool - whether every device runs the build
+    """
+    if isinstance(channel_archive, ArchiveStream):
+        for _ in channel_archive:
+            pass
+    results = deploy_to_fleet(devices, channel, max_concurrency, device_timeout, retries, registry=registry,
+                              rokus=rokus, force=force_deploy)
+    echo_fleet_summary(results)
+    if report_json:
+        write_fleet_report(results, report_json)
+
+    return all(result["ok"] for result in results)
+
+
+def watch_channel(channel, build_archive, install_build, debounce=DEBOUNCE):
+    """
+    Rebuilds and redeploys the channel every time a burst of saves settles, until interrupted.
+    The archive is updated incrementally from the build cache and install_build reuses the
+    clients of the first deploy so their connections and digest nonce stay warm
+    :param channel: Object - Channel with manifest and config data set
+    :param build_archive: Function - prepares the archive, returns the result of prepare_channel_archive
+    :param install_build: Function - installs a prepared archive, returns whether it succeeded
+    :param debounce: Float - seconds without changes that end a burst of saves
+    """
+    watcher = create_watcher(channel.channel_path, channel.config_data["files"], collect_channel_files)
+    click.echo(f'watching {channel.channel_path} for changes, press Ctrl+C to stop')
+    try:
+        while True:
+            first_change, changes = watcher.wait_for_change(debounce)
+            click.echo(f'{len(changes)} changed: {", ".join(sorted(changes)[:5])}{" ..." if len(changes) > 5 else ""}')
+            try:
+                channel.manifest_data = parse_manifest(channel.channel_path / 'manifest')
+                channel_archive = build_archive()
+                succeeded = install_build(channel_archive)
+            except (OSError, ValueError, IndexError, eTree.ParseError, click.ClickException,
+                    urllib3.exceptions.HTTPError) as e:
+                # a half written manifest or config is normal while editing, the next save retries
+                click.echo(f'redeploy failed: {type(e).__name__}: {e}')
+                continue
+            click.echo(f'{"deployed" if succeeded else "deploy FAILED"} {time.time() - first_change:.2f}s after save')
+    except KeyboardInterrupt:
+        click.echo('stopped watching')
+    finally:
+        watcher.close()
+
+
+def report_launch_times(rokus, runs, ready, marker, max_launch=None):
+    """
+    Times cold launches of the freshly installed dev channel on every device and prints
+    the distribution per device
+    :param rokus: List - Roku clients the build was installed with
+    :param runs: Int - launches per device
+    :param ready: String - one of READY_CONDITIONS
+    :param marker: String - debug console text that counts as ready
+    :param max_launch: Float - seconds the p95 launch time may take, None for no limit
+    :return: Bool - whether every launch finished within the limit
+    """
+    with trace('launch_timing', runs=runs):
+        measurements = measure_launch_on_devices(rokus, runs, ready=ready, marker=marker)
+    passed = True
+    for measurement in measurements:
+        summary = launch_summary(measurement["results"])
+        click.echo(f'{measurement["device"]}: launch to {ready} in {summary["count"]} runs, '
+                   f'min {summary["min"]:.2f}s mean {summary["mean"]:.2f}s p95 {summary["p95"]:.2f}s '
+                   f'max {summary["max"]:.2f}s')
+        for result in measurement["results"]:
+            if result["error"]:
+                click.echo(f'  run {result["run"]} failed: {result["error"]}')
+        if summary["failed"] or (max_launch is not None and summary["p95"] > max_launch):
+            passed = False
+
+    return passed
+
+
+def report_profile(profile, trace_file):
+    """
+    Prints the phase summary and writes the trace once the command finished, also when it
+    exited early or was interrupted
+    """
+    if profile:
+        for line in TRACER.summary_lines():
+            click.echo(line)
+    if trace_file:
+        TRACER.write_chrome_trace(trace_file)
+        click.echo(f'trace written to {trace_file}')
+
+
+@click.group(cls=DefaultCommandGroup)
+def cli():
+    pass
+
+
+@cli.command()
 @click.option('-c',
               '--channel',
               'channel_path',
@@ -220,16 +647,131 @@ def handle_yes_no_response(response):
               required=True)
 @click.option('-ip',
               '--roku-ip',
-              'roku_ip',
-              help='Ip address to roku',
+              'roku_ips',
+              help='Ip address to roku, repeat to deploy to several devices',
+              multiple=True,
               required=False)
-def deploy(channel_path, roku_ip):
-    f = Figlet(font='slant')
-    click.echo(f.renderText('RokuPi'))
+@click.option('--subnet',
+              'subnet',
+              help='subnet in CIDR notation to sweep when no device answers the SSDP search')
+@click.option('--registry-ttl',
+              'registry_ttl',
+              default=REGISTRY_TTL,
+              show_default=True,
+              help='seconds a known device is offered without scanning the network')
+@click.option('--force-rebuild',
+              'force_rebuild',
+              is_flag=True,
+              help='ignore the build cache and rebuild the channel archive')
+@click.option('--force-deploy',
+              'force_deploy',
+              is_flag=True,
+              help='upload even when the device already runs this build')
+@click.option('--out/--no-out',
+              'write_out',
+              default=True,
+              help='write a streamed archive to the out dir while uploading')
+@click.option('--bounded-memory',
+              'bounded_memory',
+              is_flag=True,
+              help='cap memory used by a streamed archive, packaging waits on a slow upload')
+@click.option('--max-concurrency',
+              'max_concurrency',
+              default=8,
+              show_default=True,
+              help='devices uploading at the same time during a fleet deploy')
+@click.option('--device-timeout',
+              'device_timeout',
+              default=120.0,
+              show_default=True,
+              help='seconds a device may take during a fleet deploy, no retry starts after them')
+@click.option('--retries',
+              'retries',
+              default=2,
+              show_default=True,
+              help='retries per device during a fleet deploy')
+@click.option('--report-json',
+              'report_json',
+              type=click.Path(dir_okay=False),
+              help='write the fleet deploy results to a json file')
+@click.option('--optimize',
+              'optimize',
+              is_flag=True,
+              help='minify BrightScript and xml and recompress images before archiving')
+@click.option('--strip-debug',
+              'strip_debug',
+              is_flag=True,
+              help='with --optimize, also drop #if DEBUG blocks and print statements')
+@click.option('--non-interactive',
+              'non_interactive',
+              is_flag=True,
+              envvar='ROKUPI_NON_INTERACTIVE',
+              help=f'never prompt, the device comes from --roku-ip or config and its password from {PASSWORD_ENV}')
+@click.option('--structure',
+              'structure',
+              help='comma separated channel globs for a config created by a non-interactive run')
+@click.option('--profile',
+              'profile',
+              is_flag=True,
+              help='print the time spent in every deploy phase')
+@click.option('--trace-file',
+              'trace_file',
+              type=click.Path(dir_okay=False),
+              help='write deploy phases as a Chrome trace json file')
+@click.option('--build',
+              'build',
+              help='deploy an earlier build from the artifact store, by key prefix or manifest version')
+@click.option('--launch-runs',
+              'launch_runs',
+              default=0,
+              show_default=True,
+              help='after installing, time this many cold launches of the dev channel on every device')
+@click.option('--launch-ready',
+              'launch_ready',
+              type=click.Choice(READY_CONDITIONS),
+              default='active-app',
+              show_default=True,
+              help='what counts as launched, the channel in the foreground, video playing or a console marker')
+@click.option('--launch-marker',
+              'launch_marker',
+              default=LAUNCH_MARKER,
+              show_default=True,
+              help='debug console text that marks the channel as launched with --launch-ready console')
+@click.option('--max-launch',
+              'max_launch',
+              type=float,
+              help='fail when the p95 launch time of a device goes over this many seconds')
+@click.option('--watch',
+              'watch',
+              is_flag=True,
+              help='keep running and redeploy whenever channel files change')
+@click.option('--debounce',
+              'debounce',
+              default=DEBOUNCE,
+              show_default=True,
+              help='seconds without changes before a watched save is redeployed')
+def deploy(channel_path, roku_ips, subnet, registry_ttl, force_rebuild, force_deploy, write_out, bounded_memory,
+           max_concurrency, device_timeout, retries, report_json, optimize, strip_debug, non_interactive, structure,
+           profile, trace_file, build, launch_runs, launch_ready, launch_marker, max_launch, watch, debounce):
+    """
+    Packages a channel and deploys it to one or more devices
+    """
+    if build and watch:
+        raise click.UsageError('--build deploys a stored build and cannot be combined with --watch')
+    if profile or trace_file:
+        TRACER.enable()
+        click.get_current_context().call_on_close(lambda: report_profile(profile, trace_file))
+    if not non_interactive:
+        echo_banner()
     current_channel = Channel(channel_path)
 
     # create config if non-existent
-    if current_channel.config_file is None:
+    if current_channel.config_file is None and non_interactive:
+        channel_structure = [pattern.strip() for pattern in structure.split(',')] if structure \
+            else STANDARD_CHANNEL_STRUCTURE
+        click.echo(f'creating {CONFIG_FILE} with {channel_structure}')
+        create_config_file(channel_structure, current_channel.channel_path)
+    elif current_channel.config_file is None:
         create_config_response = click.prompt('Would like to create config file y/n ', type=str, default='y')
 
         if handle_yes_no_response(create_config_response):
@@ -256,26 +798,59 @@ def deploy(channel_path, roku_ip):
                     click.echo(f'please use an array of files {example}')
 
     # Parse manifest for data
-    current_channel.manifest_data = parse_manifest(current_channel.channel_path / 'manifest')
+    with trace('parse_manifest'):
+        current_channel.manifest_data = parse_manifest(current_channel.channel_path / 'manifest')
     current_channel.set_config_file_data()
 
-    # Stage channel contents and create archive
-    stage_channel_contents(current_channel.channel_path, current_channel.config_data["files"])
-    stage_dir_path = current_channel.channel_path / STAGE_DIR
-    out_dir = current_channel.channel_path / 'out' / current_channel.__str__()
-    archive_staged_content_to_out(stage_dir_path, out_dir)
+    # several devices get the same archive so it has to be built once in out
+    fleet = select_fleet_devices(current_channel, roku_ips, non_interactive)
+
+    # Reuse or update the last build, take an earlier one from the store, or stream a new archive during upload
+    optimizer = AssetOptimizer(strip_debug) if optimize or strip_debug else None
+    store = ArtifactStore()
+    if build:
+        channel_archive = stored_build(current_channel, store, build)
+    else:
+        channel_archive = prepare_channel_archive(current_channel, force_rebuild, write_out or bool(fleet) or watch,
+                                                  bounded_memory, optimizer, store=store)
+
+    def build_archive():
+        return prepare_channel_archive(current_channel, False, True, bounded_memory, optimizer, store=store)
 
-    # empty stage dir and remove
-    empty_dir(str(stage_dir_path))
-    stage_dir_path.rmdir()
+    registry = DeviceRegistry(ttl=registry_ttl)
+    if fleet:
+        rokus = {}
+
+        def install_build(archive):
+            succeeded = install_on_fleet(fleet, current_channel, archive, registry, force_deploy, max_concurrency,
+                                         device_timeout, retries, report_json, rokus)
+            if succeeded and launch_runs:
+                succeeded = report_launch_times(list(rokus.values()), launch_runs, launch_ready, launch_marker,
+                                                max_launch)
+            return succeeded
+
+        succeeded = install_build(channel_archive)
+        if watch:
+            watch_channel(current_channel, build_archive, install_build, debounce)
+        elif not succeeded:
+            click.get_current_context().exit(1)
+        return
 
     # device selection
+    roku_ip = roku_ips[0] if roku_ips else None
     if roku_ip is None:
         device_selection_results = None
         # No device defined in config
         if "device" not in current_channel.config_data.keys() or not bool(current_channel.config_data["device"]):
-            device_selection_results = device_selection()
+            if non_interactive:
+                raise click.UsageError(f'no device to deploy to, pass --roku-ip or save a device in {CONFIG_FILE}')
+            device_selection_results = device_selection(registry, subnet)
             device = device_selection_results["device"]
+        # using the device defined in config without asking
+        elif non_interactive:
+            device = dict(current_channel.config_data["device"])
+            if PASSWORD_ENV in os.environ:
+                device["password"] = os.environ[PASSWORD_ENV]
         # using device defined in config
         else:
             current_channel.set_config_file_data()
@@ -285,7 +860,7 @@ def deploy(channel_path, roku_ip):
                                            default='y')
             # not using device in config but there is one
             if not handle_yes_no_response(use_config_roku):
-                device_selection_results = device_selection()
+                device_selection_results = device_selection(registry, subnet)
                 device = device_selection_results["device"]
         # scanning/manual input device saving
         if device_selection_results and device_selection_results["write_to_config"]:
@@ -294,15 +869,14 @@ def deploy(channel_path, roku_ip):
     else:
         device = {
             "name": ' ',
-            "username": 'rokudev',
+            "username": device_username(),
             "password": '',
             "ip_address": roku_ip
         }
         try:
             # validate ip
             if ipaddress.ip_address(device["ip_address"]):
-                device_password = click.prompt('device password', type=str, hide_input=True)
-                device["password"] = device_password
+                device["password"] = device_password(non_interactive)
             else:
                 click.echo("IP address needs to be in IPV4 format")
         except ValueError:
@@ -311,7 +885,11 @@ def deploy(channel_path, roku_ip):
         data_from_device = query_ip_address_for_device_info(roku_ip)
         if data_from_device is None:
             click.echo("Unable to establish connection with device")
+            if non_interactive:
+                click.get_current_context().exit(1)
             return
+        elif non_interactive:
+            device["name"] = data_from_device["value"]["name"]
         else:
             device["name"] = data_from_device["value"]["name"]
             save_device = click.prompt('Do you want to save this device y/n',  type=str, default='y')
@@ -320,9 +898,598 @@ def deploy(channel_path, roku_ip):
                 current_channel.set_config_file_data()
 
     roku = Roku(device)
-    roku.delete_channel()
-    roku.deploy_channel(current_channel)
+
+    def install_build(archive):
+        succeeded = install_on_device(roku, current_channel, archive, registry, force_deploy)
+        if succeeded and launch_runs:
+            succeeded = report_launch_times([roku], launch_runs, launch_ready, launch_marker, max_launch)
+        return succeeded
+
+    succeeded = install_build(channel_archive)
+    if watch:
+        watch_channel(current_channel, build_archive, install_build, debounce)
+    elif not succeeded:
+        # a failed install, or a slow launch with --launch-runs, fails the run
+        click.get_current_context().exit(1)
+
+
+def channel_devices(channel_path, roku_ips):
+    """
+    Devices for commands that act on several devices, --roku-ip flags first and the
+    devices saved in channel config otherwise
+    :param channel_path: String - path to channel root, may be None
+    :param roku_ips: Tuple - ip addresses passed on the command line
+    :return: List - device dictionaries
+    """
+    if roku_ips:
+        return [{"name": roku_ip, "username": device_username(), "password": '', "ip_address": roku_ip}
+                for roku_ip in roku_ips]
+    if channel_path is None:
+        return []
+
+    channel = Channel(channel_path)
+    if channel.config_file is None:
+        return []
+    channel.set_config_file_data()
+    if channel.config_data.get("devices"):
+        return [{"name": device["ip_address"], "username": device_username(), "password": '', **device}
+                for device in channel.config_data["devices"]]
+    if channel.config_data.get("device"):
+        return [channel.config_data["device"]]
+
+    return []
+
+
+@cli.command('keys')
+@click.option('-s',
+              '--script',
+              'script_file',
+              type=click.File('r'),
+              required=True,
+              help='key script to run, - reads stdin')
+@click.option('-ip',
+              '--roku-ip',
+              'roku_ips',
+              multiple=True,
+              help='Ip address to roku, repeat to run on several devices')
+@click.option('-c',
+              '--channel',
+              'channel_path',
+              help='use the devices saved in this channel config')
+@click.option('--max-concurrency',
+              'max_concurrency',
+              default=8,
+              show_default=True,
+              help='devices driven at the same time')
+@click.option('--json',
+              'as_json',
+              is_flag=True,
+              help='print every command result as json')
+def run_keys(script_file, roku_ips, channel_path, max_concurrency, as_json):
+    """
+    Runs a key script on one or more devices and reports round trip latency
+    """
+    try:
+        commands = parse_script(script_file.read())
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--script')
+    devices = channel_devices(channel_path, roku_ips)
+    if not devices:
+        raise click.UsageError('pass --roku-ip or a channel with saved devices')
+
+    runs = run_script_on_devices(devices, commands, max_concurrency)
+    if as_json:
+        click.echo(json.dumps(runs, indent=4))
+    else:
+        for run in runs:
+            summary = latency_summary(run["results"])
+            click.echo(f'{run["device"]["ip_address"]}: {summary["count"]} requests, '
+                       f'min {summary["min"]:.1f}ms mean {summary["mean"]:.1f}ms '
+                       f'p95 {summary["p95"]:.1f}ms max {summary["max"]:.1f}ms'
+                       f'{"  " + run["error"] if run["error"] else ""}')
+    if any(run["error"] for run in runs):
+        click.get_current_context().exit(1)
+
+
+@cli.command('perf')
+@click.option('-ip',
+              '--roku-ip',
+              'roku_ips',
+              multiple=True,
+              help='Ip address to roku, repeat to sample several devices at once')
+@click.option('-c',
+              '--channel',
+              'channel_path',
+              help='use the devices saved in this channel config')
+@click.option('--app-id',
+              'app_id',
+              default='dev',
+              show_default=True,
+              help='channel to launch and sample')
+@click.option('--duration',
+              default=30.0,
+              show_default=True,
+              help='seconds to sample for')
+@click.option('--interval',
+              default=1.0,
+              show_default=True,
+              help='seconds between samples')
+@click.option('--warmup',
+              default=2.0,
+              show_default=True,
+              help='seconds between launching the channel and the first sample')
+@click.option('--launch/--no-launch',
+              default=True,
+              help='launch the channel before sampling')
+@click.option('-o',
+              '--output',
+              'output',
+              type=click.Path(dir_okay=False),
+              help='write every sample to a .csv, .json or .parquet file')
+@click.option('--max',
+              'thresholds',
+              multiple=True,
+              help='fail when a summary goes over a limit, metric[.stat]=value such as cpu_total.p95=40, '
+                   'repeat for several')
+def perf(roku_ips, channel_path, app_id, duration, interval, warmup, launch, output, thresholds):
+    """
+    Samples channel cpu, memory and texture memory over ECP and summarises it per device
+    """
+    try:
+        thresholds = parse_thresholds(thresholds)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--max')
+    if interval <= 0:
+        raise click.BadParameter('must be positive', param_hint='--interval')
+    devices = channel_devices(channel_path, roku_ips)
+    if not devices:
+        raise click.UsageError('pass --roku-ip or a channel with saved devices')
+
+    runs = sample_devices(devices, app_id, duration, interval, launch, warmup)
+    for line in perf_report_lines(runs):
+        click.echo(line)
+    if output:
+        try:
+            write_series(runs, output)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+    violations = check_thresholds(runs, thresholds)
+    for violation in violations:
+        click.echo(f'threshold exceeded, {violation}')
+    if violations or any(run["error"] for run in runs):
+        click.get_current_context().exit(1)
+
+
+@cli.command('logs')
+@click.option('-ip',
+              '--roku-ip',
+              'roku_ips',
+              multiple=True,
+              help='Ip address to roku, repeat to follow several devices')
+@click.option('-c',
+              '--channel',
+              'channel_path',
+              help='use the devices saved in this channel config')
+@click.option('-g',
+              '--grep',
+              'includes',
+              multiple=True,
+              help='only show lines matching this regex, repeat to match any of several')
+@click.option('-x',
+              '--exclude',
+              'excludes',
+              multiple=True,
+              help='hide lines matching this regex, repeat for several')
+@click.option('-i',
+              '--ignore-case',
+              'ignore_case',
+              is_flag=True,
+              help='match --grep and --exclude regardless of case')
+@click.option('-o',
+              '--output',
+              'output',
+              type=click.Path(dir_okay=False),
+              help='write to this file instead of the terminal, rotated by size')
+@click.option('--max-bytes',
+              'max_bytes',
+              default=ROTATE_BYTES,
+              show_default=True,
+              help='size at which --output is rotated')
+@click.option('--backups',
+              'backups',
+              default=ROTATE_BACKUPS,
+              show_default=True,
+              help='rotated --output files kept')
+@click.option('--buffer-lines',
+              'buffer_lines',
+              default=BUFFER_LINES,
+              show_default=True,
+              help='lines held per device while the output catches up, older lines are dropped past it')
+@click.option('--duration',
+              type=float,
+              help='stop after this many seconds instead of at Ctrl+C')
+def logs(roku_ips, channel_path, includes, excludes, ignore_case, output, max_bytes, backups, buffer_lines,
+         duration):
+    """
+    Follows the BrightScript debug console of one or more devices with timestamped, interleaved lines
+    """
+    try:
+        line_filter = LineFilter(includes, excludes, ignore_case)
+    except re.error as e:
+        raise click.BadParameter(str(e), param_hint='--grep/--exclude')
+    devices = channel_devices(channel_path, roku_ips)
+    if not devices:
+        raise click.UsageError('pass --roku-ip or a channel with saved devices')
+
+    writer = RotatingWriter(output, max_bytes, backups) if output else None
+
+    def write_lines(lines):
+        if writer is None:
+            click.echo('\n'.join(lines))
+            return
+        for line in lines:
+            writer.write(line + '\n')
+        writer.flush()
+
+    try:
+        device_logs = stream_logs(devices, write_lines, line_filter, buffer_lines, duration)
+    finally:
+        if writer is not None:
+            writer.close()
+    for device_log in device_logs:
+        click.echo(f'{device_log.name}: {device_log.received} lines, {device_log.filtered} filtered, '
+                   f'{device_log.dropped} dropped', err=True)
+
+
+@cli.command('screenshot')
+@click.option('-ip',
+              '--roku-ip',
+              'roku_ips',
+              multiple=True,
+              help='Ip address to roku, repeat to capture several devices at once')
+@click.option('-c',
+              '--channel',
+              'channel_path',
+              help='use the devices saved in this channel config')
+@click.option('-s',
+              '--script',
+              'script_file',
+              type=click.File('r'),
+              help='key script with capture NAME lines, the steps before each capture run first')
+@click.option('-o',
+              '--output',
+              'output_dir',
+              default='screenshots',
+              show_default=True,
+              type=click.Path(file_okay=False),
+              help='directory screenshots are written to, one directory per device')
+@click.option('--baseline',
+              'baseline_dir',
+              type=click.Path(exists=True, file_okay=False),
+              help='directory of earlier screenshots in the same layout to compare with')
+@click.option('--threshold',
+              default=CHANGE_THRESHOLD,
+              show_default=True,
+              help='image hash bits that may differ before a screen counts as changed')
+@click.option('--max-concurrency',
+              'max_concurrency',
+              default=8,
+              show_default=True,
+              help='devices captured at the same time')
+@click.option('--json',
+              'as_json',
+              is_flag=True,
+              help='print every capture result as json')
+@click.option('--non-interactive',
+              'non_interactive',
+              is_flag=True,
+              envvar='ROKUPI_NON_INTERACTIVE',
+              help=f'never prompt, read the device password from {PASSWORD_ENV}')
+def screenshot(roku_ips, channel_path, script_file, output_dir, baseline_dir, threshold, max_concurrency, as_json,
+               non_interactive):
+    """
+    Takes screenshots of the dev channel on several devices at once and flags screens that
+    changed from a baseline
+    """
+    try:
+        captures = parse_capture_script(script_file.read() if script_file else '')
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--script')
+    devices = channel_devices(channel_path, roku_ips)
+    if not devices:
+        raise click.UsageError('pass --roku-ip or a channel with saved devices')
+    if any(not device.get("password") for device in devices):
+        password = device_password(non_interactive)
+        devices = [{**device, "username": device.get("username") or device_username(),
+                    "password": device.get("password") or password} for device in devices]
+
+    runs, seconds = capture_devices(devices, captures, output_dir, baseline_dir, threshold, max_concurrency)
+    if as_json:
+        click.echo(json.dumps(runs, indent=4))
+    else:
+        for line in screenshot_report_lines(runs):
+            click.echo(line)
+        click.echo(f'captured {sum(len(run["captures"]) for run in runs)} screenshots in {seconds:.2f}s')
+    if any(run["error"] or any(capture["changed"] for capture in run["captures"]) for run in runs):
+        click.get_current_context().exit(1)
+
+
+@cli.command('build')
+@click.argument('channels', nargs=-1, required=True)
+@click.option('-j',
+              '--jobs',
+              type=click.IntRange(min=1),
+              help='channels built at the same time, defaults to one per cpu')
+@click.option('--force-rebuild',
+              is_flag=True,
+              help='ignore the build caches and rebuild every channel from scratch')
+@click.option('--entry-cache/--no-entry-cache',
+              'use_entry_cache',
+              default=True,
+              help='share compressed files between channels and builds')
+@click.option('--entry-cache-bytes',
+              'entry_cache_bytes',
+              default=ENTRY_CACHE_MAX_BYTES,
+              show_default=True,
+              help='size of the entry cache past which the least recently used entries are removed')
+@click.option('--report-json',
+              'report_json',
+              type=click.Path(dir_okay=False),
+              help='write the per channel results and timings to a json file')
+def build(channels, jobs, force_rebuild, use_entry_cache, entry_cache_bytes, report_json):
+    """
+    Builds the archives of several channels in parallel without deploying them, CHANNELS are
+    channel roots or globs such as channels/*
+    """
+    channel_paths = expand_channel_paths(channels)
+    if not channel_paths:
+        raise click.UsageError(f'no channel with a manifest matches {" ".join(channels)}')
+
+    entry_cache_dir = default_entry_cache_dir() if use_entry_cache else None
+    results, wall_seconds = build_channels(channel_paths, jobs, force_rebuild, entry_cache_dir)
+    if entry_cache_dir is not None:
+        trim_entry_cache(entry_cache_dir, entry_cache_bytes)
+
+    width = max(len(result["channel"]) for result in results)
+    for result in results:
+        for message in result["messages"]:
+            click.echo(f'{result["channel"]}: {message}')
+    click.echo(f'{"channel":<{width}} {"seconds":>8} {"size":>12}  archive')
+    for result in results:
+        outcome = result["error"] or result["archive"]
+        size = f'{result["size"]:,}' if result["size"] is not None else '-'
+        click.echo(f'{result["channel"]:<{width}} {result["seconds"]:>8.2f} {size:>12}  {outcome}')
+    channel_seconds = sum(result["seconds"] for result in results)
+    click.echo(f'built {len(results)} channels in {wall_seconds:.2f}s, {channel_seconds:.2f}s of channel builds, '
+               f'{channel_seconds / wall_seconds if wall_seconds else 1.0:.1f}x')
+    if report_json:
+        with open(report_json, 'w') as report_file:
+            json.dump({"channels": results, "wall_seconds": wall_seconds, "channel_seconds": channel_seconds},
+                      report_file, indent=4)
+    if any(result["error"] for result in results):
+        click.get_current_context().exit(1)
+
+
+@cli.command('serve')
+@click.option('--socket',
+              'socket_path',
+              type=click.Path(dir_okay=False),
+              help=f'Unix socket to listen on, defaults to ~/{USER_DATA_DIR}/serve.sock without --port')
+@click.option('--port',
+              type=int,
+              help='also or only listen for HTTP on this port')
+@click.option('--host',
+              default='127.0.0.1',
+              show_default=True,
+              help=f'address the HTTP port binds to, anything but loopback needs {SERVE_TOKEN_ENV}')
+@click.option('--registry-ttl',
+              'registry_ttl',
+              default=REGISTRY_TTL,
+              show_default=True,
+              help='seconds a known device counts as fresh')
+def serve(socket_path, port, host, registry_ttl):
+    """
+    Runs a deploy daemon that keeps device connections, the registry and build caches warm between CI jobs
+    """
+    if socket_path is None and port is None:
+        socket_path = default_socket_path()
+    token = os.environ.get(SERVE_TOKEN_ENV) or None
+    if port is not None and token is None and not is_loopback(host):
+        # the daemon deploys with the operator's device credentials, the network needs a token
+        raise click.BadParameter(f'set {SERVE_TOKEN_ENV} to serve on {host}, requests then need '
+                                 f'an Authorization: Bearer header with it', param_hint='--host')
+    daemon = DeployDaemon(DeviceRegistry(ttl=registry_ttl), functools.partial(build_channel, store=ArtifactStore()),
+                          device_username(), os.environ.get(PASSWORD_ENV, ''))
+    servers = start_servers(daemon, socket_path, host, port, token)
+    for server in servers:
+        address = server.server_address
+        click.echo(f'listening on {address if isinstance(address, str) else f"http://{address[0]}:{address[1]}"}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        click.echo('stopping')
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        daemon.close()
+        if socket_path is not None and os.path.exists(str(socket_path)):
+            os.unlink(str(socket_path))
+
+
+@cli.command('status')
+@click.option('-ip',
+              '--roku-ip',
+              'roku_ips',
+              multiple=True,
+              help='Ip address to roku, repeat for several, defaults to every known device')
+@click.option('-c',
+              '--channel',
+              'channel_path',
+              help='flag devices whose dev channel is not the version in this channel manifest')
+@click.option('--timeout',
+              default=3.0,
+              show_default=True,
+              help='seconds a device may take to answer a query')
+@click.option('--max-concurrency',
+              'max_concurrency',
+              default=STATUS_CONCURRENCY,
+              show_default=True,
+              help='devices queried at the same time')
+@click.option('--json',
+              'as_json',
+              is_flag=True,
+              help='print the status records as json')
+def status(roku_ips, channel_path, timeout, max_concurrency, as_json):
+    """
+    Queries model, firmware, developer mode, dev channel version and uptime of every device at once
+    """
+    expected_version = None
+    if channel_path is not None:
+        channel = Channel(channel_path)
+        channel.manifest_data = parse_manifest(channel.channel_path / 'manifest')
+        expected_version = channel.version()
+    registry = DeviceRegistry()
+    devices = channel_devices(channel_path, roku_ips)
+    if not devices:
+        devices = [{"name": entry["info"].get('friendly-model-name') or entry["ip_address"],
+                    "ip_address": entry["ip_address"]} for entry in registry.known_devices(fresh_only=False)]
+    if not devices:
+        raise click.UsageError('pass --roku-ip, a channel with saved devices or run rokuPi devices refresh')
+
+    records = query_fleet_status(devices, expected_version, urllib3.Timeout(connect=min(timeout, 1.0), read=timeout),
+                                 max_concurrency)
+    for record in records:
+        if record["info"].get('serial-number'):
+            registry.record(record["info"], record["ip_address"])
+    registry.save()
+
+    if as_json:
+        click.echo(json.dumps(records, indent=4))
+    else:
+        for line in status_report_lines(records):
+            click.echo(line)
+        states = collections.Counter(record["state"] for record in records)
+        click.echo(', '.join(f'{count} {state}' for state, count in sorted(states.items())))
+    if any(record["state"] != 'ok' for record in records):
+        click.get_current_context().exit(1)
+
+
+@cli.group()
+@click.option('--registry-ttl',
+              'registry_ttl',
+              default=REGISTRY_TTL,
+              show_default=True,
+              help='seconds a known device counts as fresh')
+@click.pass_context
+def devices(ctx, registry_ttl):
+    """
+    Lists, refreshes and prunes the known device registry
+    """
+    ctx.obj = DeviceRegistry(ttl=registry_ttl)
+
+
+@devices.command('list')
+@click.pass_obj
+def list_devices(registry):
+    entries = registry.known_devices(fresh_only=False)
+    if not entries:
+        click.echo('no known devices, run rokuPi devices refresh to scan the network')
+        return
+
+    click.echo(f'{"serial":<14} {"device":<24} {"ip address":<16} {"seen":>8}  state')
+    for entry in entries:
+        age = time.time() - entry["updated"]
+        click.echo(f'{entry["serial_number"]:<14} {(entry["info"].get("friendly-model-name") or "")[:24]:<24} '
+                   f'{entry["ip_address"]:<16} {age:>7.0f}s  {"fresh" if registry.is_fresh(entry) else "stale"}')
+
+
+@devices.command('refresh')
+@click.option('--subnet',
+              'subnet',
+              help='subnet in CIDR notation to sweep when no device answers the SSDP search')
+@click.pass_obj
+def refresh_devices(registry, subnet):
+    missing = registry.revalidate(subnet)
+    if not registry.known_devices(fresh_only=False):
+        registry.discover(subnet)
+        registry.save()
+    for serial_number in missing:
+        click.echo(f'{serial_number} did not answer')
+    click.echo(f'{len(registry.known_devices())} devices available')
+
+
+@devices.command('prune')
+@click.option('--older-than',
+              'older_than',
+              type=float,
+              help='remove devices not seen for this many seconds')
+@click.option('--unreachable',
+              is_flag=True,
+              help='remove devices that do not answer a revalidation')
+@click.argument('serial_numbers', nargs=-1)
+@click.pass_obj
+def prune_devices(registry, older_than, unreachable, serial_numbers):
+    serial_numbers = set(serial_numbers)
+    if unreachable:
+        serial_numbers.update(registry.revalidate())
+    for serial_number in registry.prune(older_than, serial_numbers):
+        click.echo(f'removed {serial_number}')
+
+
+@cli.group()
+@click.option('--max-bytes',
+              'max_bytes',
+              default=ARTIFACT_MAX_BYTES,
+              show_default=True,
+              help='size of the artifact store past which the least recently used builds are evicted')
+@click.option('--max-count',
+              'max_count',
+              default=ARTIFACT_MAX_COUNT,
+              show_default=True,
+              help='builds kept in the artifact store')
+@click.pass_context
+def builds(ctx, max_bytes, max_count):
+    """
+    Lists and prunes the store of earlier builds
+    """
+    ctx.obj = ArtifactStore(max_bytes=max_bytes, max_count=max_count)
+
+
+@builds.command('list')
+@click.option('-c',
+              '--channel',
+              'channel_path',
+              help='only list builds of this channel')
+@click.pass_obj
+def list_builds(store, channel_path):
+    entries = store.entries(channel_path)
+    if not entries:
+        click.echo('no stored builds, every deploy adds its build')
+        return
+
+    click.echo(f'{"build":<12} {"title":<24} {"version":<10} {"size":>12} {"used":>8}  channel')
+    for key, entry in entries:
+        age = time.time() - entry["used"]
+        click.echo(f'{key[:12]:<12} {(entry["title"] or "")[:24]:<24} {entry["version"] or "":<10} '
+                   f'{entry["size"]:>12,} {age:>7.0f}s  {entry["channel"]}')
+
+
+@builds.command('prune')
+@click.pass_obj
+def prune_builds(store):
+    """
+    Evicts the least recently used builds until the store is within --max-bytes and --max-count
+    """
+    with store.locked():
+        store.load()
+        evicted = store.evict()
+        store.save()
+    for key in evicted:
+        click.echo(f'removed {key[:12]}')
 
 
 if __name__ == '__main__':
-    deploy()
+    cli()
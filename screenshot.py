@@ -0,0 +1,171 @@
+import concurrent.futures
+import hashlib
+import re
+import time
+import urllib3
+import xml.etree.ElementTree as eTree
+
+from pathlib import Path
+from remote import parse_script, RemoteSession
+from roku import Roku
+
+SCREENSHOT_TIMEOUT = 30.0
+HASH_BITS = 64
+CHANGE_THRESHOLD = 10
+CAPTURE_NAME = re.compile(r'[\w-]+')
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+def parse_capture_script(script):
+    """
+    Splits a key script into the steps before each capture, a `capture NAME` line takes a
+    screenshot saved as NAME, every other line is a parse_script command. Without capture
+    lines one screenshot named screen is taken after the steps
+    :param script: String - script contents
+    :return: List - tuples of capture name and the parsed commands run before it
+    """
+    captures = []
+    lines = []
+    for line_number, line in enumerate(script.splitlines(), 1):
+        command, _, name = line.strip().partition(' ')
+        if command.lower() != 'capture':
+            lines.append(line)
+            continue
+
+        name = name.strip()
+        if not CAPTURE_NAME.fullmatch(name) or name in (capture for capture, _ in captures):
+            raise ValueError(f'line {line_number}: capture needs a unique name of letters, digits, _ and -, '
+                             f'got "{line.strip()}"')
+        captures.append((name, parse_script('\n'.join(lines))))
+        # blank lines keep the line numbers of parse_script errors right
+        lines = [''] * line_number
+
+    steps = parse_script('\n'.join(lines))
+    if not captures:
+        return [('screen', steps)]
+    if steps:
+        raise ValueError('steps after the last capture would never be captured')
+
+    return captures
+
+
+def image_hash(image_path):
+    """
+    Hashes a screenshot, a difference hash of the downscaled grayscale image when Pillow is
+    installed so small rendering noise barely changes it, a hash of the file bytes otherwise
+    :param image_path: Object - path object to the image
+    :return: String - dhash:<hex> or sha1:<hex>
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        digest = hashlib.sha1()
+        with open(str(image_path), 'rb') as image_file:
+            for chunk in iter(lambda: image_file.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return f'sha1:{digest.hexdigest()}'
+
+    with Image.open(str(image_path)) as image:
+        pixels = list(image.convert('L').resize((9, 8)).getdata())
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            bits = bits << 1 | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+
+    return f'dhash:{bits:016x}'
+
+
+def hash_distance(first, second):
+    """
+    :param first: String - result of image_hash
+    :param second: String - result of image_hash
+    :return: Int - differing bits of two difference hashes, 0 or HASH_BITS for byte hashes
+    """
+    first_kind, _, first_value = first.partition(':')
+    second_kind, _, second_value = second.partition(':')
+    if first_kind == second_kind == 'dhash':
+        return bin(int(first_value, 16) ^ int(second_value, 16)).count('1')
+
+    return 0 if first == second else HASH_BITS
+
+
+def device_dir_name(device_data):
+    return re.sub(r'[^\w.-]+', '_', (device_data.get("name") or '').strip() or device_data["ip_address"])
+
+
+def find_baseline(baseline_dir, device_name, capture):
+    if baseline_dir is None:
+        return None
+
+    # a .part file is a screenshot still being written or left by a failed download
+    return next(iter(sorted(path for path in (Path(baseline_dir) / device_name).glob(f'{capture}.*')
+                            if path.suffix != '.part')), None)
+
+
+def capture_device(device_data, captures, output_dir, baseline_dir=None, threshold=CHANGE_THRESHOLD):
+    """
+    Runs the steps of every capture on one device and streams each screenshot to
+    output_dir/<device>/<capture>, comparing it with the same file under baseline_dir
+    :param device_data: Dictionary - device with credentials
+    :param captures: List - result of parse_capture_script
+    :param output_dir: Object - path object screenshots are written under
+    :param baseline_dir: Object - path object to earlier screenshots in the same layout, None skips the diff
+    :param threshold: Int - hash bits that may differ before a screen counts as changed
+    :return: Dictionary - device name, capture results and an error if capturing stopped
+    """
+    name = device_dir_name(device_data)
+    device_dir = Path(output_dir) / name
+    device_dir.mkdir(parents=True, exist_ok=True)
+    roku = Roku(device_data, SCREENSHOT_TIMEOUT)
+    session = RemoteSession(device_data)
+    results = []
+    error = None
+    try:
+        for capture, steps in captures:
+            session.run(steps)
+            shot = roku.take_screenshot(device_dir / capture)
+            result = {"name": capture, "path": str(shot["path"]), "bytes": shot["bytes"], "seconds": shot["elapsed"],
+                      "hash": image_hash(shot["path"]), "baseline": None, "distance": None, "changed": None}
+            baseline = find_baseline(baseline_dir, name, capture)
+            if baseline is not None:
+                result["baseline"] = str(baseline)
+                result["distance"] = hash_distance(result["hash"], image_hash(baseline))
+                result["changed"] = result["distance"] > threshold
+            results.append(result)
+    except (urllib3.exceptions.HTTPError, eTree.ParseError, OSError) as e:
+        error = f'{type(e).__name__}: {e}'
+    finally:
+        session.close()
+
+    return {"device": name, "captures": results, "error": error}
+
+
+def capture_devices(devices, captures, output_dir, baseline_dir=None, threshold=CHANGE_THRESHOLD,
+                    max_concurrency=8):
+    """
+    Captures every device at once, each device runs its steps and captures in order
+    :param devices: List - device dictionaries
+    :param max_concurrency: Int - devices captured at the same time
+    :return: Tuple - results of capture_device in device order and the wall clock seconds
+    """
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(devices)))) as executor:
+        runs = list(executor.map(
+            lambda device: capture_device(device, captures, output_dir, baseline_dir, threshold), devices))
+
+    return runs, time.perf_counter() - started
+
+
+def screenshot_report_lines(runs):
+    lines = []
+    for run in runs:
+        lines.append(f'{run["device"]}: {len(run["captures"])} screenshots'
+                     f'{"  " + run["error"] if run["error"] else ""}')
+        for capture in run["captures"]:
+            if capture["changed"] is None:
+                state = 'no baseline'
+            else:
+                state = f'{"changed" if capture["changed"] else "same"} ({capture["distance"]} bits)'
+            lines.append(f'  {capture["name"]:<16} {capture["bytes"]:>10,} bytes {capture["seconds"]:>6.2f}s  {state}')
+
+    return lines
@@ -3,13 +3,37 @@ from setuptools import setup
 setup(
     name='RokuPi',
     version='1.0',
-    py_modules=['rokuPi'],
+    py_modules=[
+        'archive',
+        'artifact_store',
+        'build_cache',
+        'channel',
+        'console_logs',
+        'constants',
+        'daemon',
+        'device_registry',
+        'digest',
+        'discovery',
+        'file_matcher',
+        'fleet',
+        'inventory',
+        'launch_timing',
+        'optimizer',
+        'perf',
+        'profiling',
+        'remote',
+        'roku',
+        'rokuPi',
+        'screenshot',
+        'validators',
+        'watcher'
+    ],
     install_requires=[
         'Click',
         'prompt-toolkit',
     ],
     entry_points='''
         [console_scripts]
-        rokuPi=rokuPi:deploy
+        rokuPi=rokuPi:cli
     ''',
 )
\ No newline at end of file
@@ -1,17 +1,1274 @@
+import collections
+import csv
+import io
+import json
 import os
+import socket
+import tempfile
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib3
+import zipfile
+import zlib
 from pathlib import Path
 import unittest
+from unittest import mock
+
+import click
+from click.testing import CliRunner
+
+from artifact_store import ArtifactStore
+from archive import (ArchiveStream, compress_files, CompressionPolicy, EntryCache, trim_entry_cache, update_archive,
+                     write_entries)
+from build_cache import BuildCache, build_fingerprint, hash_file
+from channel import Channel
+from console_logs import DeviceLog, LineFilter, RotatingWriter, stream_logs
+from daemon import DeployDaemon, start_servers
+from device_registry import check_installed_build, DeviceRegistry
+from digest import DigestAuth, md5_hex
+from discovery import ssdp_search, sweep_subnet
+from fake_roku import FakeRoku
+from file_matcher import collect_channel_files, FileMatcher
+from fleet import deploy_to_fleet
+from profiling import TRACER
+from optimizer import AssetOptimizer, minify_brightscript, minify_xml, recompress_png
+from inventory import query_fleet_status, status_report_lines
+from launch_timing import launch_summary, measure_launch
+from perf import check_thresholds, parse_thresholds, sample_devices, summarize_series
+from remote import parse_script, RemoteSession
+from rokuPi import (build_channel, build_channels, channel_devices, cli, expand_channel_paths, PASSWORD_ENV,
+                    prepare_channel_archive, watch_channel)
+from roku import encode_multipart, multipart_length, parse_plugin_messages, Roku
+from screenshot import capture_devices, find_baseline, parse_capture_script, screenshot_report_lines
+from watcher import ChannelWatcher, create_watcher, PollingWatcher, watch_roots
 
 
 class TestChannelMethods(unittest.TestCase):
 
     def setUp(self):
-        Path('.', exist_ok=True).mkdir('tmp')
-        print(self.temp_dir)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.channel_path = Path(self.temp_dir.name)
+        (self.channel_path / 'manifest').write_text('title=Test\nmajor_version=1\nminor_version=2\nbuild_version=3\n')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
 
     def test_upper(self):
         self.assertEqual('foo'.upper(), 'FOO')
 
+    def test_channel_name_and_version(self):
+        channel = Channel(self.channel_path)
+        channel.manifest_data = {'title': 'Test', 'major_version': '1', 'minor_version': '2', 'build_version': '3'}
+
+        self.assertIsNone(channel.config_file)
+        self.assertTrue(channel.out_dir.exists())
+        self.assertEqual(channel.__str__(), 'Test_1.2.3')
+        self.assertEqual(channel.version(), '1.2.3')
+
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.channel_path = Path(self.temp_dir.name)
+        (self.channel_path / 'source').mkdir()
+        (self.channel_path / 'manifest').write_text('title=Test\n')
+        (self.channel_path / 'source' / 'main.brs').write_text('sub main()\nend sub\n')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_unchanged_files_have_no_diff(self):
+        build_cache = BuildCache(self.channel_path)
+        file_states = build_cache.scan(['manifest', 'source/main.brs'])
+        build_cache.update(file_states, 'Test.zip')
+        build_cache.save()
+
+        build_cache = BuildCache(self.channel_path)
+        changes = build_cache.diff(build_cache.scan(['manifest', 'source/main.brs']))
+        self.assertEqual(changes, {"changed": [], "removed": []})
+
+    def test_modified_and_removed_files(self):
+        build_cache = BuildCache(self.channel_path)
+        build_cache.update(build_cache.scan(['manifest', 'source/main.brs']), 'Test.zip')
+
+        (self.channel_path / 'manifest').write_text('title=Changed\n')
+        changes = build_cache.diff(build_cache.scan(['manifest']))
+        self.assertEqual(changes, {"changed": ['manifest'], "removed": ['source/main.brs']})
+
+    def test_update_archive_rewrites_changed_entries(self):
+        previous_archive = self.channel_path / 'previous.zip'
+        with zipfile.ZipFile(str(previous_archive), 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('manifest', 'title=Test\n')
+            zf.writestr('source/main.brs', 'sub main()\nend sub\n')
+            zf.writestr('source/old.brs', 'sub old()\nend sub\n')
+
+        (self.channel_path / 'manifest').write_text('title=Changed\n')
+        archive_path = self.channel_path / 'updated.zip'
+        update_archive(previous_archive, archive_path, self.channel_path, ['manifest'], ['source/old.brs'])
+
+        self.assertFalse(previous_archive.exists())
+        with zipfile.ZipFile(str(archive_path)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(sorted(zf.namelist()), ['manifest', 'source/main.brs'])
+            self.assertEqual(zf.read('manifest'), b'title=Changed\n')
+            self.assertEqual(zf.read('source/main.brs'), b'sub main()\nend sub\n')
+
+
+class TestArtifactStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.channel_path = Path(self.temp_dir.name) / 'channel'
+        (self.channel_path / 'source').mkdir(parents=True)
+        (self.channel_path / 'manifest').write_text('title=Store\nmajor_version=1\nminor_version=0\nbuild_version=1\n')
+        (self.channel_path / 'source' / 'main.brs').write_text('sub main()\nend sub\n')
+        (self.channel_path / 'rokuPiConfig.json').write_text(json.dumps({"files": ['manifest', 'source/**']}))
+        self.store_dir = Path(self.temp_dir.name) / 'artifacts'
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def build(self, store):
+        channel = Channel(self.channel_path)
+        channel.set_config_file_data()
+        channel.manifest_data = {'title': 'Store', 'major_version': '1', 'minor_version': '0', 'build_version': '1'}
+        channel_archive = prepare_channel_archive(channel, store=store)
+        if isinstance(channel_archive, ArchiveStream):
+            collections.deque(channel_archive, maxlen=0)
+
+        return channel, channel.get_channel_archive()
+
+    def test_earlier_build_is_reused_without_rebuilding(self):
+        store = ArtifactStore(self.store_dir)
+        first_channel, first_archive = self.build(store)
+        first_bytes = first_archive.read_bytes()
+        (self.channel_path / 'source' / 'main.brs').write_text('sub main()\n    print "changed"\nend sub\n')
+        self.build(store)
+        self.assertEqual(len(store.entries()), 2)
+
+        (self.channel_path / 'source' / 'main.brs').write_text('sub main()\nend sub\n')
+        with mock.patch('rokuPi.update_archive') as rebuild:
+            channel, archive = self.build(ArtifactStore(self.store_dir))
+        rebuild.assert_not_called()
+        self.assertEqual(channel.build_fingerprint, first_channel.build_fingerprint)
+        self.assertTrue(str(archive).startswith(str(self.store_dir)))
+        self.assertEqual(archive.read_bytes(), first_bytes)
+        key, entry = ArtifactStore(self.store_dir).find('1.0.1', self.channel_path)
+        self.assertEqual(entry["fingerprint"], first_channel.build_fingerprint)
+
+    def test_least_recently_used_builds_are_evicted(self):
+        store = ArtifactStore(self.store_dir, max_count=2)
+        channel = Channel(self.channel_path)
+        channel.manifest_data = {'title': 'Store'}
+        for key in ('a' * 40, 'b' * 40):
+            archive_path = Path(self.temp_dir.name) / f'{key}.zip'
+            archive_path.write_bytes(key.encode('ascii'))
+            store.put(key, archive_path, channel)
+        store.get('a' * 40)
+        (Path(self.temp_dir.name) / 'c.zip').write_bytes(b'c' * 100)
+        store.put('c' * 40, Path(self.temp_dir.name) / 'c.zip', channel)
+
+        self.assertEqual(sorted(key[0] for key, _ in store.entries()), ['a', 'c'])
+        self.assertFalse(store.object_path('b' * 40).exists())
+        store.max_bytes = 100
+        self.assertEqual(store.evict(), ['a' * 40])
+        self.assertEqual(ArtifactStore(self.store_dir).get('c' * 40).read_bytes(), b'c' * 100)
+
+
+class TestMultiChannelBuild(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name)
+        shared = 'sub shared()\n' + '    print "shared line"\n' * 2000 + 'end sub\n'
+        for variant in ('brand_a', 'brand_b'):
+            channel_path = self.root / 'channels' / variant
+            (channel_path / 'source').mkdir(parents=True)
+            (channel_path / 'manifest').write_text(f'title={variant}\nmajor_version=1\nminor_version=0\n'
+                                                   f'build_version=1\n')
+            (channel_path / 'source' / 'shared.brs').write_text(shared)
+            (channel_path / 'source' / 'main.brs').write_text(f'sub main()\n    print "{variant}"\nend sub\n')
+            (channel_path / 'rokuPiConfig.json').write_text(json.dumps({"files": ['manifest', 'source/**']}))
+        (self.root / 'channels' / 'docs').mkdir()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_channels_build_in_parallel_sharing_compressed_files(self):
+        with mock.patch.dict(os.environ, {'HOME': str(self.root)}):
+            result = CliRunner().invoke(cli, ['build', str(self.root / 'channels' / '*'), '--jobs', '2',
+                                              '--report-json', str(self.root / 'report.json')])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('built 2 channels', result.output)
+        report = json.loads((self.root / 'report.json').read_text())
+        self.assertEqual([Path(entry["channel"]).name for entry in report["channels"]], ['brand_a', 'brand_b'])
+        for entry in report["channels"]:
+            with zipfile.ZipFile(entry["archive"]) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertIn('print "shared line"', zf.read('source/shared.brs').decode('utf-8'))
+        entries = list((self.root / '.rokuPi' / 'entries').rglob('*-6'))
+        # the shared file once, manifest and main.brs per channel
+        self.assertEqual(len(entries), 5)
+
+        with mock.patch.dict(os.environ, {'HOME': str(self.root)}), \
+                mock.patch('archive.zlib.compressobj', side_effect=AssertionError('compressed again')):
+            results, _ = build_channels(expand_channel_paths([str(self.root / 'channels' / 'brand_*')]), jobs=1,
+                                        force_rebuild=True, entry_cache_dir=self.root / '.rokuPi' / 'entries',
+                                        store_dir=self.root / 'store')
+        self.assertEqual([result["error"] for result in results], [None, None])
+        self.assertEqual(trim_entry_cache(self.root / '.rokuPi' / 'entries', 0), 5)
+
+    def test_entry_cache_skips_files_edited_after_the_scan(self):
+        channel_path = self.root / 'channels' / 'brand_a'
+        cache_dir = self.root / 'entries'
+        relative_path = 'source/shared.brs'
+        entry_cache = EntryCache(cache_dir, {relative_path: hash_file(channel_path / relative_path)})
+        with zipfile.ZipFile(io.BytesIO(), 'w') as zf:
+            write_entries(zf, channel_path, [relative_path], max_workers=1, entry_cache=entry_cache)
+        cached, = cache_dir.rglob('*-6')
+        cached_bytes = cached.read_bytes()
+
+        (channel_path / relative_path).write_text('sub edited()\n' + '    print "edited"\n' * 2000 + 'end sub\n')
+        archive_file = io.BytesIO()
+        with zipfile.ZipFile(archive_file, 'w') as zf:
+            write_entries(zf, channel_path, [relative_path], max_workers=1, entry_cache=entry_cache)
+        with zipfile.ZipFile(archive_file) as zf:
+            self.assertEqual(zf.read(relative_path), (channel_path / relative_path).read_bytes())
+        self.assertEqual(cached.read_bytes(), cached_bytes)
+
+        cached.unlink()
+        with zipfile.ZipFile(io.BytesIO(), 'w') as zf:
+            write_entries(zf, channel_path, [relative_path], max_workers=1, entry_cache=entry_cache)
+        self.assertEqual(list(cache_dir.rglob('*-6')), [])
+
+
+class TestArchiveStream(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.channel_path = Path(self.temp_dir.name)
+        (self.channel_path / 'source').mkdir()
+        (self.channel_path / 'manifest').write_text('title=Test\n')
+        (self.channel_path / 'source' / 'main.brs').write_bytes(os.urandom(300 * 1024))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_streamed_bytes_match_out_archive(self):
+        completed = []
+        archive_path = self.channel_path / 'Test.zip'
+        archive_stream = ArchiveStream(self.channel_path, ['manifest', 'source/main.brs'], archive_path,
+                                       bounded_memory=True, on_complete=lambda: completed.append(True))
+        streamed = b''.join(archive_stream)
+
+        self.assertEqual(completed, [True])
+        self.assertEqual(archive_path.read_bytes(), streamed)
+        with zipfile.ZipFile(str(archive_path)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.read('source/main.brs'), (self.channel_path / 'source' / 'main.brs').read_bytes())
+
+    def test_missing_source_file_raises(self):
+        archive_path = self.channel_path / 'Test.zip'
+        archive_stream = ArchiveStream(self.channel_path, ['manifest', 'missing.brs'], archive_path)
+
+        with self.assertRaises(FileNotFoundError):
+            b''.join(archive_stream)
+        self.assertFalse(archive_path.exists())
+        self.assertFalse(Path(f'{archive_path}.part').exists())
+
+    def test_media_is_stored_and_rules_override_levels(self):
+        (self.channel_path / 'images').mkdir()
+        (self.channel_path / 'images' / 'icon.png').write_bytes(b'png ' * 4096)
+        (self.channel_path / 'source' / 'util.brs').write_text('function util()\nend function\n' * 200)
+        compression = CompressionPolicy({'source/util.brs': 0, 'images/**': 9})
+        archive_path = self.channel_path / 'Test.zip'
+        relative_paths = ['images/icon.png', 'manifest', 'source/main.brs', 'source/util.brs']
+        for _ in ArchiveStream(self.channel_path, relative_paths, archive_path, compression=compression):
+            pass
+
+        with zipfile.ZipFile(str(archive_path)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), relative_paths)
+            compress_types = {info.filename: info.compress_type for info in zf.infolist()}
+        # random bytes and tiny files do not get smaller so they are stored even at the default level
+        self.assertEqual(compress_types, {'images/icon.png': zipfile.ZIP_DEFLATED, 'manifest': zipfile.ZIP_STORED,
+                                          'source/main.brs': zipfile.ZIP_STORED,
+                                          'source/util.brs': zipfile.ZIP_STORED})
+        self.assertEqual(CompressionPolicy().level_for('images/Icon.PNG'), 0)
+        with self.assertRaises(ValueError):
+            CompressionPolicy({'images/**': 12})
+
+    def test_parallel_compression_keeps_archive_order(self):
+        relative_paths = []
+        for index in range(12):
+            relative_path = f'source/file{index}.brs'
+            (self.channel_path / relative_path).write_text(f'function value{index}()\nend function\n' * 500)
+            relative_paths.append(relative_path)
+        archive_path = self.channel_path / 'Test.zip'
+        with mock.patch('archive.PARALLEL_COMPRESS_BYTES', 0), mock.patch('archive.COMPRESS_BATCH_BYTES', 16 * 1024):
+            with zipfile.ZipFile(str(archive_path), 'w') as zf:
+                write_entries(zf, self.channel_path, relative_paths, max_workers=2)
+
+        with zipfile.ZipFile(str(archive_path)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), relative_paths)
+            self.assertEqual(zf.read('source/file7.brs'), (self.channel_path / 'source/file7.brs').read_bytes())
+
+    def test_large_files_deflate_through_spill_files(self):
+        text = ''.join(f'sub line{index}()\nend sub\n' for index in range(20000))
+        (self.channel_path / 'source' / 'big.brs').write_text(text)
+        spill_dir = self.channel_path / 'spill'
+        spill_dir.mkdir()
+        archive_path = self.channel_path / 'Test.zip'
+        with mock.patch('archive.SPILL_BYTES', 4 * 1024), mock.patch('tempfile.tempdir', str(spill_dir)):
+            with zipfile.ZipFile(str(archive_path), 'w') as zf:
+                write_entries(zf, self.channel_path, ['manifest', 'source/big.brs'], max_workers=1)
+
+        with zipfile.ZipFile(str(archive_path)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.read('source/big.brs').decode('utf-8'), text)
+            self.assertEqual(zf.getinfo('source/big.brs').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(list(spill_dir.iterdir()), [])
+
+    def test_file_changed_after_its_crc_was_read_fails_the_build(self):
+        def compress_then_edit(entries):
+            results = compress_files(entries)
+            (self.channel_path / 'source' / 'main.brs').write_bytes(os.urandom(300 * 1024))
+            return results
+
+        with mock.patch('archive.compress_files', side_effect=compress_then_edit):
+            with zipfile.ZipFile(io.BytesIO(), 'w') as zf, self.assertRaisesRegex(OSError, 'changed while'):
+                write_entries(zf, self.channel_path, ['source/main.brs'], max_workers=1)
+
+
+def png_bytes(width, height, level):
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    rows = b''.join(b'\x00' + bytes([x % 256 for x in range(width * 3)]) for _ in range(height))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b'tEXt', b'Comment\x00exported') + chunk(b'IDAT', zlib.compress(rows, level)) + chunk(b'IEND', b'')
+
+
+class TestAssetOptimizer(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.channel_path = Path(self.temp_dir.name)
+        (self.channel_path / 'source').mkdir()
+        (self.channel_path / 'images').mkdir()
+        (self.channel_path / 'source' / 'main.brs').write_text(
+            "sub main() ' entry\n    x = \"it's\" ' comment\n    REM old\n    print x\n"
+            "    #if DEBUG\n        ? \"debug\"\n    #else\n        y = 1\n    #end if\nend sub\n")
+        (self.channel_path / 'images' / 'icon.png').write_bytes(png_bytes(64, 64, 0))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_minifiers(self):
+        source = (self.channel_path / 'source' / 'main.brs').read_text()
+        self.assertEqual(minify_brightscript(source),
+                         'sub main()\nx = "it\'s"\nprint x\n#if DEBUG\n? "debug"\n#else\ny = 1\n#end if\nend sub\n')
+        self.assertEqual(minify_brightscript(source, strip_debug=True), 'sub main()\nx = "it\'s"\ny = 1\nend sub\n')
+        self.assertEqual(minify_xml('<component>\n  <!-- note -->\n  <script><![CDATA[\n  x = 1\n]]></script>\n'
+                                    '</component>\n'),
+                         '<component><script><![CDATA[\n  x = 1\n]]></script></component>\n')
+
+    def test_png_recompression_is_lossless(self):
+        original = png_bytes(64, 64, 0)
+        recompressed = recompress_png(original)
+
+        self.assertLess(len(recompressed), len(original))
+        self.assertNotIn(b'tEXt', recompressed)
+        self.assertEqual(zlib.decompress(recompressed[recompressed.index(b'IDAT') + 4:-16]),
+                         zlib.decompress(original[original.index(b'IDAT') + 4:-16]))
+
+    def test_outputs_are_cached_and_archived(self):
+        build_cache = BuildCache(self.channel_path)
+        file_states = build_cache.scan(['images/icon.png', 'source/main.brs'])
+        optimizer = AssetOptimizer(cache_dir=self.channel_path / 'cache')
+        sources, report = optimizer.optimize(self.channel_path, file_states)
+
+        self.assertEqual(sorted(sources), ['images/icon.png', 'source/main.brs'])
+        self.assertEqual(report["png"]["cached"], 0)
+        self.assertLess(report["png"]["optimized"], report["png"]["original"])
+        self.assertEqual(optimizer.optimize(self.channel_path, file_states)[1]["brightscript"]["cached"], 1)
+
+        archive_path = self.channel_path / 'Test.zip'
+        for _ in ArchiveStream(self.channel_path, list(file_states), archive_path, sources=sources):
+            pass
+        with zipfile.ZipFile(str(archive_path)) as zf:
+            self.assertEqual(zf.read('source/main.brs'), sources['source/main.brs'].read_bytes())
+
+
+class TestPluginClient(unittest.TestCase):
+
+    def test_digest_authorization_with_qop(self):
+        digest_auth = DigestAuth('rokudev', 'secret')
+        self.assertTrue(digest_auth.parse_challenge('Digest realm="rokudev", nonce="abc123", qop="auth"'))
+        header = digest_auth.authorization('POST', '/plugin_install')
+        params = dict(part.split('=', 1) for part in header[7:].split(', '))
+
+        ha1 = md5_hex('rokudev:rokudev:secret')
+        ha2 = md5_hex('POST:/plugin_install')
+        cnonce = params["cnonce"].strip('"')
+        self.assertEqual(params["nc"], '00000001')
+        self.assertEqual(params["response"].strip('"'), md5_hex(f'{ha1}:abc123:00000001:{cnonce}:auth:{ha2}'))
+        digest_auth.authorization('POST', '/plugin_install')
+        self.assertEqual(digest_auth.nonce_count, 2)
+
+    def test_non_digest_challenge_is_ignored(self):
+        digest_auth = DigestAuth('rokudev', 'secret')
+        self.assertFalse(digest_auth.parse_challenge('Basic realm="rokudev"'))
+        self.assertFalse(digest_auth.has_challenge)
+
+    def test_multipart_length_matches_body(self):
+        fields = {'mysubmit': 'Install'}
+        body = b''.join(encode_multipart(fields, 'boundary', 'channel.zip', [b'zip', b'bytes']))
+        self.assertEqual(len(body), multipart_length(fields, 'boundary', 'channel.zip', 8))
+
+    def test_parse_plugin_messages(self):
+        page = "<script>Shell.create('Roku.Message').trigger('Set message type', 'error')" \
+               ".trigger('Set message content', 'Install Failure: Compilation Failed.')</script>" \
+               '<font color="red">Application Received: 2048 bytes stored.</font>'
+        self.assertEqual(parse_plugin_messages(page),
+                         ['Install Failure: Compilation Failed.', 'Application Received: 2048 bytes stored.'])
+
+
+class TestFleetDeploy(unittest.TestCase):
+
+    def test_unreachable_device_is_reported_not_raised(self):
+        devices = [{"name": 'offline', "username": 'rokudev', "password": '', "ip_address": '127.0.0.1',
+                    "http_port": 1}]
+        results = deploy_to_fleet(devices, None, max_concurrency=2, timeout=1.0, retries=1, backoff=0.0)
+
+        self.assertEqual(len(results), 1)
+        self.assertFalse(results[0]["ok"])
+        self.assertEqual(results[0]["attempts"], 2)
+        self.assertIsNotNone(results[0]["error"])
+
+
+class TestDiscovery(unittest.TestCase):
+
+    def start_ssdp_responder(self, responses):
+        responder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        responder.bind(('127.0.0.1', 0))
+        self.addCleanup(responder.close)
+
+        def respond():
+            data, sender = responder.recvfrom(4096)
+            if b'ST: roku:ecp' in data:
+                for response in responses:
+                    responder.sendto(response, sender)
+
+        threading.Thread(target=respond, daemon=True).start()
+        return responder.getsockname()
+
+    def test_ssdp_search_collects_roku_responses(self):
+        address = self.start_ssdp_responder([
+            b'HTTP/1.1 200 OK\r\nST: roku:ecp\r\nLOCATION: http://10.0.0.5:8060/\r\nUSN: uuid:roku:ecp:A1\r\n\r\n',
+            b'HTTP/1.1 200 OK\r\nST: roku:ecp\r\nLOCATION: http://10.0.0.5:8060/\r\nUSN: uuid:roku:ecp:A1\r\n\r\n',
+            b'HTTP/1.1 200 OK\r\nST: upnp:rootdevice\r\nLOCATION: http://10.0.0.9:80/\r\n\r\n',
+        ])
+        responses = list(ssdp_search(window=0.5, address=address))
+
+        self.assertEqual([response["ip_address"] for response in responses], ['10.0.0.5'])
+        self.assertEqual(responses[0]["usn"], 'uuid:roku:ecp:A1')
+
+    def test_sweep_subnet_yields_listening_hosts(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(8)
+        self.addCleanup(listener.close)
+
+        hosts = list(sweep_subnet('127.0.0.0/30', port=listener.getsockname()[1], timeout=0.5))
+        self.assertEqual(hosts, ['127.0.0.1'])
+
+
+class TestDeviceRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.registry_path = Path(self.temp_dir.name) / 'devices.json'
+        self.device_info = {'serial-number': 'X00000000001', 'friendly-model-name': 'Roku Ultra'}
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_device_is_keyed_by_serial_across_ip_changes(self):
+        registry = DeviceRegistry(self.registry_path)
+        registry.record(self.device_info, '10.0.0.5')
+        registry.record(self.device_info, '10.0.0.6')
+        registry.save()
+
+        registry = DeviceRegistry(self.registry_path)
+        self.assertEqual(len(registry.known_devices()), 1)
+        self.assertEqual(registry.find('X00000000001')["ip_address"], '10.0.0.6')
+        choice = registry.choices()[0]
+        self.assertEqual(choice["value"]["ip_address"], '10.0.0.6')
+        self.assertEqual(choice["value"]["serial_number"], 'X00000000001')
+
+    def test_expired_devices_are_not_fresh(self):
+        registry = DeviceRegistry(self.registry_path, ttl=60)
+        registry.record(self.device_info, '10.0.0.5')["updated"] -= 120
+
+        self.assertEqual(registry.known_devices(), [])
+        self.assertEqual(len(registry.known_devices(fresh_only=False)), 1)
+        self.assertEqual(registry.prune(older_than=90), ['X00000000001'])
+
+    def test_installed_build_matches_fingerprint_and_version(self):
+        channel = Channel(self.temp_dir.name)
+        channel.manifest_data = {'title': 'Test', 'major_version': '1', 'minor_version': '2', 'build_version': '3'}
+        channel.build_fingerprint = build_fingerprint({'manifest': {'sha1': 'abc'}}, channel.manifest_data)
+        dev_app = {'title': 'Test', 'version': '1.2.3'}
+
+        registry = DeviceRegistry(self.registry_path)
+        registry.record(self.device_info, '10.0.0.5')
+        self.assertFalse(registry.is_installed('X00000000001', channel, dev_app))
+
+        registry.record_install('X00000000001', channel)
+        self.assertTrue(registry.is_installed('X00000000001', channel, dev_app))
+        self.assertFalse(registry.is_installed('X00000000001', channel, None))
+        self.assertFalse(registry.is_installed('X00000000001', channel, {'title': 'Test', 'version': '1.2.2'}))
+
+        channel.build_fingerprint = build_fingerprint({'manifest': {'sha1': 'def'}}, channel.manifest_data)
+        self.assertFalse(registry.is_installed('X00000000001', channel, dev_app))
+
+    def test_unreadable_apps_list_means_not_installed(self):
+        channel = Channel(self.temp_dir.name)
+        channel.manifest_data = {'title': 'Test', 'major_version': '1', 'minor_version': '2', 'build_version': '3'}
+        channel.build_fingerprint = build_fingerprint({'manifest': {'sha1': 'abc'}}, channel.manifest_data)
+        registry = DeviceRegistry(self.registry_path)
+        with FakeRoku() as device:
+            device.installed = {"title": '<Test', "version": '1.2.3'}
+            registry.record_install(device.serial_number, channel)
+
+            installed, serial_number = check_installed_build(Roku(device.device_data), registry, channel)
+
+        self.assertFalse(installed)
+        self.assertEqual(serial_number, device.serial_number)
+
+    def test_device_without_serial_is_not_recorded(self):
+        registry = DeviceRegistry(self.registry_path)
+        self.assertIsNone(registry.record({'friendly-model-name': 'Roku Ultra'}, '10.0.0.5'))
+
+
+class TestRemoteScripts(unittest.TestCase):
+
+    def test_parse_script(self):
+        commands = parse_script('# navigate\nkey Home\nkey Down 3\ntext hi\ndelay 250\n'
+                                'launch dev contentId=12 mediaType=movie\ninput a=b\n')
+        self.assertEqual([command["command"] for command in commands],
+                         ['key', 'key', 'text', 'delay', 'launch', 'input'])
+        self.assertEqual(commands[1]["count"], 3)
+        self.assertEqual(commands[4]["params"], {'contentId': '12', 'mediaType': 'movie'})
+        with self.assertRaises(ValueError):
+            parse_script('swipe left')
+
+    def test_script_runs_over_one_connection(self):
+        with FakeRoku() as device:
+            session = RemoteSession(device.device_data)
+            results = session.run(parse_script('key Home 2\ntext a b\nlaunch 12 x=1'))
+            session.close()
+
+            self.assertEqual(device.keypresses, ['Home', 'Home', 'Lit_a', 'Lit_ ', 'Lit_b'])
+            self.assertEqual(device.requests[-1], ('POST', '/launch/12?x=1'))
+            self.assertEqual(device.active_app, '12')
+            # the keys and the launch share one keep-alive connection, the pipelined text opens its own
+            self.assertEqual(device.ecp_connections, 2)
+        self.assertEqual(len(results), 6)
+        self.assertTrue(all(result["status"] == 200 for result in results))
+
+    def test_pipelined_text_records_the_latency_of_each_character(self):
+        with FakeRoku(latency=0.05) as device:
+            session = RemoteSession(device.device_data)
+            results = session.send_text('abcd')
+            session.close()
+
+        self.assertEqual([status for status, _ in results], [200] * 4)
+        self.assertLess(max(latency for _, latency in results), 0.15)
+
+    def test_text_is_not_retyped_when_the_batch_breaks_after_it_was_sent(self):
+        connections = []
+
+        def serve(server):
+            while True:
+                try:
+                    client, _ = server.accept()
+                except OSError:
+                    return
+                connections.append(client)
+                with client:
+                    client.recv(4096)
+                    client.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+
+        with socket.socket() as server:
+            server.bind(('127.0.0.1', 0))
+            server.listen()
+            thread = threading.Thread(target=serve, args=(server,), daemon=True)
+            thread.start()
+            session = RemoteSession({"ip_address": '127.0.0.1', "ecp_port": server.getsockname()[1]})
+            with self.assertRaises(OSError) as raised:
+                session.send_text('abc')
+            session.close()
+
+        self.assertIn('after 1 of 3 characters', str(raised.exception))
+        self.assertEqual(len(connections), 1)
+
+
+def install_fake_channel(device, version=('1', '0', '1')):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('manifest', 'title=Perf\nmajor_version={}\nminor_version={}\nbuild_version={}\n'.format(*version))
+    device.install(archive.getvalue())
+    device.active_app = None
+
+
+class TestFleetStatus(unittest.TestCase):
+
+    def test_reports_offline_and_stale_devices(self):
+        with socket.socket() as unused:
+            unused.bind(('127.0.0.1', 0))
+            offline = {"name": 'Offline', "ip_address": '127.0.0.1', "ecp_port": unused.getsockname()[1]}
+        with FakeRoku('Rack A') as current, FakeRoku('Rack B') as stale, FakeRoku('Rack C') as empty:
+            install_fake_channel(current)
+            install_fake_channel(stale, ('0', '9', '4'))
+            started = time.perf_counter()
+            records = query_fleet_status([current.device_data, stale.device_data, empty.device_data, offline],
+                                         expected_version='1.0.1')
+            elapsed = time.perf_counter() - started
+            current_requests = list(current.requests)
+
+        self.assertLess(elapsed, 2.0)
+        self.assertEqual([record["state"] for record in records], ['ok', 'stale', 'stale', 'offline'])
+        self.assertEqual(records[0]["device"], 'Rack A')
+        self.assertEqual(records[0]["model"], 'Roku Ultra')
+        self.assertEqual(records[0]["firmware"], '9.2.0 4803')
+        self.assertTrue(records[0]["developer"])
+        self.assertEqual(records[0]["network"], 'ethernet')
+        self.assertEqual(records[0]["dev_version"], '1.0.1')
+        self.assertEqual(records[1]["dev_version"], '0.9.4')
+        self.assertIsNone(records[2]["dev_app"])
+        self.assertIn('Error', records[3]["error"])
+        self.assertEqual([path for _, path in current_requests],
+                         ['/query/device-info', '/query/apps', '/query/active-app'])
+        lines = status_report_lines(records)
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[4].startswith('Offline'))
+        json.dumps(records)
+
+
+class TestScreenshots(unittest.TestCase):
+
+    def test_parse_capture_script(self):
+        captures = parse_capture_script('key Home\ncapture home\nkey Right 2\ndelay 10\ncapture details\n')
+        self.assertEqual([name for name, _ in captures], ['home', 'details'])
+        self.assertEqual(captures[1][1], [{"command": 'key', "key": 'Right', "count": 2},
+                                          {"command": 'delay', "milliseconds": 10.0}])
+        self.assertEqual(parse_capture_script(''), [('screen', [])])
+        with self.assertRaisesRegex(ValueError, 'line 2'):
+            parse_capture_script('capture home\ncapture home')
+        with self.assertRaisesRegex(ValueError, 'line 3'):
+            parse_capture_script('capture home\nkey Home\nbogus')
+        with self.assertRaisesRegex(ValueError, 'after the last capture'):
+            parse_capture_script('capture home\nkey Home')
+
+    def test_captures_devices_and_flags_changed_screens(self):
+        captures = parse_capture_script('capture home\nkey Right\ncapture details\n')
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                FakeRoku('Shot A') as first, FakeRoku('Shot B') as second, FakeRoku('Shot C') as empty:
+            install_fake_channel(first)
+            install_fake_channel(second)
+            baseline_dir = Path(temp_dir) / 'baseline'
+            runs, _ = capture_devices([first.device_data, second.device_data, empty.device_data], captures,
+                                      baseline_dir)
+            self.assertEqual([run["device"] for run in runs], ['Shot_A', 'Shot_B', 'Shot_C'])
+            self.assertIsNone(runs[0]["error"])
+            self.assertIn('no dev channel installed', runs[2]["error"])
+            home = baseline_dir / 'Shot_A' / 'home.png'
+            self.assertTrue(home.read_bytes().startswith(b'\x89PNG'))
+            self.assertEqual(runs[0]["captures"][0]["bytes"], home.stat().st_size)
+            self.assertNotEqual(home.read_bytes(), (baseline_dir / 'Shot_A' / 'details.png').read_bytes())
+            self.assertFalse(list(baseline_dir.rglob('*.part')))
+
+            first.keypresses.clear()
+            second.keypresses.clear()
+            second.screen = 200
+            runs, _ = capture_devices([first.device_data, second.device_data], captures, Path(temp_dir) / 'current',
+                                      baseline_dir)
+        self.assertEqual([capture["changed"] for capture in runs[0]["captures"]], [False, False])
+        self.assertEqual([capture["changed"] for capture in runs[1]["captures"]], [True, True])
+        self.assertEqual(runs[0]["captures"][0]["distance"], 0)
+        self.assertIn('same (0 bits)', screenshot_report_lines(runs)[1])
+
+    def test_non_interactive_environment_never_prompts_for_the_password(self):
+        result = CliRunner().invoke(cli, ['screenshot', '--roku-ip', '127.0.0.1'],
+                                    env={'ROKUPI_NON_INTERACTIVE': '1', 'ROKUPI_PASSWORD': None})
+
+        self.assertEqual(result.exit_code, 2, result.output)
+        self.assertIn(PASSWORD_ENV, result.output)
+
+    def test_devices_use_the_configured_username(self):
+        with mock.patch.dict(os.environ, {'ROKUPI_USERNAME': 'tester'}):
+            self.assertEqual([device["username"] for device in channel_devices(None, ('10.0.0.5', '10.0.0.6'))],
+                             ['tester', 'tester'])
+
+    def test_failed_download_leaves_no_part_file_to_compare_with(self):
+        def broken_stream(response, amount):
+            yield b'\x89PNG'
+            raise urllib3.exceptions.ProtocolError('connection broken')
+
+        with tempfile.TemporaryDirectory() as temp_dir, FakeRoku('Shot A') as device:
+            install_fake_channel(device)
+            device_dir = Path(temp_dir) / 'Shot_A'
+            device_dir.mkdir()
+            with mock.patch.object(urllib3.response.HTTPResponse, 'stream', broken_stream):
+                with self.assertRaises(urllib3.exceptions.ProtocolError):
+                    Roku(device.device_data).take_screenshot(device_dir / 'home')
+
+            self.assertEqual(list(device_dir.iterdir()), [])
+            (device_dir / 'home.png.part').write_bytes(b'\x89PNG')
+            self.assertIsNone(find_baseline(temp_dir, 'Shot_A', 'home'))
+            (device_dir / 'home.png').write_bytes(b'\x89PNG')
+            self.assertEqual(find_baseline(temp_dir, 'Shot_A', 'home'), device_dir / 'home.png')
+
+
+class TestPerfSampler(unittest.TestCase):
+
+    def test_samples_launched_channel_on_every_device(self):
+        with FakeRoku('Perf A') as first, FakeRoku('Perf B') as second:
+            install_fake_channel(first)
+            runs = sample_devices([first.device_data, second.device_data], duration=0.2, interval=0.1, warmup=0.0)
+
+            self.assertEqual(first.active_app, 'dev')
+            self.assertIn(('GET', '/query/chanperf/dev'), first.requests)
+        self.assertIsNone(runs[0]["error"])
+        self.assertEqual(len(runs[0]["series"]["time"]), 3)
+        self.assertEqual(runs[0]["series"]["cpu_total"], [15.0] * 3)
+        self.assertEqual(runs[0]["series"]["texture_used"], [24 * 1024 * 1024] * 3)
+        self.assertIn('launching dev returned 404', runs[1]["error"])
+
+        summaries = summarize_series(runs[0]["series"])
+        self.assertEqual(summaries["mem_used"]["p95"], 96 * 1024 * 1024)
+        self.assertEqual(check_thresholds(runs[:1], parse_thresholds(['cpu_total=20', 'mem_used.max=1e9'])), [])
+        self.assertEqual(check_thresholds(runs[:1], parse_thresholds(['cpu_user.mean=10'])),
+                         ['Perf A: cpu_user mean 12 > 10'])
+        with self.assertRaises(ValueError):
+            parse_thresholds(['cpu_total.median=20'])
+
+    def test_cli_writes_series_and_fails_over_threshold(self):
+        with FakeRoku() as device, tempfile.TemporaryDirectory() as temp_dir:
+            install_fake_channel(device)
+            device.perf["cpu_user"] = 70.0
+            device_data = device.device_data
+            output = os.path.join(temp_dir, 'perf.csv')
+            with mock.patch('rokuPi.channel_devices', return_value=[device_data]):
+                result = CliRunner().invoke(cli, ['perf', '--duration', '0.1', '--interval', '0.1', '--warmup', '0',
+                                                  '-o', output, '--max', 'cpu_total.p95=50'])
+
+            with open(output) as output_file:
+                rows = list(csv.DictReader(output_file))
+        self.assertEqual(result.exit_code, 1, result.output)
+        self.assertIn('threshold exceeded, Fake Roku: cpu_total p95 73 > 50', result.output)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]["device"], 'Fake Roku')
+        self.assertEqual(float(rows[0]["cpu_total"]), 73.0)
+
+
+class TestLaunchTiming(unittest.TestCase):
+
+    def test_cold_launch_until_foreground_and_console_marker(self):
+        with FakeRoku(launch_delay=0.2) as device:
+            install_fake_channel(device)
+            roku = Roku(device.device_data)
+            results = measure_launch(roku, runs=2, settle=0.0, timeout=5.0)
+            self.assertEqual(device.keypresses, ['Home', 'Home'])
+            console_results = measure_launch(roku, runs=1, ready='console', settle=0.0, timeout=5.0)
+            missing_marker = measure_launch(roku, runs=1, ready='console', marker='NeverPrinted', settle=0.0,
+                                            timeout=0.5)
+
+        self.assertEqual([result["error"] for result in results], [None, None])
+        self.assertTrue(all(0.2 <= result["seconds"] < 2.0 for result in results))
+        self.assertTrue(0.2 <= console_results[0]["seconds"] < 2.0)
+        self.assertIn('not ready', missing_marker[0]["error"])
+        summary = launch_summary(results + missing_marker)
+        self.assertEqual((summary["count"], summary["failed"]), (2, 1))
+
+
+class TestConsoleLogs(unittest.TestCase):
+
+    def test_follows_consoles_with_filters(self):
+        with FakeRoku('Console A') as first, FakeRoku('Console B') as second:
+            written = []
+
+            def print_lines():
+                while len(first.console_clients) + len(second.console_clients) < 2:
+                    time.sleep(0.01)
+                first.console_print('keep first')
+                second.console_print('keep second')
+                first.console_print('keep but skip this')
+                second.console_print('other output')
+
+            printer = threading.Thread(target=print_lines)
+            printer.start()
+            device_logs = stream_logs([first.device_data, second.device_data], written.extend,
+                                      LineFilter(['keep'], ['skip']), duration=1.0)
+            printer.join()
+
+        self.assertEqual([line.split(' ', 1)[1] for line in written],
+                         ['[Console A] keep first', '[Console B] keep second'])
+        self.assertEqual([(log.received, log.filtered, log.dropped) for log in device_logs], [(2, 1, 0), (2, 1, 0)])
+
+    def test_ring_buffer_and_rotation(self):
+        device_log = DeviceLog({"name": 'Noisy', "ip_address": '127.0.0.1'}, buffer_lines=3)
+        for index in range(5):
+            device_log.append(float(index), f'line {index}')
+        self.assertEqual([line for _, _, line in device_log.take()], ['line 2', 'line 3', 'line 4'])
+        self.assertEqual(device_log.dropped, 2)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            log_path = os.path.join(temp_dir, 'console.log')
+            writer = RotatingWriter(log_path, max_bytes=10, backups=2)
+            for index in range(4):
+                writer.write(f'line {index}\n')
+            writer.close()
+            self.assertEqual(sorted(os.listdir(temp_dir)), ['console.log', 'console.log.1', 'console.log.2'])
+            with open(log_path) as log_file:
+                self.assertEqual(log_file.read(), 'line 3\n')
+
+
+class TestFakeDeviceDeploy(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.channel_path = Path(self.temp_dir.name)
+        (self.channel_path / 'source').mkdir()
+        (self.channel_path / 'manifest').write_text('title=Test\nmajor_version=1\nminor_version=2\nbuild_version=3\n')
+        (self.channel_path / 'source' / 'main.brs').write_text('sub main()\nend sub\n')
+        self.channel = Channel(self.channel_path)
+        self.channel.manifest_data = {'title': 'Test', 'major_version': '1', 'minor_version': '2',
+                                      'build_version': '3'}
+        self.registry = DeviceRegistry(self.channel_path / 'devices.json')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def build_archive(self):
+        archive_path = self.channel.out_dir / f'{self.channel.__str__()}.zip'
+        for _ in ArchiveStream(self.channel_path, ['manifest', 'source/main.brs'], archive_path):
+            pass
+
+    def test_retries_stop_at_the_device_deadline(self):
+        self.build_archive()
+        with socket.socket() as unused:
+            unused.bind(('127.0.0.1', 0))
+            port = unused.getsockname()[1]
+        device = {"name": 'Offline', "username": 'rokudev', "password": '', "ip_address": '127.0.0.1',
+                  "ecp_port": port, "http_port": port}
+
+        started = time.perf_counter()
+        results = deploy_to_fleet([device], self.channel, timeout=0.5, retries=5, backoff=0.2)
+
+        self.assertLess(time.perf_counter() - started, 1.0)
+        self.assertEqual(results[0]["attempts"], 2)
+        self.assertTrue(results[0]["timed_out"])
+        self.assertFalse(results[0]["ok"])
+        self.assertIn('device timeout of 0.5s reached', results[0]["error"])
+
+    def test_streamed_install_and_replace(self):
+        with FakeRoku(support_replace=True) as device:
+            roku = Roku(device.device_data)
+            archive_stream = ArchiveStream(self.channel_path, ['manifest', 'source/main.brs'])
+            result = roku.install_channel(self.channel, archive_stream)
+            self.assertEqual(result["status"], 200)
+            self.assertEqual(result["messages"], ['Install Success.'])
+            self.assertEqual(device.installed["version"], '1.2.3')
+
+            self.build_archive()
+            roku = Roku(device.device_data)
+            self.assertTrue(roku.supports_replace())
+            requests_before = len(device.requests)
+            self.assertEqual(roku.install_channel(self.channel)["messages"], ['Install Success.'])
+            self.assertEqual(device.requests[requests_before:], [('POST', '/plugin_install')])
+
+    def test_wrong_password_is_rejected(self):
+        with FakeRoku(password='secret') as device:
+            device_data = dict(device.device_data, password='wrong')
+            self.build_archive()
+            result = Roku(device_data).install_channel(self.channel)
+
+            self.assertEqual(result["status"], 401)
+            self.assertIsNone(device.installed)
+
+    def test_fleet_deploy_skips_devices_with_the_same_build(self):
+        self.build_archive()
+        self.channel.build_fingerprint = 'fingerprint'
+        with FakeRoku('one') as first, FakeRoku('two') as second:
+            devices = [first.device_data, second.device_data]
+            results = deploy_to_fleet(devices, self.channel, registry=self.registry)
+            self.assertEqual([result["ok"] for result in results], [True, True])
+            self.assertEqual([result["skipped"] for result in results], [False, False])
+
+            results = deploy_to_fleet(devices, self.channel, registry=self.registry)
+            self.assertEqual([result["skipped"] for result in results], [True, True])
+
+            self.channel.build_fingerprint = 'changed'
+            results = deploy_to_fleet(devices, self.channel, registry=self.registry)
+            self.assertEqual([result["skipped"] for result in results], [False, False])
+
+            # a forced deploy of the first build is recorded so going back to it is not skipped
+            self.channel.build_fingerprint = 'fingerprint'
+            results = deploy_to_fleet(devices, self.channel, registry=self.registry)
+            self.assertEqual([result["skipped"] for result in results], [False, False])
+            self.channel.build_fingerprint = 'forced'
+            results = deploy_to_fleet(devices, self.channel, registry=self.registry, force=True)
+            self.assertEqual([result["skipped"] for result in results], [False, False])
+            self.channel.build_fingerprint = 'fingerprint'
+            results = deploy_to_fleet(devices, self.channel, registry=self.registry)
+            self.assertEqual([result["skipped"] for result in results], [False, False])
+
+
+class TestDeployDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.channel_path = Path(self.temp_dir.name) / 'channel'
+        (self.channel_path / 'source').mkdir(parents=True)
+        (self.channel_path / 'manifest').write_text('title=Daemon\nmajor_version=1\nminor_version=0\nbuild_version=1\n')
+        (self.channel_path / 'source' / 'main.brs').write_text('sub main()\nend sub\n')
+        (self.channel_path / 'rokuPiConfig.json').write_text(json.dumps({"files": ['manifest', 'source/**']}))
+        self.daemon = DeployDaemon(DeviceRegistry(Path(self.temp_dir.name) / 'devices.json'), build_channel)
+        self.socket_path = Path(self.temp_dir.name) / 'serve.sock'
+        self.servers = start_servers(self.daemon, self.socket_path, port=0)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.daemon.close()
+        self.temp_dir.cleanup()
+
+    def post(self, path, body):
+        port = self.servers[1].server_address[1]
+        response = urllib3.PoolManager().request('POST', f'http://127.0.0.1:{port}{path}', body=json.dumps(body))
+        return response.status, json.loads(response.data)
+
+    def test_http_port_requires_the_token(self):
+        servers = start_servers(self.daemon, port=0, token='s3cret')
+        self.addCleanup(servers[0].server_close)
+        self.addCleanup(servers[0].shutdown)
+        url = f'http://127.0.0.1:{servers[0].server_address[1]}'
+        http = urllib3.PoolManager()
+
+        self.assertEqual(http.request('GET', f'{url}/stats').status, 401)
+        self.assertEqual(http.request('POST', f'{url}/deploy', body=json.dumps({"channel": str(self.channel_path)}),
+                                      headers={'Authorization': 'Bearer wrong'}).status, 401)
+        self.assertEqual(http.request('GET', f'{url}/stats', headers={'Authorization': 'Bearer s3cret'}).status, 200)
+        # the owner only Unix socket and the server without a token stay open
+        self.assertEqual(self.post('/query', {})[0], 400)
+
+    def test_serve_refuses_network_hosts_without_a_token(self):
+        result = CliRunner().invoke(cli, ['serve', '--port', '0', '--host', '0.0.0.0'],
+                                    env={'ROKUPI_SERVE_TOKEN': None, 'HOME': self.temp_dir.name})
+
+        self.assertEqual(result.exit_code, 2, result.output)
+        self.assertIn('ROKUPI_SERVE_TOKEN', result.output)
+
+    def test_deploys_and_queues_jobs_per_device(self):
+        with FakeRoku('Daemon A') as first, FakeRoku('Daemon B') as second:
+            devices = [first.device_data, second.device_data]
+            status, response = self.post('/deploy', {"channel": str(self.channel_path), "devices": devices})
+            self.assertEqual(status, 200, response)
+            self.assertEqual([device.installed["version"] for device in (first, second)], ['1.0.1', '1.0.1'])
+
+            status, response = self.post('/deploy', {"channel": str(self.channel_path), "devices": devices[:1]})
+            self.assertEqual(response["jobs"][0]["result"]["skipped"], True)
+
+            status, response = self.post('/keypress', {"device": devices[0], "keys": ['Up', 'Down'], "wait": False})
+            self.assertEqual(status, 202)
+            status, response = self.post('/query', {"device": devices[0], "query": 'active-app'})
+            self.assertEqual(response["jobs"][0]["result"], 'dev')
+            self.assertEqual(first.keypresses, ['Up', 'Down'])
+            self.assertEqual(self.post('/query', {"device": devices[0], "query": 'uptime'})[0], 400)
+
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(str(self.socket_path))
+            sock.sendall(b'GET /stats HTTP/1.1\r\nHost: local\r\nConnection: close\r\n\r\n')
+            stats = json.loads(b''.join(iter(lambda: sock.recv(65536), b'')).split(b'\r\n\r\n', 1)[1])
+        first_stats = stats["devices"][f'127.0.0.1:{devices[0]["ecp_port"]}']
+        self.assertEqual((first_stats["completed"], first_stats["queued"], first_stats["running"]), (4, 0, None))
+        self.assertEqual(stats["devices"][f'127.0.0.1:{devices[1]["ecp_port"]}']["completed"], 1)
+        self.assertEqual(list(stats["builds"].values())[0]["count"], 2)
+
+    def test_queued_deploy_uploads_the_build_it_was_queued_with(self):
+        gates = [threading.Event(), threading.Event()]
+        with FakeRoku('Daemon Queue') as device:
+            self.daemon.submit('keypress', device.device_data, lambda roku: gates[0].wait(5))
+            first_job, = self.daemon.deploy(self.channel_path, [device.device_data])
+            self.daemon.submit('keypress', device.device_data, lambda roku: gates[1].wait(5))
+            (self.channel_path / 'manifest').write_text('title=Daemon\nmajor_version=1\nminor_version=0\n'
+                                                        'build_version=2\n')
+            second_job, = self.daemon.deploy(self.channel_path, [device.device_data])
+
+            gates[0].set()
+            self.assertTrue(first_job.done.wait(5))
+            self.assertTrue(first_job.result["ok"], first_job.as_dict())
+            self.assertEqual(device.installed["version"], '1.0.1')
+            gates[1].set()
+            self.assertTrue(second_job.done.wait(5))
+            self.assertEqual(device.installed["version"], '1.0.2')
+        self.assertEqual(list(self.daemon.pin_dir.iterdir()), [])
+
+
+class TestFileMatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.channel_path = Path(self.temp_dir.name)
+        for relative_path in ['manifest', 'source/main.brs', 'source/.main.brs.swp', 'source/lib/util.brs',
+                              'components/Home.xml', 'components/debug/Panel.xml', 'images/icon.png',
+                              'images/raw/icon.psd', '.git/HEAD', 'out/Test_1.0.0.zip', 'notes.txt']:
+            (self.channel_path / relative_path).parent.mkdir(parents=True, exist_ok=True)
+            (self.channel_path / relative_path).write_text(relative_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_includes_and_excludes(self):
+        glob_array = ['manifest', 'source/**', 'components', 'images/*.png', '!components/debug', '!**/*.psd']
+        channel_files = collect_channel_files(self.channel_path, glob_array)
+
+        self.assertEqual(list(channel_files),
+                         ['components/Home.xml', 'images/icon.png', 'manifest', 'source/lib/util.brs',
+                          'source/main.brs'])
+        self.assertEqual(channel_files['manifest'].st_size, len('manifest'))
+
+    def test_follows_symlinked_directories_without_looping(self):
+        shared_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(shared_dir.cleanup)
+        shared_path = Path(shared_dir.name)
+        (shared_path / 'shared.brs').write_text('sub shared()\nend sub\n')
+        (shared_path / 'loop').symlink_to(shared_path)
+        (self.channel_path / 'source' / 'shared').symlink_to(shared_path)
+
+        channel_files = collect_channel_files(self.channel_path, ['manifest', 'source/**'])
+
+        self.assertEqual(list(channel_files), ['manifest', 'source/lib/util.brs', 'source/main.brs',
+                                               'source/shared/shared.brs'])
+        self.assertIn('manifest', BuildCache(self.channel_path).scan(channel_files))
+
+    def test_single_path_checks_and_pruning(self):
+        matcher = FileMatcher(['manifest', 'source/**', 'images/*.png'])
+
+        self.assertTrue(matcher.matches('source/deep/main.brs'))
+        self.assertFalse(matcher.matches('source/.main.brs.swp'))
+        self.assertFalse(matcher.matches('out/Test_1.0.0.zip'))
+        self.assertFalse(matcher.matches('images/raw/icon.png'))
+        self.assertTrue(matcher.may_contain('images'))
+        self.assertFalse(matcher.may_contain('images/raw'))
+        self.assertFalse(matcher.may_contain('docs'))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.channel_path = Path(self.temp_dir.name)
+        (self.channel_path / 'manifest').write_text('title=Test\nmajor_version=1\nminor_version=2\nbuild_version=3\n')
+        self.channel = Channel(self.channel_path)
+        self.channel.manifest_data = {'title': 'Test', 'major_version': '1', 'minor_version': '2',
+                                      'build_version': '3'}
+        for _ in ArchiveStream(self.channel_path, ['manifest'], self.channel.out_dir / 'Test_1.2.3.zip'):
+            pass
+        TRACER.enable()
+
+    def tearDown(self):
+        TRACER.enabled = False
+        self.temp_dir.cleanup()
+
+    def test_install_phases_are_traced(self):
+        with FakeRoku(support_replace=False) as device:
+            Roku(device.device_data).install_channel(self.channel)
+
+        phases = {phase["name"]: phase for phase in TRACER.summary()}
+        self.assertEqual(phases["install_on_device"]["statuses"], {'200': 1})
+        self.assertGreater(phases["install_upload"]["bytes"], (self.channel.out_dir / 'Test_1.2.3.zip').stat().st_size)
+        self.assertIn('delete_upload', phases)
+        self.assertIn('authenticate', phases)
+
+        trace_path = self.channel_path / 'trace.json'
+        TRACER.write_chrome_trace(str(trace_path))
+        with open(str(trace_path)) as trace_file:
+            trace_events = json.load(trace_file)["traceEvents"]
+        spans = [event for event in trace_events if event["ph"] == 'X']
+        self.assertEqual(len(spans), len(TRACER.events))
+        self.assertTrue(all(event["dur"] >= 0 and event["ts"] >= 0 for event in spans))
+
+
+class TestChannelWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.channel_path = Path(self.temp_dir.name)
+        (self.channel_path / 'source').mkdir()
+        (self.channel_path / 'manifest').write_text('title=Test\n')
+        (self.channel_path / 'source' / 'main.brs').write_text('sub main()\nend sub\n')
+        self.glob_array = ['manifest', 'source/**']
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_watch_roots(self):
+        self.assertEqual(watch_roots(self.channel_path, self.glob_array),
+                         {self.channel_path: False, self.channel_path / 'source': True})
+
+    def test_watchers_must_read_changes(self):
+        with self.assertRaises(TypeError):
+            ChannelWatcher(self.channel_path, self.glob_array)
+
+    def test_watch_survives_broken_saves(self):
+        class ScriptedWatcher:
+            def __init__(self, saves):
+                self.saves = iter(saves)
+
+            def wait_for_change(self, debounce):
+                try:
+                    next(self.saves)()
+                except StopIteration:
+                    raise KeyboardInterrupt
+                return time.time(), {'manifest'}
+
+            def close(self):
+                pass
+
+        manifest_path = self.channel_path / 'manifest'
+        archives = []
+
+        def build_archive():
+            if channel.config_data["compression"] == 'bogus':
+                raise click.ClickException('unknown compression bogus')
+            archives.append(dict(channel.manifest_data))
+            return archives[-1]
+
+        channel = mock.Mock(channel_path=self.channel_path,
+                            config_data={"files": self.glob_array, "compression": 'auto'})
+        saves = [lambda: manifest_path.write_text('title=Test\nbs_const\n'),
+                 lambda: manifest_path.write_text('title=Fixed\n'),
+                 lambda: channel.config_data.update(compression='bogus'),
+                 lambda: channel.config_data.update(compression='auto')]
+        with mock.patch('rokuPi.create_watcher', return_value=ScriptedWatcher(saves)):
+            with mock.patch('click.echo') as echo:
+                watch_channel(channel, build_archive, lambda archive: True)
+
+        self.assertEqual(archives, [{'title': 'Fixed'}, {'title': 'Fixed'}])
+        output = [call[0][0] for call in echo.call_args_list]
+        self.assertTrue(any(line.startswith('redeploy failed: IndexError') for line in output), output)
+        self.assertTrue(any(line.startswith('redeploy failed: ClickException') for line in output), output)
+        self.assertEqual(output[-1], 'stopped watching')
+
+    def assert_burst_is_one_change(self, watcher):
+        def save_files():
+            time.sleep(0.2)
+            for index in range(3):
+                (self.channel_path / 'source' / 'main.brs').write_text(f'sub main()\n\' save {index}\nend sub\n')
+                time.sleep(0.05)
+            (self.channel_path / 'out.log').write_text('ignored')
+
+        threading.Thread(target=save_files).start()
+        try:
+            first_change, changes = watcher.wait_for_change(debounce=0.3)
+        finally:
+            watcher.close()
+
+        self.assertEqual(changes, {'source/main.brs'})
+        self.assertLessEqual(first_change, time.time())
+
+    def test_polling_watcher(self):
+        self.assert_burst_is_one_change(PollingWatcher(self.channel_path, self.glob_array, collect_channel_files, 0.05))
+
+    def test_default_watcher(self):
+        self.assert_burst_is_one_change(create_watcher(self.channel_path, self.glob_array, collect_channel_files))
+
+
+class TestNonInteractiveDeploy(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.channel_path = Path(self.temp_dir.name) / 'channel'
+        (self.channel_path / 'source').mkdir(parents=True)
+        (self.channel_path / 'manifest').write_text('title=Test\nmajor_version=1\nminor_version=2\nbuild_version=3\n')
+        (self.channel_path / 'source' / 'main.brs').write_text('sub main()\nend sub\n')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_import_skips_interactive_dependencies(self):
+        output = subprocess.run(
+            [sys.executable, '-c', 'import rokuPi, sys; print(sorted(set(sys.modules) & '
+                                   '{"pyfiglet", "PyInquirer", "prompt_toolkit", "asyncio"}))'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, check=True).stdout
+
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_deploy_takes_everything_from_config_and_environment(self):
+        with FakeRoku(password='secret') as device:
+            with open(str(self.channel_path / 'rokuPiConfig.json'), 'w') as config_file:
+                json.dump({"files": ['manifest', 'source/**'], "device": dict(device.device_data, password='')},
+                          config_file)
+            result = CliRunner().invoke(cli, ['-c', str(self.channel_path), '--non-interactive'], env={
+                'HOME': self.temp_dir.name,
+                'ROKUPI_PASSWORD': 'secret'
+            })
+
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(device.installed["version"], '1.2.3')
+            self.assertNotIn('RokuPi', result.output.splitlines()[0])
+
+    def test_failed_install_exits_with_an_error(self):
+        with FakeRoku(password='secret') as device:
+            with open(str(self.channel_path / 'rokuPiConfig.json'), 'w') as config_file:
+                json.dump({"files": ['manifest', 'source/**'], "device": dict(device.device_data, password='')},
+                          config_file)
+            result = CliRunner().invoke(cli, ['-c', str(self.channel_path), '--non-interactive'], env={
+                'HOME': self.temp_dir.name,
+                'ROKUPI_PASSWORD': 'wrong'
+            })
+
+            self.assertEqual(result.exit_code, 1, result.output)
+            self.assertIsNone(device.installed)
+
+    def test_config_fleet_devices_without_a_password_use_the_environment(self):
+        with FakeRoku(password='secret') as device:
+            saved = {key: value for key, value in device.device_data.items() if key != 'password'}
+            with open(str(self.channel_path / 'rokuPiConfig.json'), 'w') as config_file:
+                json.dump({"files": ['manifest', 'source/**'], "devices": [saved]}, config_file)
+            result = CliRunner().invoke(cli, ['-c', str(self.channel_path), '--non-interactive'],
+                                        env={'HOME': self.temp_dir.name})
+            self.assertEqual(result.exit_code, 2, result.output)
+            self.assertIn(PASSWORD_ENV, result.output)
+
+            result = CliRunner().invoke(cli, ['-c', str(self.channel_path), '--non-interactive'], env={
+                'HOME': self.temp_dir.name,
+                'ROKUPI_PASSWORD': 'secret'
+            })
+
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('1 of 1 devices deployed', result.output)
+            self.assertEqual(device.installed["version"], '1.2.3')
+
+    def test_missing_device_fails_instead_of_prompting(self):
+        result = CliRunner().invoke(cli, ['-c', str(self.channel_path), '--non-interactive', '--structure',
+                                          'manifest, source/**'], env={'HOME': self.temp_dir.name})
+
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('no device to deploy to', result.output)
+        with open(str(self.channel_path / 'rokuPiConfig.json')) as config_file:
+            self.assertEqual(json.load(config_file)["files"], ['manifest', 'source/**'])
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
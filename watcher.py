@@ -0,0 +1,188 @@
+import abc
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from file_matcher import FileMatcher
+from pathlib import Path, PurePosixPath
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+IN_IGNORED = 0x00008000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+DEBOUNCE = 0.3
+POLL_INTERVAL = 0.5
+
+
+def watch_roots(channel_path, glob_array):
+    """
+    Works out which directories need watching for the config globs
+    :return: Dictionary - directory path to whether it is watched recursively
+    """
+    roots = {Path(channel_path): False}
+    for pattern in glob_array:
+        if pattern.strip().startswith('!'):
+            continue
+        parts = PurePosixPath(pattern.strip()).parts
+        static = []
+        for part in parts:
+            if any(character in part for character in '*?['):
+                break
+            static.append(part)
+        base = Path(channel_path).joinpath(*static)
+        if len(static) < len(parts) or base.is_dir():
+            roots[base] = True
+        elif base.parent != Path(channel_path):
+            roots.setdefault(base.parent, False)
+
+    return roots
+
+
+class ChannelWatcher(abc.ABC):
+    def __init__(self, channel_path, glob_array):
+        self.channel_path = Path(channel_path)
+        self.glob_array = glob_array
+        self.matcher = FileMatcher(glob_array)
+
+    @abc.abstractmethod
+    def read_changes(self, timeout):
+        """
+        :param timeout: Float - seconds to wait for a change, None waits until one arrives
+        :return: Set - changed relative paths, empty when the timeout passed without changes
+        """
+
+    def wait_for_change(self, debounce=DEBOUNCE):
+        """
+        Blocks until a matched channel file changes, then keeps collecting changes until
+        none arrived for the debounce interval so a burst of saves becomes one rebuild
+        :param debounce: Float - seconds without changes that end a burst
+        :return: Tuple - time.time() of the first change and the set of changed relative paths
+        """
+        changes = set()
+        while not changes:
+            changes = self.read_changes(None)
+        first_change = time.time()
+
+        while True:
+            more_changes = self.read_changes(debounce)
+            if not more_changes:
+                return first_change, changes
+            changes.update(more_changes)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(ChannelWatcher):
+    """
+    Linux inotify through libc, only the directories the config globs can reach are watched
+    """
+    def __init__(self, channel_path, glob_array):
+        super().__init__(channel_path, glob_array)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        for root, recursive in watch_roots(self.channel_path, glob_array).items():
+            self.add_watch(root, recursive)
+
+    def add_watch(self, directory, recursive):
+        if not directory.is_dir():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(directory)), WATCH_MASK)
+        if wd >= 0:
+            recursive = recursive or self.watches.get(wd, (directory, False))[1]
+            self.watches[wd] = (directory, recursive)
+        if recursive:
+            for child in os.scandir(str(directory)):
+                relative_path = Path(child.path).relative_to(self.channel_path).as_posix()
+                if child.is_dir(follow_symlinks=False) and not self.matcher.exclude.fullmatch(relative_path):
+                    self.add_watch(Path(child.path), True)
+
+    def read_changes(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changes = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changes
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + name_length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name:
+                continue
+
+            directory, recursive = self.watches[wd]
+            path = directory / os.fsdecode(name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and recursive:
+                self.add_watch(path, True)
+            relative_path = path.relative_to(self.channel_path).as_posix()
+            if self.matcher.matches(relative_path):
+                changes.add(relative_path)
+
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(ChannelWatcher):
+    """
+    Fallback that compares size and mtime of the matched files on an interval
+    """
+    def __init__(self, channel_path, glob_array, list_files, interval=POLL_INTERVAL):
+        super().__init__(channel_path, glob_array)
+        self.list_files = list_files
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        return {relative_path: (stat.st_size, stat.st_mtime_ns)
+                for relative_path, stat in self.list_files(self.channel_path, self.glob_array).items()}
+
+    def read_changes(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(self.interval if deadline is None else max(0.0, min(self.interval, deadline - time.monotonic())))
+            snapshot = self.take_snapshot()
+            changes = {path for path in set(snapshot) | set(self.snapshot)
+                       if snapshot.get(path) != self.snapshot.get(path)}
+            self.snapshot = snapshot
+            if changes or (deadline is not None and time.monotonic() >= deadline):
+                return changes
+
+
+def create_watcher(channel_path, glob_array, list_files):
+    """
+    Uses inotify where available and falls back to polling
+    :param channel_path: Object - path object to channel root
+    :param glob_array: List - config file globs
+    :param list_files: Function - lists matched files with their stat results, used by the polling fallback
+    :return: Object - ChannelWatcher
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(channel_path, glob_array)
+        except (OSError, AttributeError):
+            pass
+
+    return PollingWatcher(channel_path, glob_array, list_files)